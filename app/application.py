@@ -7,24 +7,44 @@ import psycopg2
 import time
 import subprocess
 import copy
-import markdown
 import tempfile
 import functools 
+import contextlib
+import datetime
+import signal
+import threading
 
 from threading import Timer
-from glob import glob
+from collections import deque
 from functools import wraps
-from io import StringIO, BytesIO
+from io import BytesIO
 
 
+from psycopg2 import sql
 from psycopg2.extras import DictCursor, RealDictCursor
 from dotenv import load_dotenv
-from huey import SqliteHuey
+from huey import SqliteHuey, crontab
+from threading import Lock
 
 from flask import Flask, render_template, redirect, url_for, g, request, \
-                  jsonify, Markup
+                  jsonify, Markup, Response, abort
 from flask.json import dumps
 
+from pool import ConnectionPool, PoolExhausted
+from locks import DatabaseSlots
+from downloads import DownloadCache
+from events import StatusFeed, CHANNEL
+from tasklog import TaskLogHandler, for_task
+from catalog import DatasetCatalog
+from taskqueue import PostgresHuey, PostgresStorage
+from report import build_report
+from snapshots import SnapshotError, list_snapshots, remove_snapshots, export_snapshot, restore_snapshot
+from tiles import TileCache, generation, valid_tile, table_sources, build_tile
+from metrics import Histogram, metric
+from scheduler import build_plan, PlanError, FETCH_PREFIX
+from postinstall import build_indexes, reorganize, simplified_tables, build_simplified, analyze, \
+                        relocate, relocate_index, swap_tables
+
 # Version
 __version__ = '0.1.1'
 
@@ -35,6 +55,10 @@ handler = logging.StreamHandler(sys.stdout)
 handler.setLevel(logging.DEBUG)
 logger.addHandler(handler)
 
+# Logger shared by all tasks, see tasklog.py.
+tasks_logger = logging.getLogger("task_logger")
+tasks_logger.setLevel(logging.DEBUG)
+
 # Load the dotenv files in the path
 load_dotenv()
 
@@ -65,22 +89,46 @@ class ApplicationError(Exception):
 class InstallTerminated(Exception):
     pass
 
+class InstallCancelled(Exception):
+    pass
+
 class InstallFailed(Exception):
     pass
 
 class ApplicationNotInitialized(Exception):
     pass
 
-# Create our SqliteHuey instance in Flask's instance_path directory
-huey_file = os.path.join(app.instance_path, 'huey.db')
-def get_huey(reset=False):
-    if reset:
-        os.remove(huey_file)
-    return SqliteHuey(filename=huey_file)
-huey = get_huey()
+# Directory for the persistent download cache used by the makefiles, see 
+# downloads.py for details.
+download_cache_dir = os.path.join(app.instance_path, 'downloads')
 
-# Function to fetch a database connection
-def get_db():
+# Directory for the lock files used to limit the number of concurrent tasks,
+# downloads and imports, see locks.py for details.
+lock_dir = os.path.join(app.instance_path, 'locks')
+
+# Directory for the working directories of install tasks. These are kept
+# when an install fails, so that a retry can resume where it left off.
+work_dir_root = os.path.join(app.instance_path, 'work')
+
+# The datasets and their layers, see catalog.py. Loading it here makes the
+# application refuse to start with a dataset that doesn't validate.
+catalog = DatasetCatalog(os.path.join(app.root_path, 'datasets'))
+catalog.refresh()
+
+# Directory for the snapshots of installed layers, see snapshots.py.
+snapshot_dir = os.path.join(app.instance_path, 'snapshots')
+
+# Cache of the vector tiles served on /tiles/, see tiles.py for details.
+tile_cache = TileCache(os.path.join(app.instance_path, 'tiles'),
+                       int(app.config.get('PG_BASELAYERS_TILE_CACHE_SIZE')) * 1024 * 1024,
+                       int(app.config.get('PG_BASELAYERS_TILE_MEMORY_CACHE_SIZE')) * 1024 * 1024)
+
+# The stages of an install that are checkpointed, in order. The first two 
+# are reported by the makefiles, the others by run_task.
+INSTALL_STAGES = ['downloaded', 'extracted', 'imported', 'indexed']
+
+# Function to open a new database connection
+def connect_db_raw():
     conn = psycopg2.connect(dbname=app.config.get("POSTGRES_DB",""),
                     user=app.config.get("POSTGRES_USER",""), 
                     password=app.config.get("POSTGRES_PASSWORD",""),
@@ -90,10 +138,89 @@ def get_db():
                     sslrootcert=app.config.get("POSTGRES_SSLROOTCERT",""))
     return conn
 
+# Connection pool shared by the web application and the huey worker. It is
+# created lazily so that each process (gunicorn worker, huey consumer) gets 
+# its own pool after forking.
+_pool = None
+_pool_lock = Lock()
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(connect_db_raw,
+                min_size=int(app.config.get('PG_BASELAYERS_POOL_MIN_SIZE')),
+                max_size=int(app.config.get('PG_BASELAYERS_POOL_MAX_SIZE')),
+                max_uses=int(app.config.get('PG_BASELAYERS_POOL_MAX_USES')),
+                max_age=int(app.config.get('PG_BASELAYERS_POOL_MAX_AGE')),
+                timeout=int(app.config.get('PG_BASELAYERS_POOL_TIMEOUT')))
+            _pool.fill()
+    return _pool
+
+# Function to fetch a database connection from the pool. Connections must be
+# handed back with release_db() when done.
+def get_db():
+    return get_pool().getconn()
+
+def release_db(conn, close=False):
+    get_pool().putconn(conn, close=close)
+
+# Functions to open and close a connection for bulk work like building 
+# indexes, which uses several connections per task for a long time. These
+# aren't taken from the pool, so that they can't use up the connections the
+# tasks need for their status, logs and timings.
+def get_bulk_db():
+    return connect_db_raw()
+
+def release_bulk_db(conn):
+    conn.close()
+
+# Create our huey instance. By default its queue is kept in the database (see
+# taskqueue.py), so that workers on several machines can share it. With 
+# PG_BASELAYERS_QUEUE=sqlite it's kept in Flask's instance_path directory 
+# instead, which only workers on the same machine can use.
+huey_file = os.path.join(app.instance_path, 'huey.db')
+def get_huey(reset=False):
+    if app.config.get('PG_BASELAYERS_QUEUE') == 'sqlite':
+        if reset:
+            os.remove(huey_file)
+        return SqliteHuey(filename=huey_file)
+    postgres_huey = PostgresHuey(results=False, get_conn=get_db, release_conn=release_db, connect=connect_db_raw,
+                                 lease=int(app.config.get('PG_BASELAYERS_QUEUE_LEASE')),
+                                 max_attempts=int(app.config.get('PG_BASELAYERS_QUEUE_MAX_ATTEMPTS')))
+    if reset:
+        postgres_huey.flush()
+    return postgres_huey
+huey = get_huey()
+
+
+# Live layer status pushed by the database, see events.py. Like the pool, 
+# it's started lazily in each process that needs it.
+_status_feed = None
+def get_status_feed():
+    global _status_feed
+    with _pool_lock:
+        if _status_feed is None:
+            _status_feed = StatusFeed(connect_db_raw, log=logger.info).start()
+    return _status_feed
 
 def check_username_and_password(username, password):
     return username == app.config['PG_BASELAYERS_USERNAME'] and password == app.config['PG_BASELAYERS_PASSWORD']
 
+# Time taken to handle requests, by endpoint. Exported on /metrics.
+request_duration = Histogram('pg_baselayers_http_request_duration_seconds',
+                             "Time taken to handle HTTP requests.", ['endpoint', 'method', 'status'])
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.time()
+
+@app.after_request
+def record_request_duration(response):
+    if 'request_started' in g:
+        request_duration.observe(time.time() - g.request_started, endpoint=request.endpoint or '',
+                                 method=request.method, status=response.status_code)
+    return response
+
 # Validate the environment to make sure several environment variables are 
 # defined, and it sets up the database connectivity on flask's g.conn.
 @app.before_request
@@ -103,56 +230,239 @@ def basic_authentication():
 
     auth = request.authorization
     if not auth or not check_username_and_password(auth.username, auth.password):
-        print("RETURIING AUTHHHENTI") 
         resp = jsonify({'message': "Please authenticate."})
         resp.status_code = 401
         resp.headers['WWW-Authenticate'] = 'Basic realm="PostGIS-Baselayers"'
         return resp
 
+# Endpoints that never touch the database, so they don't need a connection 
+# or any of the checks below.
+NO_DB_ENDPOINTS = {'static', 'reset', 'events'}
+
+# Per-process cache of the database state checks in connect_db(). Only a 
+# healthy state (PostGIS present and our schema initialized) is cached, for 
+# PG_BASELAYERS_STATE_CACHE_TTL seconds, so that a missing PostGIS or schema
+# is always detected straight away.
+_db_state = {'checked': 0, 'postgis_version': None}
+_db_state_lock = Lock()
+
+def invalidate_db_state():
+    with _db_state_lock:
+        _db_state.update(checked=0, postgis_version=None)
+
+# Version of the tables in the postgis_baselayers schema, kept as the comment
+# of the schema. Increase it whenever create_schema() changes, so that the
+# tables of existing installations are brought up to date.
+SCHEMA_VERSION = '2'
+
+def create_schema(cur):
+    """
+    Create the application schema and its tables, or add what is missing to
+    them. The caller commits.
+    """
+    cur.execute("""
+        CREATE SCHEMA IF NOT EXISTS postgis_baselayers;
+        CREATE TABLE IF NOT EXISTS postgis_baselayers.dataset (
+          name varchar(256) PRIMARY KEY,    -- eg. 'example'
+          metadata json NOT NULL            -- flexible column for later use
+        );
+        CREATE TABLE IF NOT EXISTS postgis_baselayers.layer (
+          key varchar(512) PRIMARY KEY,     -- eg. 'example.airports'
+          name varchar(256) NOT NULL,       -- eg. 'airports'
+          dataset_name varchar(256) REFERENCES postgis_baselayers.dataset(name),
+          status int DEFAULT 0 NOT NULL,    -- 0: not installed; 1: installed; 2: queued; 3: working 4: error
+          info varchar(512) DEFAULT '',     -- additional status info 
+          metadata json NOT NULL            -- flexible column for later use
+        );
+        CREATE TABLE IF NOT EXISTS postgis_baselayers.log (
+          id SERIAL PRIMARY KEY,
+          created TIMESTAMP DEFAULT NOW(), 
+          layer_key varchar(128) REFERENCES postgis_baselayers.layer(key),
+          task_id varchar(128) NOT NULL, 
+          target varchar(128) NOT NULL,     -- eg: 'install' or 'uninstall'
+          info varchar(512),                -- additional status info
+          log TEXT
+        );
+        ALTER TABLE postgis_baselayers.log ADD COLUMN IF NOT EXISTS status int;
+        ALTER TABLE postgis_baselayers.log ADD COLUMN IF NOT EXISTS duration float;
+        CREATE INDEX IF NOT EXISTS log_created_idx ON postgis_baselayers.log (created);
+        CREATE INDEX IF NOT EXISTS log_task_id_idx ON postgis_baselayers.log (task_id);
+        CREATE TABLE IF NOT EXISTS postgis_baselayers.log_chunk (
+          task_id varchar(128) NOT NULL,
+          seq int NOT NULL,                 -- chunks are numbered from 0 
+          content TEXT NOT NULL,
+          PRIMARY KEY (task_id, seq)
+        );
+        ALTER TABLE postgis_baselayers.layer ADD COLUMN IF NOT EXISTS version int NOT NULL DEFAULT 0;
+        ALTER TABLE postgis_baselayers.layer ADD COLUMN IF NOT EXISTS installed timestamp;
+        ALTER TABLE postgis_baselayers.layer ADD COLUMN IF NOT EXISTS rollback_schema varchar(128);
+        ALTER TABLE postgis_baselayers.layer ADD COLUMN IF NOT EXISTS rollback_version int;
+        ALTER TABLE postgis_baselayers.layer ADD COLUMN IF NOT EXISTS cancel_requested boolean NOT NULL DEFAULT false;
+        ALTER TABLE postgis_baselayers.layer ADD COLUMN IF NOT EXISTS derived_from varchar(512) REFERENCES postgis_baselayers.layer(key) ON DELETE CASCADE;
+        CREATE TABLE IF NOT EXISTS postgis_baselayers.plan (
+          node varchar(512) PRIMARY KEY,    -- layer key, or 'fetch:<dataset>'
+          target varchar(128) NOT NULL,     -- eg: 'install', 'uninstall' or 'fetch'
+          depends_on varchar(512)[] NOT NULL DEFAULT '{}',
+          downloads text[] NOT NULL DEFAULT '{}',
+          queued boolean NOT NULL DEFAULT false,
+          created TIMESTAMP DEFAULT NOW()
+        );
+        ALTER TABLE postgis_baselayers.plan ADD COLUMN IF NOT EXISTS queued_at TIMESTAMP;
+        CREATE TABLE IF NOT EXISTS postgis_baselayers.stage_timing (
+          id SERIAL PRIMARY KEY,
+          task_id varchar(128) NOT NULL,
+          layer_key varchar(512) NOT NULL,
+          target varchar(128) NOT NULL,
+          phase varchar(32) NOT NULL,       -- 'queue', 'task' or 'make'
+          stage varchar(64) NOT NULL,       -- eg. 'make', or 'downloading' for 'make'
+          info varchar(512),                -- the full STATUS= line of 'make' stages
+          started TIMESTAMP NOT NULL,
+          duration float                    -- NULL while the stage is running
+        );
+        CREATE INDEX IF NOT EXISTS stage_timing_task_id_idx ON postgis_baselayers.stage_timing (task_id);
+        CREATE INDEX IF NOT EXISTS stage_timing_running_idx ON postgis_baselayers.stage_timing (layer_key) WHERE duration IS NULL;
+        CREATE TABLE IF NOT EXISTS postgis_baselayers.queue_task (
+          id BIGSERIAL PRIMARY KEY,
+          queue varchar(128) NOT NULL,      -- name of the huey instance
+          data bytea NOT NULL,              -- the serialized task
+          priority float NOT NULL DEFAULT 0,
+          state varchar(16) NOT NULL DEFAULT 'queued', -- 'queued', 'scheduled' or 'running'
+          run_after TIMESTAMP,              -- in UTC, for 'scheduled' tasks
+          enqueued TIMESTAMP DEFAULT NOW(),
+          attempts int NOT NULL DEFAULT 0,
+          claimed_by varchar(256),          -- worker running the task
+          lease_expires TIMESTAMPTZ
+        );
+        CREATE INDEX IF NOT EXISTS queue_task_ready_idx ON postgis_baselayers.queue_task (queue, priority DESC, id) WHERE state = 'queued';
+        CREATE INDEX IF NOT EXISTS queue_task_scheduled_idx ON postgis_baselayers.queue_task (queue, run_after) WHERE state = 'scheduled';
+        CREATE INDEX IF NOT EXISTS queue_task_running_idx ON postgis_baselayers.queue_task (queue, lease_expires) WHERE state = 'running';
+        CREATE TABLE IF NOT EXISTS postgis_baselayers.queue_data (
+          queue varchar(128) NOT NULL,
+          key text NOT NULL,
+          value bytea NOT NULL,
+          PRIMARY KEY (queue, key)
+        );
+        CREATE TABLE IF NOT EXISTS postgis_baselayers.layer_report (
+          id SERIAL PRIMARY KEY,
+          layer_key varchar(512) REFERENCES postgis_baselayers.layer(key),
+          task_id varchar(128) NOT NULL,
+          version int NOT NULL,             -- version of the layer the report is of
+          created TIMESTAMP DEFAULT NOW(),
+          report json NOT NULL              -- see report.py
+        );
+        CREATE INDEX IF NOT EXISTS layer_report_layer_key_idx ON postgis_baselayers.layer_report (layer_key, created);
+        CREATE TABLE IF NOT EXISTS postgis_baselayers.checkpoint (
+          layer_key varchar(512) REFERENCES postgis_baselayers.layer(key),
+          stage varchar(32) NOT NULL,       -- see INSTALL_STAGES
+          task_id varchar(128) NOT NULL,
+          completed TIMESTAMP DEFAULT NOW(),
+          PRIMARY KEY (layer_key, stage)
+        );
+        CREATE OR REPLACE FUNCTION postgis_baselayers.notify_layer_status() RETURNS trigger AS $$
+        BEGIN
+          PERFORM pg_notify(%s, json_build_object('key', NEW.key, 'status', NEW.status, 'info', NEW.info)::text);
+          RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS layer_status_notify ON postgis_baselayers.layer;
+        CREATE TRIGGER layer_status_notify 
+          AFTER UPDATE OF status, info ON postgis_baselayers.layer
+          FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status OR OLD.info IS DISTINCT FROM NEW.info)
+          EXECUTE PROCEDURE postgis_baselayers.notify_layer_status();
+        COMMENT ON SCHEMA postgis_baselayers IS %s;
+    """, (CHANNEL, SCHEMA_VERSION))
+
+def upgrade_schema(conn):
+    """
+    Bring the application schema up to date if it was created by an older 
+    version, which would otherwise fail on the tables and columns it lacks.
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT obj_description('postgis_baselayers'::regnamespace, 'pg_namespace');")
+    if cur.fetchone()[0] == SCHEMA_VERSION:
+        return
+    # One process at a time, the others wait and find it up to date.
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext('postgis_baselayers.schema'));")
+    cur.execute("SELECT obj_description('postgis_baselayers'::regnamespace, 'pg_namespace');")
+    if cur.fetchone()[0] != SCHEMA_VERSION:
+        logger.info(f"Upgrading the postgis_baselayers schema to version {SCHEMA_VERSION}")
+        create_schema(cur)
+        catalog.sync(cur)
+    conn.commit()
+
+def check_db_state(conn):
+    """
+    Verify that PostGIS is installed and the application schema exists, bring
+    the schema up to date, and return the PostGIS version. Raises PostgisMissingException or 
+    ApplicationNotInitialized otherwise.
+    """
+    ttl = int(app.config.get('PG_BASELAYERS_STATE_CACHE_TTL'))
+    with _db_state_lock:
+        if _db_state['postgis_version'] and time.time() - _db_state['checked'] < ttl:
+            return _db_state['postgis_version']
+
+    # Verify PostGIS is installed
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT PostGIS_Lib_Version();")
+        postgis_version = cur.fetchone()[0]
+    except psycopg2.errors.UndefinedFunction as e:
+        raise PostgisMissingException("{}\n------------\nIt looks like PostGIS is not installed in this database?\n\nYou can install it manually by running this SQL command on the database: \n\nCREATE EXTENSION postgis;\n\nOr postgis-baselayers can try to do it automatically if you click the button below...\n".format(e))
+
+    # Verify that our own schema exists, otherwise raise ApplicationNotInitialized,
+    # which will show the initialization screen.
+    cur.execute("SELECT EXISTS(SELECT 1 FROM pg_namespace WHERE nspname = 'postgis_baselayers');")
+    res = cur.fetchone()[0]
+    if not res:
+        raise ApplicationNotInitialized("PostGIS Baselayers is not initialized yet on this database.")
+    upgrade_schema(conn)
+
+    with _db_state_lock:
+        _db_state.update(checked=time.time(), postgis_version=postgis_version)
+    return postgis_version
+
 @app.before_request
 def connect_db():
+    if request.endpoint in NO_DB_ENDPOINTS:
+        return None
+
     # Create the database connection on g.conn
     if not hasattr(g, 'conn'):
         g.conn = get_db()
 
     # Don't do these checks when our endpoint is 'try_install_postgis'...
     if request.endpoint != 'try_install_postgis':
+        g.postgis_version = check_db_state(g.conn)
 
-        # Verify PostGIS is installed
-        cur = g.conn.cursor()
-        try:
-            cur.execute("SELECT PostGIS_Lib_Version();")
-            g.postgis_version = cur.fetchone()[0]
-        except psycopg2.errors.UndefinedFunction as e:
-            raise PostgisMissingException("{}\n------------\nIt looks like PostGIS is not installed in this database?\n\nYou can install it manually by running this SQL command on the database: \n\nCREATE EXTENSION postgis;\n\nOr postgis-baselayers can try to do it automatically if you click the button below...\n".format(e))
-
-        # Verify that our own schema exists, otherwise raise ApplicationNotInitialized,
-        # which will show the initialization screen.
-        cur.execute("SELECT EXISTS(SELECT 1 FROM pg_namespace WHERE nspname = 'postgis_baselayers');")
-        res = cur.fetchone()[0]
-        if not res:
-            raise ApplicationNotInitialized("PostGIS Baselayers is not initialized yet on this database.")
-
-# When the app context is destroyed, close the database connection.
+# When the app context is destroyed, return the connection to the pool.
 @app.teardown_appcontext
 def close_db(error):
     if hasattr(g, 'conn'):
-        g.conn.close()
+        release_db(g.conn)
 
 # Context processor to inject some common data into templates
 @app.context_processor
 def template_variables():
     return dict(pg_baselayers_version=__version__)
 
+@app.template_filter('duration')
+def format_duration(seconds):
+    seconds = int(seconds or 0)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+
 # Handle any errors using an error page
 @app.errorhandler(DatabaseException)
 @app.errorhandler(PostgisMissingException)
 @app.errorhandler(ConfigError)
 @app.errorhandler(ApplicationError)
+@app.errorhandler(PoolExhausted)
 @app.errorhandler(psycopg2.OperationalError)
 @app.errorhandler(psycopg2.ProgrammingError)
 def handle_error(error):
-    print(type(error))
     error_type = type(error).__name__
     return render_template("error.html", **locals())
 
@@ -167,54 +477,13 @@ def initialize(error=""):
 
     if request.method == 'POST' and request.form.get("initialize") == 'yes':
         cur = g.conn.cursor()
-        #TODO: put this in a separate 'create_schema.sql' file and run that
-        cur.execute("""
-            CREATE SCHEMA IF NOT EXISTS postgis_baselayers;
-            CREATE TABLE IF NOT EXISTS postgis_baselayers.dataset (
-              name varchar(256) PRIMARY KEY,    -- eg. 'example'
-              metadata json NOT NULL            -- flexible column for later use
-            );
-            CREATE TABLE IF NOT EXISTS postgis_baselayers.layer (
-              key varchar(512) PRIMARY KEY,     -- eg. 'example.airports'
-              name varchar(256) NOT NULL,       -- eg. 'airports'
-              dataset_name varchar(256) REFERENCES postgis_baselayers.dataset(name),
-              status int DEFAULT 0 NOT NULL,    -- 0: not installed; 1: installed; 2: queued; 3: working 4: error
-              info varchar(512) DEFAULT '',     -- additional status info 
-              metadata json NOT NULL            -- flexible column for later use
-            );
-            CREATE TABLE IF NOT EXISTS postgis_baselayers.log (
-              id SERIAL PRIMARY KEY,
-              created TIMESTAMP DEFAULT NOW(), 
-              layer_key varchar(128) REFERENCES postgis_baselayers.layer(key),
-              task_id varchar(128) NOT NULL, 
-              target varchar(128) NOT NULL,     -- eg: 'install' or 'uninstall'
-              info varchar(512),                -- additional status info
-              log TEXT
-            );
-        """)
+        create_schema(cur)
         g.conn.commit()
 
-        # Parse and update all the datasets.
-        metadata_path = os.path.join(app.root_path, "datasets", "*", "metadata.json")
-        for metadata_file in glob(metadata_path):
-            with open(metadata_file) as f:
-                dataset = json.load(f)
-                cur.execute("""
-                    INSERT INTO postgis_baselayers.dataset (name, metadata) 
-                    VALUES (%s, %s) 
-                    ON CONFLICT ON CONSTRAINT dataset_pkey 
-                    DO UPDATE SET metadata = %s;
-                """, (dataset['name'], json.dumps(dataset['metadata']), json.dumps(dataset['metadata'])))
-
-                for layer in dataset['layers']:
-                    key = "{}.{}".format(dataset['name'], layer['name'])
-                    cur.execute("""
-                        INSERT INTO postgis_baselayers.layer (key, name, dataset_name, metadata)
-                        VALUES (%s, %s, %s, %s)
-                        ON CONFLICT ON CONSTRAINT layer_pkey 
-                        DO UPDATE SET metadata = %s;
-                    """, (key, layer['name'], dataset['name'], json.dumps(layer['metadata']), json.dumps(layer['metadata'])))
-                g.conn.commit()
+        # Update all the datasets.
+        catalog.sync(cur)
+        g.conn.commit()
+        invalidate_db_state()
         return redirect(url_for('index'))
     else:
         abort(404)
@@ -226,6 +495,12 @@ def reset():
 
 @app.route('/')
 def index():
+    # Where the page picks up the live status updates from /events. This is
+    # taken before the layers are, so that any change in between is sent
+    # again rather than missed.
+    feed = get_status_feed()
+    status_since = f"{feed.id}-{feed.seq}"
+
     # Fetch the metadata
     cur = g.conn.cursor(cursor_factory=RealDictCursor)
     cur.execute("""
@@ -248,14 +523,38 @@ def index():
     """)
     layers = cur.fetchall()
 
-    # Fetch processing/waiting info
-    cur = g.conn.cursor()
-    cur.execute("SELECT key FROM postgis_baselayers.layer WHERE status=3")
-    layers_working = [_[0] for _ in cur.fetchall()]
-    cur.execute("SELECT key FROM postgis_baselayers.layer WHERE status=2")
-    layers_waiting = [_[0] for _ in cur.fetchall()]
+    # Processing/waiting info
+    layers_working = [layer['key'] for layer in layers if layer['status'] == 3]
+    layers_waiting = [layer['key'] for layer in layers if layer['status'] == 2]
+
     return render_template("index.html", **locals())
 
+@app.route("/events")
+def events():
+    """
+    Server-Sent Events stream of the changes in layer status, see events.py.
+    The stream is closed after a while, upon which browsers reconnect with 
+    the id of the last event they received.
+    """
+    feed = get_status_feed()
+    (feed_id, _, seq) = (request.headers.get('Last-Event-ID') or request.args.get('since', '')).partition('-')
+    # Changes are absolute, so if we don't know where the client left off 
+    # (it may have talked to another process) just send everything we have.
+    since = int(seq) if feed_id == feed.id and seq.isdigit() else 0
+
+    def stream(since):
+        yield "retry: 3000\n\n"
+        until = time.time() + 300
+        while time.time() < until:
+            changes = feed.wait(since, timeout=15)
+            if not changes:
+                yield ": keepalive\n\n"
+            for (since, change) in changes:
+                yield f"id: {feed.id}-{since}\ndata: {json.dumps(change)}\n\n"
+
+    return Response(stream(since), mimetype='text/event-stream', 
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route("/try-postgis-install", methods=["POST"])
 def try_install_postgis():
     """
@@ -264,55 +563,213 @@ def try_install_postgis():
     cur = g.conn.cursor()
     cur.execute("CREATE EXTENSION postgis;")
     g.conn.commit()
+    invalidate_db_state()
     return redirect(url_for('index'))
 
+def load_layer_definitions():
+    """
+    Returns a dict with the layer entries from all the metadata.json files, 
+    keyed by layer key.
+    """
+    return catalog.layers()
+
+# Priorities of the tasks in the queue, the highest are run first. Downloads
+# come first because other tasks wait for them, and uninstalls free up space.
+TASK_PRIORITIES = {'fetch': 10, 'uninstall': 5}
+
+def release_ready_nodes(conn):
+    """
+    Queue all planned tasks of which the dependencies have completed.
+    """
+    cur = conn.cursor()
+    cur.execute("""
+        WITH ready AS (
+            SELECT node FROM postgis_baselayers.plan p
+            WHERE NOT queued AND NOT EXISTS (
+                SELECT 1 FROM postgis_baselayers.plan d WHERE d.node = ANY(p.depends_on)
+            )
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE postgis_baselayers.plan SET queued=true, queued_at=NOW()
+        FROM ready WHERE plan.node = ready.node
+        RETURNING plan.node, plan.target, plan.downloads;
+    """)
+    ready = cur.fetchall()
+    conn.commit()
+    for (node, target, downloads) in ready:
+        logger.info(f"Queueing planned task {target} on {node}.")
+        if target == 'fetch':
+            fetch_task(node[len(FETCH_PREFIX):], downloads)
+        else:
+            run_task(node, target, priority=TASK_PRIORITIES.get(target, 0))
+
+def advance_plan(conn, node, success):
+    """
+    Remove a finished node from the plan and queue whatever can run next. 
+    When the node failed, all the nodes that depend on it (directly or 
+    indirectly) are removed as well and their layers marked as failed.
+    """
+    cur = conn.cursor()
+    failed = [] if success else [node]
+    cur.execute("DELETE FROM postgis_baselayers.plan WHERE node=%s;", (node,))
+    while failed:
+        failed_node = failed.pop()
+        cur.execute("""
+            DELETE FROM postgis_baselayers.plan 
+            WHERE %s = ANY(depends_on) 
+            RETURNING node;
+        """, (failed_node,))
+        for (dependent,) in cur.fetchall():
+            cur.execute("""
+                UPDATE postgis_baselayers.layer SET status=4, info=%s WHERE key=%s;
+            """, (f"Dependency {failed_node} failed", dependent))
+            failed.append(dependent)
+    conn.commit()
+    release_ready_nodes(conn)
+
 @app.route("/install", methods=['POST'])
 def install():
     """
-    TODO: Validate input before passing to queue, and return/flash error 
-          otherwise.
+    Plan the requested tasks, including any dependencies, and show the
+    schedule. Once confirmed, the plan is stored and the tasks without 
+    dependencies are queued.
     """
     cur = g.conn.cursor()
     # Valid targets are:
-    valid_targets = ('install', 'uninstall')
+    valid_targets = ('install', 'uninstall', 'update', 'export', 'restore')
+    layers = load_layer_definitions()
 
     # Make a list of valid keys
-    cur.execute("SELECT key FROM postgis_baselayers.layer")
-    valid_keys = [_[0] for _ in cur.fetchall()]
+    cur.execute("SELECT key, status FROM postgis_baselayers.layer")
+    layer_status = dict(cur.fetchall())
 
+    selected = {}
     for key, target in request.form.items():
+        if key == 'confirm':
+            continue
 
         if target not in valid_targets:
             raise ApplicationError(f"Request contains invalid target: '{target}'")
 
-        if key not in valid_keys:
+        if key not in layer_status:
             raise ApplicationError(f"Request contains invalid key: '{key}'")
 
-        try:
-            task = run_task(key, target)
-            cur.execute("UPDATE postgis_baselayers.layer SET status=2 WHERE key=%s;", (key, ))
-            g.conn.commit()
-        except:
-            g.conn.rollback()
-            raise ApplicationError("Unexpected error while creating task.")
+        if key not in layers:
+            raise ApplicationError(f"Layer '{key}' is derived from another layer, install that one instead.")
 
+        if target == 'update' and not (layers[key].get('updates') and layer_status[key] == 1):
+            raise ApplicationError(f"Layer '{key}' can't be updated.")
+
+        if target in ('export', 'restore') and not layers[key].get('tables'):
+            raise ApplicationError(f"Layer '{key}' doesn't declare its tables, so it has no snapshots.")
+
+        if target == 'export' and layer_status[key] != 1:
+            raise ApplicationError(f"Layer '{key}' isn't installed.")
+
+        if target == 'restore' and not list_snapshots(snapshot_dir, key):
+            raise ApplicationError(f"Layer '{key}' has no snapshots.")
+
+        selected[key] = target
+
+    if not selected:
+        return redirect(url_for('index'))
+
+    # Use the average duration of the last few successful runs as estimate
+    cur.execute("""
+        SELECT layer_key, avg(duration) FROM (
+            SELECT layer_key, duration, row_number() OVER (PARTITION BY layer_key ORDER BY created DESC) AS n
+            FROM postgis_baselayers.log
+            WHERE target='install' AND status=1 AND duration IS NOT NULL
+        ) recent 
+        WHERE n <= 3
+        GROUP BY layer_key;
+    """)
+    durations = dict(cur.fetchall())
+    installed = {key for key, status in layer_status.items() if status == 1}
+    try:
+        plan = build_plan(layers, selected, installed, durations)
+    except PlanError as e:
+        raise ApplicationError(f"Could not plan the requested tasks: {e}")
+
+    if request.form.get('confirm') != 'yes':
+        return render_template("schedule.html", **locals())
+
+    try:
+        for node in plan['nodes']:
+            cur.execute("""
+                INSERT INTO postgis_baselayers.plan (node, target, depends_on, downloads)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT ON CONSTRAINT plan_pkey DO NOTHING;
+            """, (node['key'], node['target'], node['depends_on'], node['downloads']))
+            if node['target'] != 'fetch':
+                cur.execute("UPDATE postgis_baselayers.layer SET status=2 WHERE key=%s;", (node['key'], ))
+        g.conn.commit()
+        release_ready_nodes(g.conn)
+    except:
+        g.conn.rollback()
+        raise ApplicationError("Unexpected error while creating task.")
+
+    return redirect(url_for('index'))
+
+# Number of tasks per page in /logs/, and number of chunks of a task log 
+# (see tasklog.py) shown at a time in /logs/<task_id>/.
+LOGS_PER_PAGE = 50
+LOG_CHUNKS_PER_PAGE = 16
+
+@app.route("/cancel", methods=['POST'])
+def cancel():
+    """
+    Cancel the task on a layer. A planned task that hasn't been queued yet is
+    removed from the plan straight away, along with the tasks depending on 
+    it. Otherwise the task is asked to stop, which it does before it starts
+    or within a few seconds when it's running.
+    """
+    key = request.form.get('cancel', '')
+    cur = g.conn.cursor()
+    cur.execute("SELECT status FROM postgis_baselayers.layer WHERE key=%s FOR UPDATE;", (key,))
+    row = cur.fetchone()
+    if row is None:
+        raise ApplicationError(f"Request contains invalid key: '{key}'")
+    if row[0] not in (2, 3):
+        raise ApplicationError(f"There is no task to cancel on layer '{key}'.")
+
+    cur.execute("""
+        SELECT EXISTS (SELECT 1 FROM postgis_baselayers.plan WHERE node=%s AND NOT queued);
+    """, (key,))
+    if cur.fetchone()[0]:
+        cur.execute("UPDATE postgis_baselayers.layer SET status=4, info='Cancelled' WHERE key=%s;", (key,))
+        g.conn.commit()
+        advance_plan(g.conn, key, False)
+    else:
+        cur.execute("UPDATE postgis_baselayers.layer SET cancel_requested=true, info='Cancelling' WHERE key=%s;", (key,))
+        g.conn.commit()
     return redirect(url_for('index'))
 
 @app.route("/logs/")
 @app.route("/logs/<task_id>/")
 def logs(task_id=None):
+    """
+    List the task logs a page at a time, or show the log of a task. By 
+    default the end of the log is shown, 'start' shows the chunks from 
+    there on instead.
+    """
     cur = g.conn.cursor(cursor_factory=RealDictCursor)
     logs = None
     if not task_id:
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = LOGS_PER_PAGE
         cur.execute("""
             SELECT 
                 created, info, task_id
             FROM 
                 postgis_baselayers.log
             ORDER BY 
-                created DESC;
-        """)
+                created DESC
+            LIMIT %s OFFSET %s;
+        """, (LOGS_PER_PAGE + 1, (page - 1) * LOGS_PER_PAGE))
         logs = cur.fetchall()
+        has_next = len(logs) > LOGS_PER_PAGE
+        logs = logs[:LOGS_PER_PAGE]
     else:
         cur.execute("""
             SELECT 
@@ -323,6 +780,40 @@ def logs(task_id=None):
                 task_id=%s;
         """, (task_id,))
         logs = cur.fetchall()
+
+        # The log of a task that is still running has no entry yet, but it
+        # may have stored part of its log already.
+        cur.execute("SELECT count(*) AS chunks FROM postgis_baselayers.log_chunk WHERE task_id=%s;", (task_id,))
+        chunks = cur.fetchone()['chunks']
+        start = request.args.get('start', type=int)
+        if start is None:
+            start = max(chunks - LOG_CHUNKS_PER_PAGE, 0)
+        start = min(max(start, 0), chunks)
+        cur.execute("""
+            SELECT 
+                string_agg(content, '' ORDER BY seq) AS content
+            FROM 
+                postgis_baselayers.log_chunk
+            WHERE 
+                task_id=%s AND seq >= %s AND seq < %s;
+        """, (task_id, start, start + LOG_CHUNKS_PER_PAGE))
+        content = cur.fetchone()['content']
+        end = min(start + LOG_CHUNKS_PER_PAGE, chunks)
+        per_page = LOG_CHUNKS_PER_PAGE
+
+        cur.execute("""
+            SELECT 
+                phase, stage, info, started,
+                COALESCE(duration, EXTRACT(epoch FROM NOW() - started)) AS duration,
+                duration IS NULL AS running
+            FROM 
+                postgis_baselayers.stage_timing
+            WHERE 
+                task_id=%s
+            ORDER BY 
+                started, id;
+        """, (task_id,))
+        timings = cur.fetchall()
     return render_template("logs.html", **locals())
 
 
@@ -343,9 +834,185 @@ def settings():
 
     cur.execute("SELECT PostGIS_Full_Version() AS postgis_version, version() as postgresql_version;")
     version_info = cur.fetchone()
+
+    pool_stats = get_pool().stats()
+    tile_stats = tile_cache.stats()
+    catalog.refresh()
+    catalog_error = catalog.error
     return render_template("settings.html", **locals())
 
 
+@app.route("/metrics")
+def metrics():
+    """
+    Metrics in the Prometheus text format: the time taken by the stages of
+    tasks, the state of the layers and the queue, and the time taken to
+    handle requests by this web process.
+    """
+    cur = g.conn.cursor()
+    lines = []
+
+    cur.execute("""
+        SELECT phase, target, stage, sum(duration), count(*)
+        FROM postgis_baselayers.stage_timing
+        WHERE duration IS NOT NULL
+        GROUP BY phase, target, stage ORDER BY phase, target, stage;
+    """)
+    samples = []
+    for (phase, target, stage, total, count) in cur.fetchall():
+        labels = {'phase': phase, 'target': target, 'stage': stage}
+        samples += [('_sum', labels, total), ('_count', labels, count)]
+    lines += metric('pg_baselayers_stage_duration_seconds', 'summary',
+                    "Time taken by the stages of tasks.", samples)
+
+    cur.execute("""
+        SELECT DISTINCT ON (layer_key, phase, stage) layer_key, phase, stage, duration
+        FROM postgis_baselayers.stage_timing
+        WHERE duration IS NOT NULL AND target = 'install'
+        ORDER BY layer_key, phase, stage, started DESC;
+    """)
+    lines += metric('pg_baselayers_last_install_stage_duration_seconds', 'gauge',
+                    "Time taken by the stages of the last install of each layer.",
+                    [({'layer': key, 'phase': phase, 'stage': stage}, duration)
+                     for (key, phase, stage, duration) in cur.fetchall()])
+
+    cur.execute("""
+        SELECT timing.layer_key, timing.phase, timing.stage, EXTRACT(epoch FROM NOW() - timing.started)
+        FROM postgis_baselayers.stage_timing timing
+        JOIN postgis_baselayers.layer ON layer.key = timing.layer_key
+        WHERE timing.duration IS NULL AND layer.status = 3
+        ORDER BY timing.layer_key, timing.phase;
+    """)
+    lines += metric('pg_baselayers_running_stage_seconds', 'gauge',
+                    "Time spent so far in the stages that are running.",
+                    [({'layer': key, 'phase': phase, 'stage': stage}, age)
+                     for (key, phase, stage, age) in cur.fetchall()])
+
+    cur.execute("""
+        SELECT status.code, count(layer.key)
+        FROM (VALUES (0), (1), (2), (3), (4)) AS status(code)
+        LEFT JOIN postgis_baselayers.layer ON layer.status = status.code
+        GROUP BY status.code ORDER BY status.code;
+    """)
+    names = {0: 'not_installed', 1: 'installed', 2: 'queued', 3: 'working', 4: 'error'}
+    lines += metric('pg_baselayers_layers', 'gauge', "Number of layers by status.",
+                    [({'status': names[code]}, count) for (code, count) in cur.fetchall()])
+
+    lines += metric('pg_baselayers_queue_pending_tasks', 'gauge',
+                    "Tasks waiting in the queue for a worker.", [({}, huey.pending_count())])
+    lines += metric('pg_baselayers_queue_scheduled_tasks', 'gauge',
+                    "Tasks scheduled to run later, such as retries.", [({}, huey.scheduled_count())])
+    if isinstance(huey.storage, PostgresStorage):
+        cur.execute("""
+            SELECT claimed_by, count(*), count(*) FILTER (WHERE lease_expires < NOW())
+            FROM postgis_baselayers.queue_task
+            WHERE queue=%s AND state='running'
+            GROUP BY claimed_by ORDER BY claimed_by;
+        """, (huey.name,))
+        running = cur.fetchall()
+        lines += metric('pg_baselayers_queue_running_tasks', 'gauge', "Tasks claimed by each worker.",
+                        [({'worker': worker}, count) for (worker, count, _) in running])
+        lines += metric('pg_baselayers_queue_expired_leases', 'gauge',
+                        "Claimed tasks of which the worker stopped renewing the lease.",
+                        [({'worker': worker}, expired) for (worker, _, expired) in running])
+
+    cur.execute("""
+        SELECT 
+            count(*) FILTER (WHERE NOT queued),
+            count(*) FILTER (WHERE queued),
+            COALESCE(EXTRACT(epoch FROM NOW() - min(queued_at) FILTER (WHERE queued)), 0)
+        FROM postgis_baselayers.plan;
+    """)
+    (waiting, queued, oldest) = cur.fetchone()
+    lines += metric('pg_baselayers_plan_nodes', 'gauge', "Planned tasks, by whether they were queued yet.",
+                    [({'state': 'waiting'}, waiting), ({'state': 'queued'}, queued)])
+    lines += metric('pg_baselayers_plan_oldest_queued_seconds', 'gauge',
+                    "Time the longest queued task of the plan has been waiting.", [({}, oldest)])
+
+    cur.execute("""
+        SELECT target, status = 4 AS failed, count(*)
+        FROM postgis_baselayers.log
+        WHERE status IS NOT NULL
+        GROUP BY 1, 2 ORDER BY 1, 2;
+    """)
+    lines += metric('pg_baselayers_tasks_total', 'counter', "Completed and failed tasks, by target.",
+                    [({'target': target, 'result': 'failed' if failed else 'completed'}, count)
+                     for (target, failed, count) in cur.fetchall()])
+
+    tile_stats = tile_cache.stats()
+    lines += metric('pg_baselayers_tile_requests_total', 'counter', "Tile requests by how they were served.",
+                    [({'result': result}, tile_stats[result]) for result in ('memory', 'disk', 'built', 'not_modified')])
+
+    lines += request_duration.render()
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+# Tables with a geometry column of the layers tiles were served of, for the
+# generation of the layer they were looked up for.
+_tile_sources = {}
+
+@app.route("/tiles/<layer_key>/<int:z>/<int:x>/<int:y>.mvt")
+def tile(layer_key, z, x, y):
+    """
+    Mapbox vector tile of a layer, see tiles.py.
+    """
+    if not valid_tile(z, x, y):
+        abort(404)
+    cur = g.conn.cursor()
+    cur.execute("""
+        SELECT status, version, installed, metadata->>'last_update', metadata->'tables'
+        FROM postgis_baselayers.layer WHERE key=%s;
+    """, (layer_key,))
+    row = cur.fetchone()
+    if row is None or row[0] == 0:
+        abort(404)
+    (status, version, installed, last_update, derived_tables) = row
+    tile_generation = generation(version, installed, last_update)
+    etag = f"{tile_generation}-{z}-{x}-{y}"
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+    if request.if_none_match.contains(etag):
+        tile_cache.count('not_modified')
+        return Response(status=304, headers=headers)
+
+    data = tile_cache.get(layer_key, tile_generation, z, x, y)
+    if data is None:
+        try:
+            cur.execute("SET LOCAL statement_timeout = %s;", (app.config.get('PG_BASELAYERS_TILE_TIMEOUT'),))
+            (cached_generation, sources) = _tile_sources.get(layer_key, (None, None))
+            if cached_generation != tile_generation:
+                tables = load_layer_definitions().get(layer_key, {}).get('tables') or derived_tables or []
+                sources = table_sources(cur, tables)
+                _tile_sources[layer_key] = (tile_generation, sources)
+            if not sources:
+                abort(404)
+            data = build_tile(cur, sources, z, x, y)
+        except psycopg2.errors.UndefinedTable:
+            # The layer is being installed in place.
+            abort(404)
+        except psycopg2.errors.QueryCanceled:
+            logger.warning(f"Tile {layer_key}/{z}/{x}/{y} took longer than the tile timeout")
+            abort(503)
+        except psycopg2.Error as e:
+            logger.error(f"Could not build tile {layer_key}/{z}/{x}/{y}: {e}")
+            abort(500)
+        finally:
+            g.conn.rollback()
+        tile_cache.put(layer_key, tile_generation, z, x, y, data)
+    return Response(data, mimetype='application/vnd.mapbox-vector-tile', headers=headers)
+
+def invalidate_tiles(key, definition):
+    """
+    Remove the cached tiles of a layer and the layers derived from it.
+    """
+    (dataset, layer) = key.split(".")
+    tile_cache.invalidate(key)
+    for level in (definition.get('simplified') or {}).get('tolerances', {}):
+        tile_cache.invalidate(f"{dataset}.{layer}_{level}")
+
+
+# Number of query performance reports of each layer shown on its dataset
+# page, to compare the latest one with those of previous installs.
+REPORTS_SHOWN = 5
+
 @app.route("/dataset/<dataset_name>/")
 def dataset(dataset_name):
     """
@@ -359,6 +1026,10 @@ def dataset(dataset_name):
             layer.name as layer,
             layer.info as info,
             layer.status,
+            layer.version,
+            layer.installed,
+            layer.rollback_schema,
+            layer.rollback_version,
             layer.metadata as layer_metadata,
             dataset.metadata as dataset_metadata
         FROM 
@@ -369,52 +1040,674 @@ def dataset(dataset_name):
             layer.dataset_name=dataset.name
         WHERE 
             layer.dataset_name=%s 
+        ORDER BY
+            layer.key;
     """, (dataset_name,))
     layers = cur.fetchall()
 
-    base_dir = os.path.join(app.root_path, "datasets", dataset_name)
+    dataset = catalog.get(dataset_name)
+    if dataset is None:
+        abort(404)
+    readme = Markup(dataset['readme'])
+    updatable = {"{}.{}".format(dataset['name'], layer['name']) for layer in dataset['layers'] if layer.get('updates')}
+    exportable = {"{}.{}".format(dataset['name'], layer['name']) for layer in dataset['layers'] if layer.get('tables')}
+
+    # The last stage completed by installs that didn't finish.
+    cur.execute("""
+        SELECT DISTINCT ON (layer_key) layer_key, stage 
+        FROM postgis_baselayers.checkpoint 
+        WHERE layer_key IN (SELECT key FROM postgis_baselayers.layer WHERE dataset_name=%s)
+        ORDER BY layer_key, array_position(%s, stage::text) DESC;
+    """, (dataset_name, INSTALL_STAGES))
+    checkpoints = {row['layer_key']: row['stage'] for row in cur.fetchall()}
 
-    with open(os.path.join(base_dir, "README.md")) as f:
-        readme = Markup(markdown.markdown(f.read()))
+    snapshots = {layer['key']: list_snapshots(snapshot_dir, layer['key']) for layer in layers}
 
-    with open(os.path.join(base_dir, "metadata.json")) as f:
-        dataset = json.load(f)
+    # The last few query performance reports, the latest first.
+    cur.execute("""
+        SELECT layer_key, version, created, report FROM (
+            SELECT *, row_number() OVER (PARTITION BY layer_key ORDER BY created DESC) AS n
+            FROM postgis_baselayers.layer_report
+            WHERE layer_key IN (SELECT key FROM postgis_baselayers.layer WHERE dataset_name=%s)
+        ) recent
+        WHERE n <= %s
+        ORDER BY layer_key, created DESC;
+    """, (dataset_name, REPORTS_SHOWN))
+    reports = {}
+    for row in cur.fetchall():
+        report = row['report']
+        row.update(size=sum(t['table_size'] + t['index_size'] for t in report['tables']),
+                   rows=sum(t['rows'] for t in report['tables']),
+                   timings={f"{q['name']} {q['table'].rpartition('.')[2]}": q.get('median_ms') for q in report['queries']})
+        reports.setdefault(row['layer_key'], []).append(row)
 
     return render_template("dataset.html", **locals())
 
+def get_idle_layer(cur, key):
+    """
+    Returns the layer row locked for update, provided no task is queued or
+    running on it.
+    """
+    cur.execute("""
+        SELECT dataset_name, status, version, rollback_schema, rollback_version 
+        FROM postgis_baselayers.layer WHERE key=%s FOR UPDATE;
+    """, (key,))
+    layer = cur.fetchone()
+    if layer is None:
+        raise ApplicationError(f"Request contains invalid key: '{key}'")
+    if layer['status'] in (2, 3):
+        raise ApplicationError(f"Layer '{key}' has a task queued or running.")
+    if not layer['rollback_schema']:
+        raise ApplicationError(f"Layer '{key}' has no previous version.")
+    return layer
+
+@app.route("/dataset/<dataset_name>/rollback", methods=["POST"])
+def rollback(dataset_name):
+    """
+    Swap the previous version of a layer back in. The version it replaces 
+    is kept in its place, so a rollback can be undone in the same way.
+    """
+    key = request.form.get('key', '')
+    cur = g.conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        layer = get_idle_layer(cur, key)
+        swap_tables(cur, layer['dataset_name'], layer['rollback_schema'], 
+                    layer_tables(load_layer_definitions().get(key, {})))
+        cur.execute("""
+            UPDATE postgis_baselayers.layer 
+            SET version=rollback_version, rollback_version=version, installed=NOW() 
+            WHERE key=%s;
+            UPDATE postgis_baselayers.layer derived SET version=layer.version, installed=layer.installed
+            FROM postgis_baselayers.layer WHERE layer.key=%s AND derived.derived_from=layer.key;
+        """, (key, key))
+        g.conn.commit()
+    except psycopg2.Error as e:
+        g.conn.rollback()
+        raise ApplicationError(f"Rollback of '{key}' failed: {e}")
+    invalidate_tiles(key, load_layer_definitions().get(key, {}))
+    return redirect(url_for('dataset', dataset_name=dataset_name))
+
+@app.route("/dataset/<dataset_name>/confirm", methods=["POST"])
+def confirm(dataset_name):
+    """
+    Confirm the current version of a layer, dropping the previous version.
+    """
+    key = request.form.get('key', '')
+    cur = g.conn.cursor(cursor_factory=RealDictCursor)
+    get_idle_layer(cur, key)
+    drop_rollback(cur, key)
+    g.conn.commit()
+    return redirect(url_for('dataset', dataset_name=dataset_name))
 
-@huey.task(context=True)
-def run_task(key, target, task=None):
+
+def set_layer_info(key, info):
+    """
+    Update the status info of a layer using a connection of its own. This 
+    is only informational, so the commit doesn't wait for the disk.
+    """
+    conn = get_db()
+    try:
+        cur = conn.cursor()
+        cur.execute("SET LOCAL synchronous_commit TO OFF;")
+        cur.execute("UPDATE postgis_baselayers.layer SET info=%s WHERE key=%s;", (info, key))
+        conn.commit()
+    finally:
+        release_db(conn)
+
+class StatusThrottle(object):
+    """
+    Coalesces the status info updates of a task into at most one write per
+    `interval` seconds. An update that comes in too soon is written by a 
+    timer once the interval has passed, unless a newer one replaces it in 
+    the meantime. flush() writes the pending update straight away.
+    """
+    def __init__(self, key, interval):
+        self.key = key
+        self.interval = interval
+        self.pending = None
+        self.written = 0
+        self.timer = None
+        self.lock = Lock()
+
+    def update(self, info):
+        with self.lock:
+            self.pending = info
+            delay = self.written + self.interval - time.time()
+            if delay <= 0:
+                self._write()
+            elif self.timer is None:
+                self.timer = Timer(delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self._write()
+
+    def _write(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.pending is None:
+            return
+        set_layer_info(self.key, self.pending)
+        self.written = time.time()
+        self.pending = None
+
+class StageTimer(object):
     """
-    Run a task
+    Records the stages of a task in postgis_baselayers.stage_timing. Stages
+    run in phases: 'task' for the stages of run_task itself and 'make' for
+    the ones the makefile reports with STATUS= lines, so that a make stage
+    runs within the 'make' stage of the task. A stage is recorded when it
+    starts, so that /metrics can tell how long the running ones have been
+    going, and completed with its duration when it ends. Errors are only
+    logged, timings aren't worth failing a task over.
+    """
+    def __init__(self, task_id, key, target):
+        self.task_id = task_id
+        self.key = key
+        self.target = target
+        self.current = {}
 
-    TODO: Validate key and target
+    def _execute(self, query, args):
+        try:
+            conn = get_db()
+        except PoolExhausted as e:
+            logger.warning(f"Could not record stage timing of task {self.task_id}: {e}")
+            return None
+        try:
+            cur = conn.cursor()
+            cur.execute("SET LOCAL synchronous_commit TO OFF;")
+            cur.execute(query, args)
+            row = cur.fetchone() if cur.description else None
+            conn.commit()
+            return row
+        except psycopg2.Error as e:
+            conn.rollback()
+            logger.warning(f"Could not record stage timing of task {self.task_id}: {e}")
+        finally:
+            release_db(conn)
+
+    def start(self, phase, stage, info=None):
+        """
+        Start a stage, which ends the stage that was running in its phase.
+        """
+        self.end(phase)
+        row = self._execute("""
+            INSERT INTO postgis_baselayers.stage_timing (task_id, layer_key, target, phase, stage, info, started)
+            VALUES (%s, %s, %s, %s, %s, %s, NOW()) RETURNING id;
+        """, (self.task_id, self.key, self.target, phase, stage[:64], info and info[:512]))
+        self.current[phase] = (row and row[0], stage, time.time())
+
+    def end(self, phase):
+        (row_id, _, started) = self.current.pop(phase, (None, None, None))
+        if row_id is not None:
+            self._execute("UPDATE postgis_baselayers.stage_timing SET duration=%s WHERE id=%s;",
+                          (time.time() - started, row_id))
+
+    @contextlib.contextmanager
+    def stage(self, phase, stage):
+        self.start(phase, stage)
+        try:
+            yield
+        finally:
+            self.end(phase)
+
+    def status(self, info):
+        """
+        Start a 'make' stage for a STATUS= line, unless it's more of the
+        same, like the progress of an import. The stage is named after the
+        first word of the line.
+        """
+        words = info.split()
+        stage = words[0].lower().strip(':.') if words else 'other'
+        if self.current.get('make', (None, None))[1] != stage:
+            self.start('make', stage, info.strip())
+
+    def close(self):
+        for phase in list(self.current):
+            self.end(phase)
+
+@contextlib.contextmanager
+def task_slots(key):
+    """
+    Context manager which waits for a slot on the layer, its dataset, and 
+    the global task limit, in that order. The layer info shows what the 
+    task is waiting for in the meantime.
+
+    The slots are advisory locks in the database, so that the limits hold
+    for the workers on all machines. They're held on a connection of their
+    own, outside the pool, which is closed (releasing all of them) when the
+    task is done or its worker dies.
     """
     (dataset, layer) = key.split(".")
-    status = None
-    message = ''
+    conn = connect_db_raw()
+    conn.autocommit = True
+    resources = [
+        DatabaseSlots(conn, f"layer-{key}", 1),
+        DatabaseSlots(conn, f"dataset-{dataset}", int(app.config.get('PG_BASELAYERS_MAX_TASKS_PER_DATASET'))),
+        DatabaseSlots(conn, "task", int(app.config.get('PG_BASELAYERS_MAX_TASKS')))
+    ]
+    def waiting(slots):
+        logger.info(f"Task on {key} is waiting for a free '{slots.name}' slot.")
+        set_layer_info(key, "Waiting for other tasks")
+
+    try:
+        with contextlib.ExitStack() as stack:
+            for slots in resources:
+                stack.enter_context(slots.acquire(on_wait=waiting))
+            yield
+    finally:
+        conn.close()
+
+def layer_tables(definition):
+    """
+    Returns the tables of a layer: the ones it declares, followed by the 
+    simplified tables generated from them.
+    """
+    derived = simplified_tables(definition.get('simplified'))
+    return definition.get('tables', []) + [d['table'] for d in derived]
 
-    # Lock the task based on the dataset name. That way no more than one 
-    # task can be run for any dataset (like installing and uninstalling it at 
-    # the same time, or running two installs simultaneously)
-    with huey.lock_task(key):
-        logger = logging.getLogger("task_logger")
-        logger.setLevel(logging.DEBUG)
-        logstream = StringIO()
-        streamhandler = logging.StreamHandler(logstream)
-        logger.addHandler(streamhandler)
-        timer = None
+def post_install(key, task_logger, schema=None):
+    """
+    Store the tables of a layer as declared in its metadata.json, build its
+    indexes and simplified tables, and analyze its tables, which are in 
+    `schema` instead of the dataset schema when given. See postinstall.py 
+    for details.
+    """
+    dataset = key.split(".")[0]
+    layer = load_layer_definitions().get(key, {})
+    indexes = layer.get('indexes', [])
+    storage = layer.get('storage', [])
+    derived = simplified_tables(layer.get('simplified'))
+    tables = layer.get('tables') or sorted({index['table'] for index in indexes})
+    tables = tables + [d['table'] for d in derived]
+    if app.config.get('PG_BASELAYERS_STORAGE_OPTIONS') != 'YES':
+        storage = []
+    if schema:
+        indexes = [relocate_index(index, dataset, schema) for index in indexes]
+        storage = [dict(s, table=relocate(s['table'], dataset, schema)) for s in storage]
+        derived = [dict(d, source=relocate(d['source'], dataset, schema), table=relocate(d['table'], dataset, schema))
+                   for d in derived]
+        tables = [relocate(table, dataset, schema) for table in tables]
+
+    try:
+        if storage:
+            set_layer_info(key, "Reorganizing tables")
+            task_logger.info(f"Reorganizing {len(storage)} tables...")
+            reorganize(get_bulk_db, release_bulk_db, storage,
+                       workers=int(app.config.get('PG_BASELAYERS_INDEX_WORKERS')),
+                       maintenance_work_mem=app.config.get('PG_BASELAYERS_MAINTENANCE_WORK_MEM'),
+                       log=task_logger.info)
+        if indexes:
+            set_layer_info(key, "Building indexes")
+            task_logger.info(f"Building {len(indexes)} indexes...")
+            build_indexes(get_bulk_db, release_bulk_db, indexes,
+                          workers=int(app.config.get('PG_BASELAYERS_INDEX_WORKERS')),
+                          maintenance_work_mem=app.config.get('PG_BASELAYERS_MAINTENANCE_WORK_MEM'),
+                          parallel_workers=int(app.config.get('PG_BASELAYERS_PARALLEL_MAINTENANCE_WORKERS')),
+                          log=task_logger.info)
+        if derived:
+            set_layer_info(key, "Simplifying")
+            task_logger.info(f"Building {len(derived)} simplified tables...")
+            build_simplified(get_bulk_db, release_bulk_db, derived,
+                             workers=int(app.config.get('PG_BASELAYERS_INDEX_WORKERS')),
+                             log=task_logger.info)
+        if tables:
+            set_layer_info(key, "Analyzing")
+            analyze(get_bulk_db, release_bulk_db, tables, log=task_logger.info)
+    except (psycopg2.Error, ValueError, PoolExhausted) as e:
+        raise InstallFailed(f"Post-install stage failed: {e}")
+
+def shadow_schema_name(dataset, layer):
+    """
+    Name of the schema a new version of a layer is installed in. It's the
+    same for every attempt, so that a retry can resume a failed install, 
+    and short enough for postinstall.swap_tables() to add a suffix.
+    """
+    return f"{dataset}_shadow_{layer}"[:55]
+
+def rollback_schema_name(dataset, layer):
+    return f"{dataset}_rollback_{layer}"[:55]
+
+def load_checkpoints(cur, key):
+    cur.execute("SELECT stage FROM postgis_baselayers.checkpoint WHERE layer_key=%s;", (key,))
+    return {row[0] for row in cur.fetchall()}
+
+def record_checkpoint(key, stage, task_id):
+    conn = get_db()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO postgis_baselayers.checkpoint (layer_key, stage, task_id) VALUES (%s, %s, %s)
+            ON CONFLICT (layer_key, stage) DO UPDATE SET task_id=EXCLUDED.task_id, completed=NOW();
+        """, (key, stage, task_id))
+        conn.commit()
+    finally:
+        release_db(conn)
+
+def discard_checkpoints(cur, key, stages=INSTALL_STAGES):
+    cur.execute("""
+        DELETE FROM postgis_baselayers.checkpoint WHERE layer_key=%s AND stage = ANY(%s);
+    """, (key, list(stages)))
+
+def prepare_work_dir(work_dir, checkpoints):
+    """
+    Reconcile the stamp files the makefiles leave in a work directory for 
+    each completed stage with the recorded checkpoints: a stage is only 
+    skipped when both are there. Returns the stages that are.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    completed = set()
+    for stage in ('downloaded', 'extracted'):
+        stamp = os.path.join(work_dir, stage)
+        if stage in checkpoints and os.path.exists(stamp):
+            completed.add(stage)
+        elif os.path.exists(stamp):
+            os.remove(stamp)
+    return completed
+
+def register_derived_layers(cur, key, definition):
+    """
+    Register a layer for each tolerance of the simplified tables of a layer,
+    named after the layer and the tolerance, and drop those of tolerances 
+    that are no longer declared.
+    """
+    (dataset, layer) = key.split(".")
+    simplified = definition.get('simplified') or {}
+    tolerances = simplified.get('tolerances', {})
+    description = definition.get('metadata', {}).get('description', key)
+    cur.execute("""
+        DELETE FROM postgis_baselayers.layer WHERE derived_from=%s AND NOT (name = ANY(%s));
+    """, (key, [f"{layer}_{level}" for level in tolerances]))
+    for (level, tolerance) in tolerances.items():
+        metadata = {
+            'description': f"{description} (simplified to {tolerance})",
+            'tables': [f"{table}_{level}" for table in simplified['tables']],
+            'tolerance': tolerance
+        }
+        cur.execute("""
+            INSERT INTO postgis_baselayers.layer (key, name, dataset_name, metadata, status, version, installed, derived_from)
+            SELECT %s, %s, dataset_name, %s, 1, version, installed, key FROM postgis_baselayers.layer WHERE key=%s
+            ON CONFLICT ON CONSTRAINT layer_pkey DO UPDATE 
+            SET metadata=EXCLUDED.metadata, status=1, version=EXCLUDED.version, installed=EXCLUDED.installed
+            WHERE layer.derived_from = EXCLUDED.derived_from;
+        """, (f"{dataset}.{layer}_{level}", f"{layer}_{level}", json.dumps(metadata), key))
+
+def drop_derived_layers(cur, key, definition):
+    """
+    Drop the simplified tables of a layer and the layers they were 
+    registered as.
+    """
+    for derived in simplified_tables(definition.get('simplified')):
+        cur.execute(sql.SQL("DROP TABLE IF EXISTS {};").format(sql.Identifier(*derived['table'].split('.'))))
+    cur.execute("DELETE FROM postgis_baselayers.layer WHERE derived_from=%s;", (key,))
+
+def drop_rollback(cur, key):
+    """
+    Drop the previous version of a layer that was kept for a rollback.
+    """
+    cur.execute("SELECT rollback_schema FROM postgis_baselayers.layer WHERE key=%s;", (key,))
+    row = cur.fetchone()
+    if row and row[0]:
+        cur.execute(sql.SQL("DROP SCHEMA IF EXISTS {} CASCADE;").format(sql.Identifier(row[0])))
+    cur.execute("""
+        UPDATE postgis_baselayers.layer SET rollback_schema=NULL, rollback_version=NULL WHERE key=%s;
+    """, (key,))
 
+def swap_layer(key, shadow, tables, task_logger):
+    """
+    Make the new version of a layer that was installed in the `shadow` 
+    schema live. The tables it replaces stay in the shadow schema, which is
+    kept for a rollback in place of the one before it.
+    """
+    dataset = key.split(".")[0]
+    set_layer_info(key, "Swapping in new version")
+    conn = get_db()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT version FROM postgis_baselayers.layer WHERE key=%s FOR UPDATE;", (key,))
+        (version,) = cur.fetchone()
+        drop_rollback(cur, key)
+        started = time.time()
+        replaced = swap_tables(cur, dataset, shadow, tables)
+        if replaced:
+            # The shadow schema name is reused by the next install.
+            rollback = rollback_schema_name(*key.split("."))
+            cur.execute(sql.SQL("ALTER SCHEMA {} RENAME TO {};").format(sql.Identifier(shadow), sql.Identifier(rollback)))
+            cur.execute("""
+                UPDATE postgis_baselayers.layer 
+                SET version=%s, installed=NOW(), rollback_schema=%s, rollback_version=%s 
+                WHERE key=%s;
+            """, (version + 1, rollback, version, key))
+        else:
+            cur.execute(sql.SQL("DROP SCHEMA {} CASCADE;").format(sql.Identifier(shadow)))
+            cur.execute("""
+                UPDATE postgis_baselayers.layer SET version=%s, installed=NOW() WHERE key=%s;
+            """, (version + 1, key))
+        conn.commit()
+        task_logger.info(f"Swapped in version {version + 1} of {key} in {time.time() - started:.1f}s, replacing {replaced} table(s).")
+    except psycopg2.Error as e:
+        conn.rollback()
+        raise InstallFailed(f"Swapping in the new version failed: {e}")
+    finally:
+        release_db(conn)
+
+def report_layer(key, definition, task_id, task_logger):
+    """
+    Make the query performance report of a layer that was installed, see 
+    report.py. The install is not failed over it if that doesn't work.
+    """
+    tables = layer_tables(definition) if definition.get('tables') else \
+             sorted({index['table'] for index in definition.get('indexes', [])})
+    if not tables:
+        task_logger.info("Skipping the report, the layer doesn't declare its tables.")
+        return
+    set_layer_info(key, "Measuring queries")
+    try:
+        report = build_report(get_bulk_db, release_bulk_db, definition, tables,
+                              count=int(app.config.get('PG_BASELAYERS_REPORT_QUERIES')),
+                              timeout=app.config.get('PG_BASELAYERS_REPORT_TIMEOUT'),
+                              log=task_logger.info)
+        for warning in report['warnings']:
+            task_logger.warning(f"Report: {warning}")
         conn = get_db()
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO postgis_baselayers.layer_report (layer_key, task_id, version, report)
+                SELECT key, %s, version, %s FROM postgis_baselayers.layer WHERE key=%s;
+            """, (task_id, json.dumps(report), key))
+            conn.commit()
+        finally:
+            release_db(conn)
+    except (psycopg2.Error, KeyError, PoolExhausted) as e:
+        task_logger.error(f"Could not make the report of {key}: {e}")
+
+def export_layer(key, tables, task_logger):
+    """
+    Dump the tables of an installed layer to a new snapshot, and remove the
+    oldest snapshots of the layer beyond the number that is kept.
+    """
+    set_layer_info(key, "Exporting snapshot")
+    conn = get_db()
+    try:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("SELECT version, installed, metadata FROM postgis_baselayers.layer WHERE key=%s;", (key,))
+        export_snapshot(cur, snapshot_dir, key, tables, cur.fetchone(), app.config.get('POSTGRES_URI'),
+                        jobs=int(app.config.get('PG_BASELAYERS_SNAPSHOT_JOBS')),
+                        timeout=int(app.config.get('PG_BASELAYERS_MAKE_TIMEOUT')),
+                        log=task_logger.info)
+        conn.rollback()
+    except SnapshotError as e:
+        raise InstallFailed(f"Exporting a snapshot failed: {e}")
+    finally:
+        release_db(conn)
+    remove_snapshots(snapshot_dir, key, keep=int(app.config.get('PG_BASELAYERS_SNAPSHOTS_KEPT')))
+
+def restore_layer(key, shadow, task_logger):
+    """
+    Restore the latest snapshot of a layer into the `shadow` schema, and 
+    return its snapshot.json.
+    """
+    snapshots = list_snapshots(snapshot_dir, key)
+    if not snapshots:
+        raise InstallFailed(f"There are no snapshots of {key}.")
+    set_layer_info(key, f"Restoring snapshot {snapshots[0]['name']}")
+    try:
+        return restore_snapshot(snapshots[0]['path'], shadow, app.config.get('POSTGRES_URI'),
+                                get_bulk_db, release_bulk_db,
+                                jobs=int(app.config.get('PG_BASELAYERS_SNAPSHOT_JOBS')),
+                                timeout=int(app.config.get('PG_BASELAYERS_MAKE_TIMEOUT')),
+                                log=task_logger.info)
+    except (SnapshotError, psycopg2.Error) as e:
+        raise InstallFailed(f"Restoring snapshot {snapshots[0]['name']} failed: {e}")
+
+def set_last_update(cur, key, date):
+    """
+    Record the date up to which the delta files of a layer that supports 
+    incremental updates have been applied, see deltas.py.
+    """
+    cur.execute("""
+        UPDATE postgis_baselayers.layer 
+        SET metadata = (metadata::jsonb || jsonb_build_object('last_update', %s::text))::json 
+        WHERE key=%s;
+    """, (date, key))
+
+def terminate_process_group(process, grace):
+    """
+    Terminate a process and everything it started (make runs ogr2ogr, psql
+    and the like in the same process group). Processes get `grace` seconds
+    to exit after a SIGTERM, after which whatever is left gets a SIGKILL.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    try:
+        process.wait(grace)
+    except subprocess.TimeoutExpired:
+        pass
+    # Children may outlive make, and keep its output open.
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def cancel_requested(key):
+    conn = get_db()
+    try:
         cur = conn.cursor()
-        
-        # TODO IMPORTANT!: Validate schema name as it's not escaped here.
-        cur.execute(f"CREATE SCHEMA IF NOT EXISTS {dataset};")
+        cur.execute("SELECT cancel_requested FROM postgis_baselayers.layer WHERE key=%s;", (key,))
+        row = cur.fetchone()
         conn.commit()
+        return bool(row and row[0])
+    finally:
+        release_db(conn)
+
+def log_redactions():
+    """
+    Secrets that are replaced in task logs, and what they're replaced with.
+    """
+    return {
+        app.config.get("POSTGRES_URI"): "postgresql://{POSTGRES_USER}:XXXXXX@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}".format(**app.config),
+        app.config.get("POSTGRES_OGR"): 'PG:"dbname={POSTGRES_DB} host={POSTGRES_HOST} port={POSTGRES_PORT} user={POSTGRES_USER} password=XXXXXX"'.format(**app.config),
+        app.config.get("POSTGRES_PASSWORD"): "XXXXXX"
+    }
+
+@huey.task(context=True)
+def run_task(key, target, task=None):
+    """
+    Run a task. The key and target are validated by /install before the 
+    task is planned, and the catalog only allows names that are valid 
+    identifiers.
+    """
+    (dataset, layer) = key.split(".")
+    status = None
+    message = ''
+    started = time.time()
+
+    # Wait for the layer, dataset and global task slots. That way no more 
+    # than one task can be run for any layer (like installing and 
+    # uninstalling it at the same time), no more than the configured number
+    # of tasks for any dataset, and no more than the configured number of 
+    # tasks in total.
+    stages = StageTimer(task.id, key, target)
+    stages.start('task', 'slot_wait')
+    with task_slots(key):
+        stages.end('task')
+        logger = for_task(tasks_logger, task.id)
+        loghandler = TaskLogHandler(get_db, release_db, task.id, 
+                                    redactions=log_redactions(),
+                                    head_size=int(app.config.get('PG_BASELAYERS_LOG_HEAD_SIZE')) * 1024,
+                                    tail_size=int(app.config.get('PG_BASELAYERS_LOG_TAIL_SIZE')) * 1024)
+        # Everything after this happens within the try below, of which the
+        # finally detaches the log handler, stores the log and hands the 
+        # connection back.
+        conn = get_db()
+        cur = conn.cursor()
+        tasks_logger.addHandler(loghandler)
+        timer = None
+        status_throttle = None
+        stopped = {}
+        finished = threading.Event()
+        definition = {}
+        tables = []
+        shadow = None
+        swapped = False
+        resume = set()
+        work_dir = os.path.join(work_dir_root, key) if target == 'install' else None
 
         try:
-            temp_dir = tempfile.TemporaryDirectory(prefix='pg-baselayers-task-')
-            logger.info(f"Running task in temporary directory: {temp_dir.name}")
+            # Two tasks on the same dataset can race to create the schema, in 
+            # which case one of them fails even with IF NOT EXISTS.
+            try:
+                cur.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {};").format(sql.Identifier(dataset)))
+                conn.commit()
+            except psycopg2.errors.UniqueViolation:
+                conn.rollback()
+
+            # Layers that declare their tables are installed into a shadow 
+            # schema, and only swapped in once completed. Others are installed
+            # in place.
+            definition = load_layer_definitions().get(key, {})
+            tables = layer_tables(definition) if definition.get('tables') else []
+
+            # Installs run in a work directory of their own, which is kept 
+            # along with the shadow schema when they fail. The stages that were
+            # completed before are skipped: the makefiles skip the downloads
+            # and extraction of which they find the stamp files, and run_task
+            # skips make altogether once everything has been imported.
+            if target == 'install':
+                checkpoints = load_checkpoints(cur, key)
+                resume = prepare_work_dir(work_dir, checkpoints)
+                if tables:
+                    shadow = shadow_schema_name(dataset, layer)
+                    cur.execute("SELECT EXISTS (SELECT 1 FROM pg_namespace WHERE nspname=%s);", (shadow,))
+                    if 'imported' in checkpoints and cur.fetchone()[0]:
+                        resume |= checkpoints & {'imported', 'indexed'}
+                    else:
+                        cur.execute(sql.SQL("DROP SCHEMA IF EXISTS {} CASCADE;").format(sql.Identifier(shadow)))
+                        cur.execute(sql.SQL("CREATE SCHEMA {};").format(sql.Identifier(shadow)))
+                    logger.info(f"Installing new version into schema {shadow}")
+                discard_checkpoints(cur, key, set(INSTALL_STAGES) - resume)
+                conn.commit()
+                if resume:
+                    logger.info(f"Resuming the install after the '{max(resume, key=INSTALL_STAGES.index)}' stage")
+            else:
+                work_dir = tempfile.mkdtemp(prefix='pg-baselayers-task-')
+
+            # A restore replaces whatever was left of an install that didn't
+            # finish, it uses the same shadow schema.
+            if target == 'restore' and tables:
+                shadow = shadow_schema_name(dataset, layer)
+                cur.execute(sql.SQL("DROP SCHEMA IF EXISTS {} CASCADE;").format(sql.Identifier(shadow)))
+                cur.execute(sql.SQL("CREATE SCHEMA {};").format(sql.Identifier(shadow)))
+                discard_checkpoints(cur, key)
+                conn.commit()
+
+            logger.info(f"Running task in directory: {work_dir}")
 
             timeout = int(app.config.get('PG_BASELAYERS_MAKE_TIMEOUT'))
             logger.info("Task timeout is {}s".format(timeout))
@@ -422,14 +1715,15 @@ def run_task(key, target, task=None):
             # Copy the relevant files from the application's dataset directory.
             root_dir = os.path.join(app.root_path, 'datasets', dataset)
             logger.info("Dataset source dir is {}".format(root_dir))
-            for f in os.listdir(root_dir):
-                file_path = os.path.join(root_dir,f)
-                if os.path.isfile(file_path):
-                    shutil.copy2(file_path, temp_dir.name)
-                    logger.info("Copied {} to {}".format(file_path, os.path.join(temp_dir.name, f)))
+            with stages.stage('task', 'copy_files'):
+                for f in os.listdir(root_dir):
+                    file_path = os.path.join(root_dir,f)
+                    if os.path.isfile(file_path):
+                        shutil.copy2(file_path, work_dir)
+                        logger.info("Copied {} to {}".format(file_path, os.path.join(work_dir, f)))
 
             # Run make
-            makefile = os.path.join(temp_dir.name, f"{layer}.make")
+            makefile = os.path.join(work_dir, f"{layer}.make")
             cmd = ["/usr/bin/make", "-f", makefile, target]
             logger.info(f"Running subprocess '{cmd}'")
 
@@ -447,66 +1741,184 @@ def run_task(key, target, task=None):
                 'POSTGRES_SSLMODE': app.config.get('POSTGRES_SSLMODE'),
                 'POSTGRES_SSLROOTCERT': app.config.get('POSTGRES_SSLROOTCERT'),
                 'POSTGRES_URI': app.config.get('POSTGRES_URI'),
-                'POSTGRES_OGR': app.config.get('POSTGRES_OGR')
+                'POSTGRES_OGR': app.config.get('POSTGRES_OGR'),
+                'PG_BASELAYERS_FETCH': "{} {} fetch".format(sys.executable, os.path.join(app.root_path, 'downloads.py')),
+                'PG_BASELAYERS_DOWNLOAD_CACHE_DIR': download_cache_dir,
+                'PG_BASELAYERS_DOWNLOAD_CACHE_SIZE': app.config.get('PG_BASELAYERS_DOWNLOAD_CACHE_SIZE'),
+                'PG_BASELAYERS_DOWNLOAD_MIRROR': app.config.get('PG_BASELAYERS_DOWNLOAD_MIRROR'),
+                'PG_BASELAYERS_IMPORT': "{} {} run import --".format(sys.executable, os.path.join(app.root_path, 'locks.py')),
+                'PG_BASELAYERS_LOCK_DIR': lock_dir,
+                'PG_BASELAYERS_MAX_DOWNLOADS': app.config.get('PG_BASELAYERS_MAX_DOWNLOADS'),
+                'PG_BASELAYERS_MAX_IMPORTS': app.config.get('PG_BASELAYERS_MAX_IMPORTS'),
+                'PG_BASELAYERS_STREAM_IMPORT': "{} {}".format(sys.executable, os.path.join(app.root_path, 'importer.py')),
+                'PG_BASELAYERS_STREAM_BUFFERS': app.config.get('PG_BASELAYERS_STREAM_BUFFERS'),
+                'PG_BASELAYERS_LOADER_WORKERS': app.config.get('PG_BASELAYERS_LOADER_WORKERS'),
+                'PG_BASELAYERS_LOADER_CHUNK_SIZE': app.config.get('PG_BASELAYERS_LOADER_CHUNK_SIZE'),
+                'PG_BASELAYERS_SCHEMA': shadow or dataset,
+                'PG_BASELAYERS_UPDATE': "{} {}".format(sys.executable, os.path.join(app.root_path, 'deltas.py'))
             }
-
-            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, 
-                                            stderr=subprocess.PIPE, 
-                                            env=subprocess_env, 
-                                            cwd=temp_dir.name, 
-                                            shell=False, 
-                                            universal_newlines=True)
-
-            #TODO: The process.kill() can still take a while to complete. Maybe
-            #      start two timers, one for kill after timeout seconds, and 
-            #      one using a more rigorous approach if that's possible.
-            def process_terminator():
-                #TODO: Update the status to 'Terminating...' or something.
-                logger.error("Timer expired, killing process... (This may also take a while to complete)")
-                process.kill()
-
-            
-            timer = Timer(timeout, process_terminator)
-
-            logger.info(f"Starting {timeout}s timer within which the installation process needs to finish.")
-            timer.start()
-            for line in iter(process.stdout.readline, b''):
-                if line:
-                    logger.info(line)
-                    if line.startswith("STATUS="):
-                        (_, info) = line.split("=", maxsplit=1)
-                        info = (info[:500] + '(...)') if len(info) > 500 else info
-                        cur.execute("""
-                            UPDATE 
-                                postgis_baselayers.layer 
-                            SET info=%s 
-                            WHERE key=%s;
-                        """, (info, key))
-                        conn.commit()
+            cur.execute("SELECT metadata->>'last_update' FROM postgis_baselayers.layer WHERE key=%s;", (key,))
+            last_update = cur.fetchone()[0]
+            if last_update:
+                subprocess_env['PG_BASELAYERS_LAST_UPDATE'] = last_update
+
+            if cancel_requested(key):
+                raise InstallCancelled("The task was cancelled before it started.")
+
+            if target in ('export', 'restore') and not tables:
+                raise InstallFailed(f"Layer {key} doesn't declare its tables.")
+
+            if target == 'export':
+                with stages.stage('task', 'export'):
+                    export_layer(key, tables, logger)
+            elif target == 'restore':
+                with stages.stage('task', 'restore'):
+                    snapshot = restore_layer(key, shadow, logger)
+            elif 'imported' in resume:
+                logger.info("Skipping make, everything was imported before.")
+            else:
+                # Run make in a process group of its own, so that it can be 
+                # terminated along with everything it started.
+                stages.start('task', 'make')
+                process = subprocess.Popen(cmd, stdout=subprocess.PIPE, 
+                                                stderr=subprocess.PIPE, 
+                                                env=subprocess_env, 
+                                                cwd=work_dir, 
+                                                shell=False, 
+                                                universal_newlines=True,
+                                                start_new_session=True)
+
+                grace = int(app.config.get('PG_BASELAYERS_KILL_GRACE'))
+                def process_terminator(reason):
+                    if stopped:
+                        return
+                    stopped['reason'] = reason
+                    logger.error(f"{reason}, terminating process group...")
+                    set_layer_info(key, "Terminating")
+                    terminate_process_group(process, grace)
+
+                timer = Timer(timeout, process_terminator, args=("Timer expired",))
+                timer.daemon = True
+                status_throttle = StatusThrottle(key, float(app.config.get('PG_BASELAYERS_STATUS_INTERVAL')))
+
+                logger.info(f"Starting {timeout}s timer within which the installation process needs to finish.")
+                timer.start()
+
+                # Check whether the task gets cancelled while it's running.
+                def cancel_watcher():
+                    while not finished.wait(2):
+                        if cancel_requested(key):
+                            process_terminator("Task cancelled")
+                            return
+                threading.Thread(target=cancel_watcher, daemon=True).start()
+
+                # Drain stderr at the same time as stdout, so that neither of 
+                # them can fill up and block the process. It's logged along 
+                # with the rest, and the last lines are kept for the error. 
+                stderr_tail = deque(maxlen=50)
+                def stderr_reader():
+                    for line in iter(process.stderr.readline, ''):
+                        logger.warning(line)
+                        stderr_tail.append(line)
+                stderr_thread = threading.Thread(target=stderr_reader, daemon=True)
+                stderr_thread.start()
+
+                for line in iter(process.stdout.readline, ''):
+                    if line:
+                        logger.info(line)
+                        if line.startswith("STATUS="):
+                            (_, info) = line.split("=", maxsplit=1)
+                            info = (info[:500] + '(...)') if len(info) > 500 else info
+                            status_throttle.update(info)
+                            stages.status(info)
+                        if line.startswith("UPDATED="):
+                            set_last_update(cur, key, line.split("=", maxsplit=1)[1].strip())
+                            conn.commit()
+                        if line.startswith("CHECKPOINT=") and target == 'install':
+                            stage = line.split("=", maxsplit=1)[1].strip()
+                            if stage in INSTALL_STAGES:
+                                record_checkpoint(key, stage, task.id)
+                    else:
+                        break
+
+                # Write the latest status before anything else does.
+                status_throttle.flush()
+
+                process.wait()
+                stderr_thread.join()
+                finished.set()
+                stages.end('make')
+                stages.end('task')
+                logger.info(f"Subprocess finished with returncode {process.returncode}")
+                stderr = ''.join(stderr_tail)
+
+                if stopped.get('reason') == "Task cancelled":
+                    raise InstallCancelled(stderr)
+
+                if process.returncode < 0 or stopped:
+                    raise InstallTerminated(stderr)
+
+                if process.returncode != 0:
+                    raise InstallFailed(stderr)
+
+            if target == 'install':
+                if shadow:
+                    record_checkpoint(key, 'imported', task.id)
+                if 'indexed' in resume:
+                    logger.info("Skipping the post-install stage, it was completed before.")
                 else:
-                    break
-
-            print("Subprocess finished, wait for returncode...")
-            process.wait()
-            print("Returncode is {}".format(process.returncode))
-
-            #TODO: Do we need a wait() and communicate() here or does 
-            #      communicate() imply wait()ing?      
-            stdout, stderr = process.communicate()
-
-            if process.returncode < 0:
-                raise InstallTerminated(stderr)
-
-            if process.returncode != 0:
-                raise InstallFailed(stderr)
-
-            if process.returncode == 0:
-                message = f"Completed {target} task on {key}."
-                logger.info(message)
-                if target == 'install':
-                    status = 1
-                if target == 'uninstall':
-                    status = 0
+                    with stages.stage('task', 'post_install'):
+                        post_install(key, logger, shadow)
+                    if shadow:
+                        record_checkpoint(key, 'indexed', task.id)
+                if shadow:
+                    with stages.stage('task', 'swap'):
+                        swap_layer(key, shadow, tables, logger)
+                    swapped = True
+                else:
+                    cur.execute("""
+                        UPDATE postgis_baselayers.layer SET version=version+1, installed=NOW() WHERE key=%s;
+                    """, (key,))
+                    conn.commit()
+                register_derived_layers(cur, key, definition)
+                conn.commit()
+                # A fresh install has the changes published up to 
+                # yesterday. Should it have missed some of them, they 
+                # are applied again on the next update, which is fine.
+                if definition.get('updates'):
+                    set_last_update(cur, key, (datetime.date.today() - datetime.timedelta(days=1)).isoformat())
+                    conn.commit()
+                discard_checkpoints(cur, key)
+                conn.commit()
+            if target == 'restore':
+                with stages.stage('task', 'swap'):
+                    swap_layer(key, shadow, tables, logger)
+                swapped = True
+                register_derived_layers(cur, key, definition)
+                last_update = snapshot['metadata'].get('last_update')
+                if last_update:
+                    set_last_update(cur, key, last_update)
+                conn.commit()
+            if target == 'uninstall':
+                # Also discard what's left of an install that didn't finish.
+                drop_rollback(cur, key)
+                drop_derived_layers(cur, key, definition)
+                discard_checkpoints(cur, key)
+                cur.execute(sql.SQL("DROP SCHEMA IF EXISTS {} CASCADE;").format(sql.Identifier(shadow_schema_name(dataset, layer))))
+                conn.commit()
+                shutil.rmtree(os.path.join(work_dir_root, key), ignore_errors=True)
+            if target in ('install', 'restore') and app.config.get('PG_BASELAYERS_REPORT') == 'YES':
+                with stages.stage('task', 'report'):
+                    report_layer(key, definition, task.id, logger)
+            invalidate_tiles(key, definition)
+            message = f"Completed {target} task on {key}."
+            logger.info(message)
+            if target == 'install':
+                status = 1
+            if target == 'uninstall':
+                status = 0
+            if target in ('update', 'export', 'restore'):
+                status = 1
             
         except InstallFailed as e:
             logger.error("ERROR! The installation failed with a non-zero returncode. More info: {}".format(e))
@@ -518,69 +1930,173 @@ def run_task(key, target, task=None):
             message = f"Failed {target} on {key}. (Process was terminated)"
             status = 4
 
+        except InstallCancelled as e:
+            logger.error("The task was cancelled. More info: {}".format(e))
+            message = f"Cancelled {target} on {key}."
+            status = 4
+
         except Exception as e:
             logger.error("ERROR! The installation failed for an unknown reason. More info: {}".format(e))
             message = f"Failed {target} on {key}. (Unknown reason)"
             status = 4
 
         finally:
-            # Destroy the temporary directory
-            logger.info("Cleaning temporary directory...")
-            temp_dir.cleanup()
+            # Keep the work directory of an install that didn't finish, 
+            # along with the new version if everything has been imported
+            # into it, so that the install can be resumed. The live version
+            # was never touched.
+            stages.end('make')
+            stages.start('task', 'cleanup')
+            conn.rollback()
+            if target == 'install' and status != 1:
+                checkpoints = load_checkpoints(cur, key)
+                logger.info(f"Keeping work directory {work_dir}, completed stages: {', '.join(sorted(checkpoints, key=INSTALL_STAGES.index)) or 'none'}")
+                if shadow and not swapped and 'imported' not in checkpoints:
+                    logger.info(f"Dropping schema {shadow}...")
+                    cur.execute(sql.SQL("DROP SCHEMA IF EXISTS {} CASCADE;").format(sql.Identifier(shadow)))
+                    conn.commit()
+            elif work_dir:
+                logger.info("Cleaning work directory...")
+                shutil.rmtree(work_dir, ignore_errors=True)
+            if target == 'restore' and shadow and not swapped:
+                logger.info(f"Dropping schema {shadow}...")
+                cur.execute(sql.SQL("DROP SCHEMA IF EXISTS {} CASCADE;").format(sql.Identifier(shadow)))
+                conn.commit()
 
             # Cancel any timer
             logger.info("Cancelling timer...")
             if timer:
                 timer.cancel()
+            finished.set()
+            if status_throttle:
+                status_throttle.flush()
 
-            # No matter what happens, flush the log and save in log table.
+            # No matter what happens, store the rest of the log and save the
+            # task in the log table.
             logger.info("Flushing and saving logs...")
-            streamhandler.flush()
-            log_content = logstream.getvalue()
-
-            # Remove passwords from logfile
-            postgres_uri_safe = "postgresql://{POSTGRES_USER}:XXXXXX@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}".format(**app.config)
-            log_content = log_content.replace(app.config.get("POSTGRES_URI"), postgres_uri_safe)
-
-            postgres_ogr_safe = 'PG:"dbname={POSTGRES_DB} host={POSTGRES_HOST} port={POSTGRES_PORT} user={POSTGRES_USER} password=XXXXXX"'.format(**app.config)
-            log_content = log_content.replace(app.config.get("POSTGRES_OGR"), postgres_ogr_safe)
+            stages.start('task', 'log_flush')
+            tasks_logger.removeHandler(loghandler)
+            try:
+                loghandler.close()
+            except psycopg2.Error as e:
+                logging.error(f"Could not store the end of the log of task {task.id}: {e}")
 
             cur.execute("""
                 INSERT INTO 
                     postgis_baselayers.log 
-                    (layer_key, task_id, target, info, log) 
+                    (layer_key, task_id, target, info, status, duration) 
                 VALUES 
-                    (%s, %s, %s, %s, %s)
-            """, (task.args[0], task.id, target, message, log_content))
+                    (%s, %s, %s, %s, %s, %s)
+            """, (task.args[0], task.id, target, message, status, time.time() - started))
+            cur.execute("UPDATE postgis_baselayers.layer SET cancel_requested=false WHERE key=%s;", (key,))
             conn.commit()
-            conn.close()
+            release_db(conn)
+            stages.close()
 
             # Return the status code of the task
             return status
 
+@huey.task(retries=3, retry_delay=60, priority=TASK_PRIORITIES['fetch'])
+def fetch_task(dataset, urls):
+    """
+    Download source files shared by several layers of a dataset into the 
+    download cache, so the install tasks of those layers can use them.
+    """
+    cache = DownloadCache(download_cache_dir, 
+                          int(app.config.get('PG_BASELAYERS_DOWNLOAD_CACHE_SIZE')) * 1024 * 1024,
+                          log=logger.info,
+                          mirror=app.config.get('PG_BASELAYERS_DOWNLOAD_MIRROR'))
+    for url in urls:
+        cache.fetch(url)
+    return True
+
+def queue_updates():
+    """
+    Plan an update of every installed layer that supports incremental 
+    updates and isn't already part of the plan.
+    """
+    updatable = [key for key, layer in load_layer_definitions().items() if layer.get('updates')]
+    conn = get_db()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            WITH planned AS (
+                INSERT INTO postgis_baselayers.plan (node, target)
+                SELECT key, 'update' FROM postgis_baselayers.layer 
+                WHERE status=1 AND key = ANY(%s)
+                ON CONFLICT ON CONSTRAINT plan_pkey DO NOTHING
+                RETURNING node
+            )
+            UPDATE postgis_baselayers.layer SET status=2 
+            FROM planned WHERE layer.key = planned.node
+            RETURNING layer.key;
+        """, (updatable,))
+        for (key,) in cur.fetchall():
+            logger.info(f"Planned scheduled update of {key}.")
+        conn.commit()
+        release_ready_nodes(conn)
+    finally:
+        release_db(conn)
+
+if app.config.get('PG_BASELAYERS_UPDATE_SCHEDULE', '').strip():
+    @huey.periodic_task(crontab(*app.config.get('PG_BASELAYERS_UPDATE_SCHEDULE').split()))
+    def scheduled_updates():
+        queue_updates()
+
 @huey.pre_execute()
 def pre_exec_hook(task):
     """
     Set dataset status to '3: working' before executing task.
     """
+    if task.name != 'run_task':
+        return
     logger.info("Pre-exec hook. Setting status to 3.")
     conn = get_db()
-    cur = conn.cursor()
-    cur.execute("UPDATE postgis_baselayers.layer SET status=3, info='' WHERE key=%s;", (task.args[0],))
-    conn.commit()
-    conn.close()
+    try:
+        cur = conn.cursor()
+        cur.execute("UPDATE postgis_baselayers.layer SET status=3, info='' WHERE key=%s;", (task.args[0],))
+        # Close the stages left running when the task was claimed before by
+        # a worker that was lost.
+        cur.execute("""
+            UPDATE postgis_baselayers.stage_timing SET duration=EXTRACT(epoch FROM NOW() - started)
+            WHERE task_id=%s AND duration IS NULL;
+        """, (task.id,))
+        # Record how long the task waited for its dependencies in the plan,
+        # and then in the queue for a worker.
+        cur.execute("""
+            INSERT INTO postgis_baselayers.stage_timing (task_id, layer_key, target, phase, stage, started, duration)
+            SELECT %s, node, target, 'queue', 'planned', created, EXTRACT(epoch FROM queued_at - created)
+            FROM postgis_baselayers.plan WHERE node=%s AND queued_at IS NOT NULL
+            UNION ALL
+            SELECT %s, node, target, 'queue', 'queued', queued_at, EXTRACT(epoch FROM NOW() - queued_at)
+            FROM postgis_baselayers.plan WHERE node=%s AND queued_at IS NOT NULL;
+        """, (task.id, task.args[0], task.id, task.args[0]))
+        conn.commit()
+    finally:
+        release_db(conn)
     logger.info("Done.")
 
 @huey.post_execute()
 def post_exec_hook(task, task_value, exc):
     """
     After executing task, set the dataset status to the status code returned 
-    by the task.
+    by the task, and move on to the next tasks in the plan.
     """
+    if task.name == 'fetch_task':
+        if exc and task.retries:
+            # The download is retried later, see fetch_task.
+            return
+        conn = get_db()
+        try:
+            advance_plan(conn, FETCH_PREFIX + task.args[0], exc is None)
+        finally:
+            release_db(conn)
+        return
+    if task.name != 'run_task':
+        return
+
     logger.info(f"Post-exec hook. Setting status to {task_value}.")
     logger.info(f"Post-exec hook exception: {exc}")
-    conn = get_db()
-    cur = conn.cursor()
     if exc:
         logger.info("Exception found. Setting task status to error.")
         task_value = 4
@@ -588,8 +2104,42 @@ def post_exec_hook(task, task_value, exc):
     if task_value is None:
         logger.info("Task completed but did not return a value. Settings task status to error.")
         task_value = 4
-        
-    cur.execute("UPDATE postgis_baselayers.layer SET status=%s, info='' WHERE key=%s;", (task_value, task.args[0]))
-    conn.commit()
-    conn.close()
+
+    conn = get_db()
+    try:
+        cur = conn.cursor()
+        cur.execute("UPDATE postgis_baselayers.layer SET status=%s, info='' WHERE key=%s;", (task_value, task.args[0]))
+        conn.commit()
+        advance_plan(conn, task.args[0], task_value != 4)
+    finally:
+        release_db(conn)
     logger.info("Done.")
+
+if isinstance(huey, PostgresHuey):
+    @huey.abandoned()
+    def abandoned_hook(task):
+        """
+        Mark the layer of a task as failed when the workers that ran it kept
+        disappearing before it completed, rather than leaving it at status 3.
+        """
+        if task.name == 'fetch_task':
+            node = FETCH_PREFIX + task.args[0]
+        elif task.name == 'run_task':
+            node = task.args[0]
+        else:
+            return
+        logger.info(f"Task {task.id} on {node} was abandoned after its worker was lost.")
+        conn = get_db()
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                UPDATE postgis_baselayers.layer SET status=4, info='Worker lost' WHERE key=%s;
+            """, (node,))
+            cur.execute("""
+                UPDATE postgis_baselayers.stage_timing SET duration=EXTRACT(epoch FROM NOW() - started)
+                WHERE task_id=%s AND duration IS NULL;
+            """, (task.id,))
+            conn.commit()
+            advance_plan(conn, node, False)
+        finally:
+            release_db(conn)
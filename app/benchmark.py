@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the install pipeline.
+
+Layers are installed end-to-end by run_task, like the huey worker would,
+against the database configured in the environment. Use a scratch database
+for this: layers are installed and uninstalled again. Their source files are
+served by a local HTTP server from a directory of fixtures, laid out like a
+download mirror (<fixtures>/<host>/<path>, see PG_BASELAYERS_DOWNLOAD_MIRROR),
+normally with scaled-down copies of the real archives under the same names.
+
+    python benchmark.py run --fixtures ../fixtures [--layer example.airports] [-o results.json]
+    python benchmark.py compare old.json new.json
+
+For every layer the results have the wall time of the install and of each
+of its stages, the rows loaded per second, the peak memory use (RSS) of the
+task and everything it ran, the peak disk use of its work directory and the
+download cache, and how much the database grew. The stages are timed by the
+status updates of the layer: the STATUS= lines of its makefile followed by
+the post-install stages of run_task. Each layer is installed in a process
+of its own, with an empty download cache and work directory.
+
+After the install, the same set of bounding box queries is run on every
+table of the layer with a geometry column, and the time they took and the
+number of pages they read are saved too. These show what the storage
+options of a layer (see postinstall.py) gain: compare a run with a run with
+PG_BASELAYERS_STORAGE_OPTIONS=NO.
+
+The results are saved as JSON along with the commit they were made with,
+and compare prints the differences between two of them. It exits with 1
+when something got slower by more than the threshold.
+"""
+import os
+import sys
+import json
+import time
+import random
+import select
+import argparse
+import datetime
+import tempfile
+import socketserver
+import threading
+import subprocess
+import http.server
+
+from psycopg2 import sql
+
+# Stages of an install, by the status info they start with. Time spent
+# otherwise (setting up, uninstalling leftovers) is counted as 'other'.
+STAGES = [
+    ('download', ('Downloading',)),
+    ('extract', ('Extracting',)),
+    ('load', ('Importing', 'Updating')),
+    ('reorganize', ('Reorganizing',)),
+    ('index', ('Building indexes',)),
+    ('analyze', ('Analyzing',)),
+    ('swap', ('Swapping',)),
+]
+
+
+def stage_of(info):
+    for (stage, prefixes) in STAGES:
+        if info.startswith(prefixes):
+            return stage
+    return 'other'
+
+
+def stage_times(events, started, finished):
+    """
+    Returns the time spent in each stage, given the (time, info) status
+    updates of a task that ran from `started` until `finished`.
+    """
+    times = {}
+    (since, stage) = (started, 'other')
+    for (t, info) in [e for e in events if e[1]] + [(finished, '')]:
+        times[stage] = times.get(stage, 0) + (t - since)
+        (since, stage) = (t, stage_of(info))
+    return {stage: round(seconds, 3) for (stage, seconds) in times.items()}
+
+
+class FixtureServer(object):
+    """
+    Serves the files in `directory` over HTTP on a free local port.
+    """
+    class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        root = None
+
+        def translate_path(self, path):
+            # SimpleHTTPRequestHandler only takes a directory since Python 3.7.
+            relative = os.path.relpath(super().translate_path(path), os.getcwd())
+            return os.path.join(self.root, relative)
+
+        def log_message(self, *args):
+            pass
+
+    def __init__(self, directory):
+        handler = type('Handler', (self.Handler,), {'root': os.path.abspath(directory)})
+        self.server = self.Server(('127.0.0.1', 0), handler)
+        self.url = "http://127.0.0.1:{}/".format(self.server.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+
+class StatusRecorder(threading.Thread):
+    """
+    Records the status updates of a layer with the time they came in, from
+    the notifications sent by the database (see events.py).
+    """
+    def __init__(self, connect, channel, key):
+        super().__init__(daemon=True)
+        self.connect = connect
+        self.channel = channel
+        self.key = key
+        self.events = []
+        self.ready = threading.Event()
+        self.stopped = threading.Event()
+
+    def run(self):
+        conn = self.connect()
+        try:
+            conn.autocommit = True
+            conn.cursor().execute(f"LISTEN {self.channel};")
+            self.ready.set()
+            while True:
+                stopping = self.stopped.is_set()
+                if select.select([conn], [], [], 0.2) != ([], [], []):
+                    conn.poll()
+                    while conn.notifies:
+                        change = json.loads(conn.notifies.pop(0).payload)
+                        if change.get('key') == self.key:
+                            self.events.append((time.time(), change.get('info') or ''))
+                if stopping:
+                    break
+        finally:
+            conn.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class ResourceSampler(threading.Thread):
+    """
+    Keeps track of the peak size of the files in `directory` and of the
+    database, sampled every `interval` seconds.
+    """
+    def __init__(self, connect, directory, interval=0.5):
+        super().__init__(daemon=True)
+        self.connect = connect
+        self.directory = directory
+        self.interval = interval
+        self.peak_disk = 0
+        self.peak_db = 0
+        self.stopped = threading.Event()
+
+    def sample(self, cur):
+        size = 0
+        for (root, dirs, files) in os.walk(self.directory):
+            for f in files:
+                try:
+                    size += os.lstat(os.path.join(root, f)).st_size
+                except OSError:
+                    pass
+        self.peak_disk = max(self.peak_disk, size)
+        cur.execute("SELECT pg_database_size(current_database());")
+        self.peak_db = max(self.peak_db, cur.fetchone()[0])
+
+    def run(self):
+        conn = self.connect()
+        try:
+            conn.autocommit = True
+            cur = conn.cursor()
+            while True:
+                self.sample(cur)
+                if self.stopped.wait(self.interval):
+                    break
+            self.sample(cur)
+        finally:
+            conn.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def bbox_queries(cur, table, count=50, size=0.05, seed=0):
+    """
+    Run `count` queries for the rows in a random box within the extent of a
+    table, `size` times its width and height, and return the time they took
+    and the number of pages they hit or read. The boxes only depend on the
+    extent, so they're the same in every run. Returns None for tables that
+    don't have a geometry column.
+    """
+    cur.execute("""
+        SELECT attname FROM pg_attribute
+        WHERE attrelid = %s::regclass AND atttypid = 'geometry'::regtype AND NOT attisdropped
+        ORDER BY attnum LIMIT 1;
+    """, (table,))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    (geom, table_id) = (sql.Identifier(row[0]), sql.Identifier(*table.split('.')))
+    cur.execute(sql.SQL("""
+        SELECT ST_XMin(extent), ST_YMin(extent), ST_XMax(extent), ST_YMax(extent),
+               (SELECT ST_SRID({0}) FROM {1} WHERE {0} IS NOT NULL LIMIT 1)
+        FROM (SELECT ST_Extent({0}) AS extent FROM {1}) AS e;
+    """).format(geom, table_id))
+    (xmin, ymin, xmax, ymax, srid) = cur.fetchone()
+    if xmin is None:
+        return None
+
+    rnd = random.Random(seed)
+    (width, height) = ((xmax - xmin) * size, (ymax - ymin) * size)
+    (seconds, pages) = (0, 0)
+    query = sql.SQL("""
+        EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)
+        SELECT count(*) FROM {} WHERE {} && ST_MakeEnvelope(%s, %s, %s, %s, %s);
+    """).format(table_id, geom)
+    for _ in range(count):
+        x = xmin + rnd.random() * (xmax - xmin - width)
+        y = ymin + rnd.random() * (ymax - ymin - height)
+        cur.execute(query, (x, y, x + width, y + height, srid))
+        result = cur.fetchone()[0][0]
+        seconds += result['Execution Time'] / 1000
+        pages += result['Plan'].get('Shared Hit Blocks', 0) + result['Plan'].get('Shared Read Blocks', 0)
+    return {'queries': count, 'seconds': round(seconds, 4), 'pages': pages}
+
+
+def benchmark_layer(key, scratch, reinstall=False, keep=False):
+    """
+    Install a layer and measure it. Runs in a process of its own, started
+    by run() with the fixture server set as the download mirror.
+    """
+    import application
+
+    application.download_cache_dir = os.path.join(scratch, 'downloads')
+    application.work_dir_root = os.path.join(scratch, 'work')
+    application.huey.immediate = True
+    definition = application.load_layer_definitions()[key]
+
+    conn = application.connect_db_raw()
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute("SELECT status FROM postgis_baselayers.layer WHERE key=%s;", (key,))
+    row = cur.fetchone()
+    if row is None:
+        return {'layer': key, 'status': 'error', 'error': "Unknown layer, initialize the database first"}
+    installed = row[0] == 1
+    if row[0] not in (0, 4) and not reinstall:
+        return {'layer': key, 'status': 'skipped', 'error': f"Layer has status {row[0]}, use --reinstall"}
+
+    # Start from scratch, rather than resume an earlier install.
+    application.discard_checkpoints(cur, key)
+    cur.execute("SELECT pg_database_size(current_database());")
+    (db_size,) = cur.fetchone()
+
+    recorder = StatusRecorder(application.connect_db_raw, application.CHANNEL, key)
+    recorder.start()
+    recorder.ready.wait()
+    sampler = ResourceSampler(application.connect_db_raw, scratch)
+    sampler.start()
+
+    started = time.time()
+    application.run_task(key, 'install')
+    finished = time.time()
+
+    sampler.stop()
+    recorder.stop()
+
+    cur.execute("SELECT status FROM postgis_baselayers.layer WHERE key=%s;", (key,))
+    (status,) = cur.fetchone()
+    stages = stage_times(recorder.events, started, finished)
+    rows = {}
+    bbox = {}
+    if status == 1:
+        for table in definition.get('tables', []):
+            cur.execute(sql.SQL("SELECT count(*) FROM {};").format(sql.Identifier(*table.split('.'))))
+            rows[table] = cur.fetchone()[0]
+            result = bbox_queries(cur, table)
+            if result:
+                bbox[table] = result
+    load_time = stages.get('load') or (finished - started)
+
+    if status == 1 and not installed and not keep:
+        application.run_task(key, 'uninstall')
+    conn.close()
+
+    return {
+        'layer': key,
+        'status': 'installed' if status == 1 else 'failed',
+        'wall_time': round(finished - started, 3),
+        'stages': stages,
+        'rows': rows,
+        'rows_per_sec': round(sum(rows.values()) / load_time, 1) if rows else None,
+        'bbox_queries': bbox,
+        'peak_disk_bytes': sampler.peak_disk,
+        'peak_db_growth_bytes': sampler.peak_db - db_size
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], universal_newlines=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    from application import app, connect_db_raw, load_layer_definitions
+
+    keys = sorted(load_layer_definitions())
+    if args.layer or args.dataset:
+        keys = [k for k in keys if k in (args.layer or []) or k.split('.')[0] in (args.dataset or [])]
+    if not keys:
+        print("No layers to benchmark.", file=sys.stderr)
+        return 2
+
+    conn = connect_db_raw()
+    postgres = conn.server_version
+    conn.close()
+
+    server = FixtureServer(args.fixtures).start()
+    print(f"Serving fixtures from {args.fixtures} at {server.url}", flush=True)
+    env = dict(os.environ, PG_BASELAYERS_DOWNLOAD_MIRROR=server.url, PG_BASELAYERS_STATUS_INTERVAL='0')
+
+    results = []
+    for key in keys:
+        print(f"Benchmarking {key}...", flush=True)
+        with tempfile.TemporaryDirectory(prefix='pg-baselayers-benchmark-') as scratch:
+            output = os.path.join(scratch, 'result.json')
+            cmd = [sys.executable, os.path.abspath(__file__), 'layer', key, '--scratch', scratch, '--output', output]
+            if args.reinstall:
+                cmd.append('--reinstall')
+            if args.keep:
+                cmd.append('--keep')
+            # Wait for the process ourselves to get its resource usage,
+            # which includes that of the programs it waited for.
+            process = subprocess.Popen(cmd, env=env, cwd=app.root_path,
+                                       stdout=None if args.verbose else subprocess.DEVNULL)
+            (_, exit_status, rusage) = os.wait4(process.pid, 0)
+            process.returncode = os.WEXITSTATUS(exit_status) if os.WIFEXITED(exit_status) else -1
+            try:
+                with open(output) as f:
+                    result = json.load(f)
+            except (OSError, ValueError):
+                result = {'layer': key, 'status': 'error', 'error': f"Benchmark exited with {process.returncode}"}
+        result['peak_rss_bytes'] = rusage.ru_maxrss * 1024
+        results.append(result)
+        print("  {status}{wall}".format(status=result['status'],
+              wall=f" in {result['wall_time']:.1f}s: " + ", ".join(f"{s} {t:.1f}s" for (s, t) in result['stages'].items())
+                   if 'wall_time' in result else f" ({result.get('error')})"), flush=True)
+    server.stop()
+
+    created = datetime.datetime.now()
+    commit = git_commit()
+    report = {
+        'commit': commit,
+        'created': created.isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'postgres': postgres,
+        'fixtures': os.path.abspath(args.fixtures),
+        'results': results
+    }
+    path = args.output or "benchmark-{}-{}.json".format(created.strftime('%Y%m%d-%H%M%S'), (commit or 'unknown')[:12])
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f"Results saved to {path}")
+    return 0
+
+
+def compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f"{(old.get('commit') or 'unknown')[:12]} -> {(new.get('commit') or 'unknown')[:12]}")
+
+    def timings(result):
+        return dict([('total', result.get('wall_time'))] + list(result.get('stages', {}).items()))
+
+    slower = 0
+    old_results = {r['layer']: r for r in old['results']}
+    for result in new['results']:
+        before = old_results.get(result['layer'])
+        if before is None or 'wall_time' not in before or 'wall_time' not in result:
+            print(f"{result['layer']:<48} not comparable")
+            continue
+        print(result['layer'])
+        (a, b) = (timings(before), timings(result))
+        for stage in [s for s in b if s in a] + [s for s in a if s not in b]:
+            (t0, t1) = (a.get(stage, 0), b.get(stage, 0))
+            change = (t1 - t0) / t0 * 100 if t0 else 0
+            flag = ''
+            if change > args.threshold and t1 - t0 > args.min_seconds:
+                flag = '  SLOWER'
+                slower += 1
+            print(f"  {stage:<10} {t0:>9.1f}s {t1:>9.1f}s {change:>+7.1f}%{flag}")
+        for metric in ('rows_per_sec', 'peak_rss_bytes', 'peak_disk_bytes', 'peak_db_growth_bytes'):
+            if before.get(metric) is not None and result.get(metric) is not None:
+                print(f"  {metric:<22} {before[metric]:>14} {result[metric]:>14}")
+        for (table, b) in result.get('bbox_queries', {}).items():
+            a = before.get('bbox_queries', {}).get(table)
+            if a:
+                print(f"  bbox {table:<32} {a['seconds']:>9.3f}s {b['seconds']:>9.3f}s "
+                      f"{a['pages']:>9} pages {b['pages']:>9} pages")
+    return 1 if slower else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the install pipeline of PostGIS Baselayers.")
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', help="Install layers and measure them")
+    run_parser.add_argument('--fixtures', required=True, help="Directory with the source files, as <host>/<path>")
+    run_parser.add_argument('--layer', action='append', help="Layer key to benchmark (all layers by default)")
+    run_parser.add_argument('--dataset', action='append', help="Dataset to benchmark the layers of")
+    run_parser.add_argument('--reinstall', action='store_true', help="Also benchmark layers that are installed already")
+    run_parser.add_argument('--keep', action='store_true', help="Don't uninstall the layers afterwards")
+    run_parser.add_argument('--verbose', action='store_true', help="Show the output of the tasks")
+    run_parser.add_argument('-o', '--output', help="File to save the results to")
+    layer_parser = subparsers.add_parser('layer')
+    layer_parser.add_argument('key')
+    layer_parser.add_argument('--scratch', required=True)
+    layer_parser.add_argument('--output', required=True)
+    layer_parser.add_argument('--reinstall', action='store_true')
+    layer_parser.add_argument('--keep', action='store_true')
+    compare_parser = subparsers.add_parser('compare', help="Compare two results files")
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=10, help="Percentage by which a stage may get slower")
+    compare_parser.add_argument('--min-seconds', type=float, default=1, help="Ignore differences smaller than this")
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        return run(args)
+    if args.command == 'layer':
+        result = benchmark_layer(args.key, args.scratch, args.reinstall, args.keep)
+        with open(args.output, 'w') as f:
+            json.dump(result, f)
+        return 0
+    if args.command == 'compare':
+        return compare(args)
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,230 @@
+"""
+Catalog of the datasets in the datasets directory.
+
+The catalog keeps the parsed metadata.json of every dataset, along with its
+README.md rendered to HTML, so that they aren't read and rendered again on
+every request. It's loaded when the application starts, and refreshed at
+most every `interval` seconds after that: a dataset is only loaded again
+when one of its files was changed, added or removed since.
+
+Datasets are validated when they're loaded, so that mistakes show up right
+away rather than when a layer is installed: the metadata must have the
+fields the application uses, layer names must be usable as table names,
+dependencies must exist, and every layer needs a makefile with the targets
+it can be run with. A dataset that doesn't validate raises a CatalogError
+naming all of its problems.
+
+Such an error only raises when the catalog is loaded for the first time.
+After that, when a dataset is edited into something that doesn't validate,
+the error is logged and kept in `error`, and the last catalog that did
+validate is kept in use until the datasets are fixed.
+"""
+import os
+import re
+import json
+import time
+import logging
+import threading
+
+import markdown
+from psycopg2.extras import execute_values
+
+from report import BUILTIN_QUERIES
+from postinstall import index_name
+
+NAME_PATTERN = re.compile(r'^[a-z][a-z0-9_]*$')
+MAKE_TARGET_PATTERN = re.compile(r'^([A-Za-z0-9_.-]+(?:[ \t]+[A-Za-z0-9_.-]+)*)[ \t]*:(?!=)', re.M)
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogError(Exception):
+    pass
+
+
+def make_targets(path):
+    with open(path) as f:
+        return {target for line in MAKE_TARGET_PATTERN.findall(f.read()) for target in line.split()}
+
+
+def validate(name, dataset, directory):
+    """
+    Returns a list of the problems with a dataset, if any.
+    """
+    problems = []
+    if dataset.get('name') != name:
+        problems.append(f"name '{dataset.get('name')}' doesn't match its directory")
+    if not NAME_PATTERN.match(name):
+        problems.append("name must consist of lowercase letters, digits and underscores")
+    if not isinstance(dataset.get('metadata'), dict):
+        problems.append("'metadata' must be an object")
+    if 'downloads' in dataset:
+        problems.append("'downloads' must be declared on the layers that use them, not on the dataset")
+    layers = dataset.get('layers')
+    if not isinstance(layers, list) or not layers:
+        return problems + ["'layers' must be a list of layers"]
+
+    seen = set()
+    for layer in layers:
+        layer_name = layer.get('name', '')
+        if not NAME_PATTERN.match(layer_name):
+            problems.append(f"layer name '{layer_name}' must consist of lowercase letters, digits and underscores")
+            continue
+        if layer_name in seen:
+            problems.append(f"layer '{layer_name}' is listed more than once")
+        seen.add(layer_name)
+        if not isinstance(layer.get('metadata'), dict):
+            problems.append(f"layer '{layer_name}' must have a 'metadata' object")
+        for table in layer.get('tables', []):
+            if table.count('.') != 1:
+                problems.append(f"table '{table}' of layer '{layer_name}' must be named as 'schema.table'")
+
+        names = [(index['table'].rpartition('.')[0], index_name(index)) for index in layer.get('indexes', [])]
+        for (schema, index) in sorted({name for name in names if names.count(name) > 1}):
+            problems.append(f"layer '{layer_name}' has more than one index or constraint named '{index}' in {schema}")
+
+        for query in layer.get('report_queries', []):
+            if isinstance(query, str) and query not in BUILTIN_QUERIES:
+                problems.append(f"layer '{layer_name}' has an unknown report query '{query}'")
+            elif not isinstance(query, str) and not (query.get('name') and query.get('query')):
+                problems.append(f"report queries of layer '{layer_name}' need a 'name' and a 'query'")
+
+        makefile = os.path.join(directory, f"{layer_name}.make")
+        if not os.path.isfile(makefile):
+            problems.append(f"layer '{layer_name}' has no makefile {layer_name}.make")
+            continue
+        required = {'install', 'uninstall'} | ({'update'} if layer.get('updates') else set())
+        missing = required - make_targets(makefile)
+        if missing:
+            problems.append(f"{layer_name}.make has no target {', '.join(sorted(missing))}")
+    return problems
+
+
+class DatasetCatalog(object):
+    def __init__(self, directory, interval=2):
+        self.directory = directory
+        self.interval = interval
+        self.datasets = {}
+        self.stamps = {}
+        self.checked = 0
+        self.loaded = False
+        self.error = None
+        self.failed_stamps = None
+        self.lock = threading.Lock()
+        self._layers = {}
+
+    def _stamp(self, path):
+        """
+        Returns something that changes whenever a file in `path` does.
+        """
+        return tuple(sorted((entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+                            for entry in os.scandir(path) if entry.is_file()))
+
+    def _load(self, name, path):
+        with open(os.path.join(path, "metadata.json")) as f:
+            try:
+                dataset = json.load(f)
+            except ValueError as e:
+                raise CatalogError(f"Dataset '{name}': invalid metadata.json: {e}")
+        problems = validate(name, dataset, path)
+        if problems:
+            raise CatalogError(f"Dataset '{name}': {'; '.join(problems)}")
+        try:
+            with open(os.path.join(path, "README.md")) as f:
+                readme = markdown.markdown(f.read())
+        except FileNotFoundError:
+            readme = ''
+        return dict(dataset, readme=readme)
+
+    def refresh(self, force=False):
+        """
+        Load the datasets that were added or changed since the last refresh,
+        and forget the ones that were removed. Returns whether anything
+        changed. A CatalogError is only raised when nothing was loaded yet,
+        otherwise the previous catalog is kept.
+        """
+        with self.lock:
+            if not force and time.time() - self.checked < self.interval:
+                return False
+            self.checked = time.time()
+            stamps = {}
+            for entry in os.scandir(self.directory):
+                if entry.is_dir() and os.path.isfile(os.path.join(entry.path, "metadata.json")):
+                    stamps[entry.name] = self._stamp(entry.path)
+            changed = [name for name in stamps if stamps[name] != self.stamps.get(name)]
+            removed = [name for name in self.datasets if name not in stamps]
+            if not changed and not removed:
+                self.loaded = True
+                self.error = None
+                return False
+            if stamps == self.failed_stamps:
+                # Still the same mistake, which was logged already.
+                return False
+
+            try:
+                (datasets, layers) = self._load_changes(changed, removed)
+            except CatalogError as e:
+                if not self.loaded:
+                    raise
+                logger.error(f"Keeping the previous catalog of datasets: {e}")
+                self.error = str(e)
+                self.failed_stamps = stamps
+                return False
+
+            self.datasets = datasets
+            self._layers = layers
+            self.stamps = stamps
+            self.loaded = True
+            self.error = None
+            self.failed_stamps = None
+            return True
+
+    def _load_changes(self, changed, removed):
+        datasets = dict(self.datasets)
+        for name in removed:
+            del datasets[name]
+        for name in changed:
+            datasets[name] = self._load(name, os.path.join(self.directory, name))
+
+        layers = {f"{name}.{layer['name']}": layer
+                  for (name, dataset) in sorted(datasets.items()) for layer in dataset['layers']}
+        problems = []
+        for (key, layer) in layers.items():
+            for dependency in layer.get('depends_on', []):
+                dependency_key = dependency if '.' in dependency else f"{key.split('.')[0]}.{dependency}"
+                if dependency_key not in layers:
+                    problems.append(f"layer '{key}' depends on unknown layer '{dependency_key}'")
+        if problems:
+            raise CatalogError('; '.join(problems))
+        return (datasets, layers)
+
+    def get(self, name):
+        self.refresh()
+        return self.datasets.get(name)
+
+    def layers(self):
+        """
+        Returns the layer entries of all datasets, keyed by layer key.
+        """
+        self.refresh()
+        return self._layers
+
+    def sync(self, cur):
+        """
+        Insert or update all datasets and their layers in the database. The
+        date up to which a layer was updated (see deltas.py) is kept. The
+        caller commits.
+        """
+        self.refresh(force=True)
+        datasets = sorted(self.datasets.values(), key=lambda dataset: dataset['name'])
+        execute_values(cur, """
+            INSERT INTO postgis_baselayers.dataset (name, metadata) VALUES %s
+            ON CONFLICT ON CONSTRAINT dataset_pkey DO UPDATE SET metadata = EXCLUDED.metadata;
+        """, [(dataset['name'], json.dumps(dataset['metadata'])) for dataset in datasets])
+        execute_values(cur, """
+            INSERT INTO postgis_baselayers.layer (key, name, dataset_name, metadata) VALUES %s
+            ON CONFLICT ON CONSTRAINT layer_pkey DO UPDATE SET metadata = (
+                EXCLUDED.metadata::jsonb || jsonb_strip_nulls(jsonb_build_object('last_update', layer.metadata->'last_update'))
+            )::json;
+        """, [(f"{dataset['name']}.{layer['name']}", layer['name'], dataset['name'], json.dumps(layer['metadata']))
+              for dataset in datasets for layer in dataset['layers']], page_size=1000)
@@ -1,5 +1,5 @@
-DROP TABLE IF EXISTS example.airports;
-CREATE TABLE example.airports (
+DROP TABLE IF EXISTS :"schema".airports;
+CREATE TABLE :"schema".airports (
     id integer,
     ident varchar(256),
     type varchar(256),
@@ -17,5 +17,7 @@ CREATE TABLE example.airports (
     local_code varchar(12),
     home_link varchar(256),
     wikipedia_link varchar(256),
-    keywords varchar(256)
+    keywords varchar(256),
+    -- Point geometry computed from the coordinates while the data is loaded
+    geom geometry(Point, 4326) GENERATED ALWAYS AS (ST_SetSRID(ST_MakePoint(longitude_deg, latitude_deg), 4326)) STORED
  );
@@ -1,8 +0,0 @@
-ALTER TABLE ONLY geonames.alternatename ADD CONSTRAINT pk_alternatenameid PRIMARY KEY (alternatenameid);
-ALTER TABLE ONLY geonames.geoname ADD CONSTRAINT pk_geonameid PRIMARY KEY (geonameid);
-ALTER TABLE ONLY geonames.countryinfo ADD CONSTRAINT pk_iso_alpha2 PRIMARY KEY (iso_alpha2);
-ALTER TABLE ONLY geonames.countryinfo ADD CONSTRAINT fk_geonameid FOREIGN KEY (geonameid) REFERENCES geonames.geoname(geonameid);
-ALTER TABLE ONLY geonames.alternatename ADD CONSTRAINT fk_geonameid FOREIGN KEY (geonameid) REFERENCES geonames.geoname(geonameid);
-ALTER TABLE geonames.geoname ADD COLUMN geom geometry(Point, 4326);
-UPDATE geonames.geoname SET geom = ST_PointFromText('POINT(' || longitude || ' ' || latitude || ')', 4326);
-CREATE INDEX idx_geoname_geom ON geonames.geoname USING gist(geom);
\ No newline at end of file
@@ -1,4 +1,4 @@
-CREATE TABLE geonames.geoname (
+CREATE TABLE :"schema".geoname (
     geonameid   int,
     name varchar(200),
     asciiname varchar(200),
@@ -17,9 +17,10 @@ CREATE TABLE geonames.geoname (
     elevation int,
     gtopo30 int,
     timezone varchar(40),
-    moddate date
+    moddate date,
+    geom geometry(Point, 4326) GENERATED ALWAYS AS (ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)) STORED
  );
-CREATE TABLE geonames.alternatename (
+CREATE TABLE :"schema".alternatename (
     alternatenameId int,
     geonameid int,
     isoLanguage varchar(7),
@@ -29,7 +30,7 @@ CREATE TABLE geonames.alternatename (
     isColloquial boolean,
     isHistoric boolean
  );
-CREATE TABLE geonames.countryinfo (
+CREATE TABLE :"schema".countryinfo (
     iso_alpha2 char(2),
     iso_alpha3 char(3),
     iso_numeric integer,
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Incremental updates of installed layers from daily delta files.
+
+Some sources publish the records that were modified and deleted each day,
+like the modifications-<date>.txt and deletes-<date>.txt files of Geonames.
+Rather than reinstalling the whole layer, the 'update' target of its
+makefile applies the files published since the last update:
+
+    update:
+    	$(PG_BASELAYERS_UPDATE) <layer>
+
+The updates are declared per layer in metadata.json, in the order in which
+the modifications must be applied. Deletes are applied afterwards in the
+reverse order, so that referencing rows are deleted first:
+
+    "updates": [
+        {
+            "name": "geoname",
+            "table": "geonames.geoname",
+            "key": "geonameid",
+            "columns": ["geonameid", "name", ...],
+            "options": "null as ''",
+            "modifications": "http://download.geonames.org/export/dump/modifications-{date}.txt",
+            "deletes": "http://download.geonames.org/export/dump/deletes-{date}.txt",
+            "dependents": [{"table": "geonames.alternatename", "column": "geonameid"}]
+        }
+    ]
+
+Modified rows are upserted in batches and rows that did not actually change
+are left alone, so that only the index entries of rows that changed are
+touched. The first column of a deletes file holds the key of a deleted row.
+Rows in `dependents` that reference a deleted row are deleted with it.
+
+run_task passes the date of the last update in PG_BASELAYERS_LAST_UPDATE.
+After each day has been applied an UPDATED=<date> line is printed on
+stdout, which run_task stores as the new date of the last update. Applying
+a day more than once does no harm.
+"""
+import os
+import sys
+import json
+import argparse
+import datetime
+import contextlib
+
+import psycopg2
+from psycopg2 import sql
+
+from locks import slots_from_env
+from downloads import DownloadCache, DownloadError
+from importer import copy_statement, CHUNK_SIZE
+from postinstall import table_identifier, relocate
+
+
+class UpdateError(Exception):
+    pass
+
+
+def find_updates(metadata, layer):
+    for entry in metadata['layers']:
+        if entry['name'] == layer:
+            if not entry.get('updates'):
+                raise UpdateError(f"Layer '{layer}' declares no updates.")
+            return entry['updates']
+    raise UpdateError(f"Unknown layer '{layer}'.")
+
+
+def parse_date(value):
+    # date.fromisoformat only exists since Python 3.7.
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def pending_dates(since, until):
+    """
+    Returns the dates after `since` up to and including `until`.
+    """
+    dates = []
+    date = since + datetime.timedelta(days=1)
+    while date <= until:
+        dates.append(date)
+        date += datetime.timedelta(days=1)
+    return dates
+
+
+def apply_modifications(conn, source, spec, batch_size=10000):
+    """
+    Load the modified rows into a temporary table, and upsert them into the
+    target table in batches of `batch_size` rows, each in a transaction of
+    its own. Returns the number of rows that were inserted or changed.
+    """
+    table = table_identifier(spec['table'])
+    key = sql.Identifier(spec['key'])
+    columns = sql.SQL(', ').join(map(sql.Identifier, spec['columns']))
+    changed = sql.SQL(', ').join(sql.SQL("{} = EXCLUDED.{}").format(sql.Identifier(c), sql.Identifier(c))
+                                 for c in spec['columns'] if c != spec['key'])
+    cur = conn.cursor()
+    cur.execute(sql.SQL("CREATE TEMP TABLE delta AS SELECT {} FROM {} WITH NO DATA;").format(columns, table))
+    try:
+        cur.copy_expert(copy_statement('delta', spec['columns'], spec.get('options', '')).as_string(conn), source, size=CHUNK_SIZE)
+        conn.commit()
+        upserted = 0
+        while True:
+            cur.execute(sql.SQL("""
+                WITH batch AS (
+                    DELETE FROM delta WHERE ctid IN (SELECT ctid FROM delta LIMIT %s) RETURNING *
+                )
+                INSERT INTO {table} AS target ({columns})
+                SELECT DISTINCT ON ({key}) {columns} FROM batch ORDER BY {key}
+                ON CONFLICT ({key}) DO UPDATE SET {changed}
+                WHERE ({target_columns}) IS DISTINCT FROM ({excluded_columns});
+            """).format(table=table, columns=columns, key=key, changed=changed,
+                        target_columns=sql.SQL(', ').join(sql.SQL("target.{}").format(sql.Identifier(c)) for c in spec['columns']),
+                        excluded_columns=sql.SQL(', ').join(sql.SQL("EXCLUDED.{}").format(sql.Identifier(c)) for c in spec['columns'])),
+                        (batch_size,))
+            upserted += cur.rowcount
+            conn.commit()
+            cur.execute("SELECT EXISTS (SELECT 1 FROM delta);")
+            if not cur.fetchone()[0]:
+                return upserted
+    finally:
+        conn.rollback()
+        cur.execute("DROP TABLE IF EXISTS delta;")
+        conn.commit()
+
+
+def apply_deletes(conn, source, spec, batch_size=10000):
+    """
+    Delete the rows listed in a deletes file, along with the rows of the
+    dependent tables referencing them. Returns the number of rows deleted
+    from the target table.
+    """
+    keys = [line.split(b'\t', 1)[0].strip() for line in source.read().splitlines()]
+    keys = [int(k) for k in keys if k.isdigit()]
+    cur = conn.cursor()
+    deleted = 0
+    for i in range(0, len(keys), batch_size):
+        batch = keys[i:i + batch_size]
+        for dependent in spec.get('dependents', []):
+            cur.execute(sql.SQL("DELETE FROM {} WHERE {} = ANY(%s);").format(
+                table_identifier(dependent['table']), sql.Identifier(dependent['column'])), (batch,))
+        cur.execute(sql.SQL("DELETE FROM {} WHERE {} = ANY(%s);").format(
+            table_identifier(spec['table']), sql.Identifier(spec['key'])), (batch,))
+        deleted += cur.rowcount
+        conn.commit()
+    return deleted
+
+
+def apply_day(conn, cache, updates, date):
+    for spec in updates:
+        if spec.get('modifications'):
+            url = spec['modifications'].format(date=date.isoformat())
+            with cache.open(url) as source:
+                count = apply_modifications(conn, source, spec)
+            print(f"Applied {count} modification(s) to {spec['table']} from {url}", flush=True)
+    for spec in reversed(updates):
+        if spec.get('deletes'):
+            url = spec['deletes'].format(date=date.isoformat())
+            with cache.open(url) as source:
+                count = apply_deletes(conn, source, spec)
+            print(f"Applied {count} delete(s) to {spec['table']} from {url}", flush=True)
+
+
+def main():
+    yesterday = datetime.date.today() - datetime.timedelta(days=1)
+    parser = argparse.ArgumentParser(description="Apply the daily delta files published since the last update of a layer.")
+    parser.add_argument('layer', help="Layer name in metadata.json")
+    parser.add_argument('--metadata', default='metadata.json')
+    parser.add_argument('--since', default=os.environ.get('PG_BASELAYERS_LAST_UPDATE'),
+                        help="Date of the last update (YYYY-MM-DD)")
+    parser.add_argument('--until', default=yesterday.isoformat(),
+                        help="Date of the last delta files to apply (YYYY-MM-DD), yesterday by default")
+    args = parser.parse_args()
+
+    if not args.since:
+        print("The date of the last update is unknown. Reinstall the layer instead.", file=sys.stderr)
+        return 1
+
+    with open(args.metadata) as f:
+        metadata = json.load(f)
+    try:
+        updates = find_updates(metadata, args.layer)
+    except UpdateError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    # Update the live tables, in case a schema is set for the makefile.
+    schema = os.environ.get('PG_BASELAYERS_SCHEMA')
+    if schema:
+        updates = [dict(spec, table=relocate(spec['table'], metadata['name'], schema),
+                        dependents=[dict(d, table=relocate(d['table'], metadata['name'], schema))
+                                    for d in spec.get('dependents', [])])
+                   for spec in updates]
+
+    dates = pending_dates(parse_date(args.since), parse_date(args.until))
+    if not dates:
+        print(f"Already up to date with {args.since}.", flush=True)
+        return 0
+
+    cache = DownloadCache(os.environ['PG_BASELAYERS_DOWNLOAD_CACHE_DIR'],
+                          int(os.environ.get('PG_BASELAYERS_DOWNLOAD_CACHE_SIZE', '0')) * 1024 * 1024,
+                          log=lambda msg: print(msg, flush=True),
+                          mirror=os.environ.get('PG_BASELAYERS_DOWNLOAD_MIRROR'))
+    slots = slots_from_env('import')
+
+    conn = psycopg2.connect(os.environ['POSTGRES_URI'])
+    try:
+        with contextlib.ExitStack() as stack:
+            if slots is not None:
+                stack.enter_context(slots.acquire())
+            for i, date in enumerate(dates):
+                print(f"STATUS=Updating ({i + 1}/{len(dates)})", flush=True)
+                apply_day(conn, cache, updates, date)
+                print(f"UPDATED={date.isoformat()}", flush=True)
+    except DownloadError as e:
+        print(f"Update failed: {e}. The delta files may no longer be available, in which case the layer has to be reinstalled.", file=sys.stderr)
+        return 1
+    except psycopg2.Error as e:
+        print(f"Update failed: {e}", file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
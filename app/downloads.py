@@ -0,0 +1,500 @@
+#!/usr/bin/env python3
+"""
+Persistent download cache for dataset source files.
+
+Files are stored content-addressed (by sha256) in an `objects` directory,
+with an index that maps each URL to its object along with the ETag and
+Last-Modified headers that the server returned. A subsequent fetch of the
+same URL sends a conditional request, and if the server replies with
+'304 Not Modified' the cached copy is used. The least recently used objects
+are evicted when the cache grows beyond its size limit.
+
+A download that is interrupted is kept as a partial download, provided that
+the server identified the file with a strong ETag or a Last-Modified date.
+The next fetch of the same URL asks for the rest of it only (a Range request
+with If-Range), and starts over if the file has changed in the meantime.
+
+The makefiles use this through the PG_BASELAYERS_FETCH environment variable
+that run_task passes to make, which runs this file as a script:
+
+    $(PG_BASELAYERS_FETCH) http://example.com/file.zip [-O file.zip] [--sha256 <digest>]
+
+When that variable is not defined the makefiles fall back to plain wget.
+With --sha256 a download that turns out to have another checksum fails and
+isn't cached, and a cached copy with another checksum is downloaded again.
+
+With PG_BASELAYERS_DOWNLOAD_MIRROR set, files are downloaded from a mirror
+instead, which has them at <mirror>/<host>/<path> (see benchmark.py). They
+are cached under their original URL.
+"""
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import argparse
+import tempfile
+import contextlib
+import urllib.parse
+import urllib.request
+import urllib.error
+import http.client
+
+from locks import slots_from_env
+
+CHUNK_SIZE = 1024 * 1024
+
+# Partial downloads that haven't been resumed for this long are removed.
+PARTIAL_MAX_AGE = 7 * 24 * 3600
+
+
+class DownloadError(Exception):
+    pass
+
+
+class TeeReader(object):
+    """
+    File-like object that copies everything read from `source` into the
+    file `f`, keeping track of the size and sha256 of the data.
+    """
+    def __init__(self, source, f):
+        self.source = source
+        self.f = f
+        self.sha = hashlib.sha256()
+        self.size = 0
+        self.complete = False
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        if data:
+            self.f.write(data)
+            self.sha.update(data)
+            self.size += len(data)
+        elif size != 0:
+            self.complete = True
+        return data
+
+
+def filename_from_url(url):
+    name = os.path.basename(urllib.parse.urlparse(url).path)
+    return name or 'index.html'
+
+
+class DownloadCache(object):
+    """
+    A download cache in `cache_dir`, limited to `max_size` bytes. A
+    `max_size` of 0 disables caching altogether and every fetch goes
+    straight to the destination file.
+    """
+    def __init__(self, cache_dir, max_size, timeout=60, log=print, mirror=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.timeout = timeout
+        self.log = log
+        self.mirror = mirror
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.tmp_dir = os.path.join(cache_dir, 'tmp')
+        self.index_file = os.path.join(cache_dir, 'index.json')
+        self.lock_file = os.path.join(cache_dir, 'index.lock')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    @contextlib.contextmanager
+    def _locked_index(self):
+        """
+        Context manager yielding the index dict while holding an exclusive
+        lock on it, so that several workers can share the cache. The index
+        is written back when the block exits.
+        """
+        with open(self.lock_file, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                index = self._read_index()
+                yield index
+                self._write_index(index)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self, index):
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix='index-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp, self.index_file)
+
+    def _source(self, url):
+        """
+        The URL to actually download `url` from.
+        """
+        if not self.mirror:
+            return url
+        parts = urllib.parse.urlsplit(url)
+        source = f"{self.mirror.rstrip('/')}/{parts.netloc}{parts.path}"
+        return f"{source}?{parts.query}" if parts.query else source
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest)
+
+    def _cached_entry(self, url):
+        with self._locked_index() as index:
+            entry = index.get(url)
+            if entry and not os.path.exists(self._object_path(entry['sha256'])):
+                del index[url]
+                entry = None
+            return entry
+
+    def _link(self, src, dest):
+        """
+        Hardlink a cached object to its destination, falling back to a copy
+        when the two are on different filesystems.
+        """
+        if dest is None:
+            return
+        if os.path.exists(dest):
+            os.remove(dest)
+        try:
+            os.link(src, dest)
+        except OSError:
+            shutil.copyfile(src, dest)
+
+    def _partial_path(self, url):
+        return os.path.join(self.tmp_dir, hashlib.sha256(url.encode()).hexdigest() + '.part')
+
+    @contextlib.contextmanager
+    def _partial(self, path):
+        """
+        Context manager holding an exclusive lock on the partial download
+        `path` while it's being downloaded into, so that a second fetch of
+        the same URL waits for the first one. Afterwards only what can be
+        resumed is left behind.
+        """
+        while True:
+            f = open(path, 'ab')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # Start over if the file was moved away while we were waiting.
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            f.close()
+        try:
+            yield path
+        finally:
+            if os.path.exists(path) and not os.path.exists(path + '.json'):
+                os.remove(path)
+            f.close()
+
+    def _resume_headers(self, path):
+        """
+        Request headers asking for the rest of the partial download `path`,
+        if there is one that can be resumed.
+        """
+        try:
+            size = os.path.getsize(path)
+            with open(path + '.json') as f:
+                validator = json.load(f)['validator']
+        except (OSError, ValueError, KeyError):
+            return {}
+        if not size:
+            return {}
+        return {'Range': f'bytes={size}-', 'If-Range': validator}
+
+    def _forget_partial(self, path):
+        if os.path.exists(path + '.json'):
+            os.remove(path + '.json')
+        if os.path.exists(path):
+            os.truncate(path, 0)
+
+    def _download(self, response, path):
+        """
+        Write the body of `response` to `path`, or append it when it's the
+        rest of a partial download. Returns the sha256 and size of the
+        complete file.
+        """
+        sha = hashlib.sha256()
+        size = 0
+        if response.status == 206:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    sha.update(chunk)
+                    size += len(chunk)
+            content_range = response.headers.get('Content-Range', '')
+            if not content_range.startswith(f"bytes {size}-"):
+                self._forget_partial(path)
+                raise DownloadError(f"Unexpected Content-Range '{content_range}' when resuming at {size} bytes")
+            self.log(f"Resuming partial download at {size} bytes")
+            mode = 'ab'
+        else:
+            # Remember what to resume this download with should it get
+            # interrupted. If-Range requires a strong ETag.
+            etag = response.headers.get('ETag')
+            validator = etag if etag and not etag.startswith('W/') else response.headers.get('Last-Modified')
+            if validator:
+                with open(path + '.json', 'w') as f:
+                    json.dump({'url': response.geturl(), 'validator': validator}, f)
+            elif os.path.exists(path + '.json'):
+                os.remove(path + '.json')
+            mode = 'wb'
+
+        received = 0
+        with open(path, mode) as f:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha.update(chunk)
+                f.write(chunk)
+                received += len(chunk)
+        # The connection may be closed halfway without an error.
+        expected = response.headers.get('Content-Length')
+        if expected and expected.isdigit() and int(expected) != received:
+            raise DownloadError(f"Download of {response.geturl()} was interrupted after {size + received} bytes")
+        return sha.hexdigest(), size + received
+
+    def _request(self, url, partial=None, cached=True):
+        """
+        Send a (conditional) request for `url`. Returns a tuple (state,
+        entry, response) where state is 'hit' or 'stale' when the cached
+        entry should be used, or 'miss' with the response to download. The
+        response holds only the rest of the file when there's a `partial`
+        download of it to resume.
+        """
+        entry = self._cached_entry(url) if cached else None
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        if partial:
+            headers.update(self._resume_headers(partial))
+
+        request = urllib.request.Request(self._source(url), headers=headers)
+        try:
+            return 'miss', entry, urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and entry:
+                self.log(f"Download cache HIT: {url} ({entry['size']} bytes, sha256 {entry['sha256'][:12]})")
+                return 'hit', entry, None
+            if e.code == 416 and 'Range' in headers:
+                self.log(f"Partial download of {url} can't be resumed, starting over")
+                self._forget_partial(partial)
+                return self._request(url, partial, cached)
+            raise DownloadError(f"Download of {url} failed: HTTP {e.code} {e.reason}")
+        except (urllib.error.URLError, OSError) as e:
+            if entry:
+                self.log(f"Download cache STALE: {url} could not be checked ({e}), using cached copy")
+                return 'stale', entry, None
+            raise DownloadError(f"Download of {url} failed: {e}")
+
+    def _store(self, url, response, tmp, digest, size):
+        """
+        Move a completely downloaded temporary file into the cache and add
+        it to the index.
+        """
+        obj = self._object_path(digest)
+        if os.path.exists(obj):
+            os.remove(tmp)
+        else:
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, obj)
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        entry = {'sha256': digest, 'size': size, 'etag': etag,
+                 'last_modified': last_modified, 'last_used': time.time()}
+        if not etag and not last_modified:
+            self.log(f"Server sent no ETag or Last-Modified for {url}, it will be downloaded again next time")
+        with self._locked_index() as index:
+            index[url] = entry
+        return entry
+
+    def _verify(self, url, digest, sha256, partial):
+        if sha256 and digest != sha256.lower():
+            self._forget_partial(partial)
+            raise DownloadError(f"Download of {url} has sha256 {digest}, expected {sha256}")
+
+    def fetch(self, url, dest=None, sha256=None):
+        """
+        Fetch `url` into the file `dest`, using the cached copy when it is
+        still current. Returns 'hit', 'miss' or 'stale' (a cached copy was
+        used because the server could not be reached). Without `dest` the
+        file is only stored in the cache. With `sha256` the file must have
+        that checksum.
+        """
+        if self.max_size <= 0:
+            if dest is None:
+                self.log(f"Download cache disabled, not prefetching {url}")
+                return 'miss'
+            self.log(f"Download cache disabled, downloading {url}")
+            with self._partial(dest + '.part') as partial:
+                _, _, response = self._request(url, partial, cached=False)
+                try:
+                    with response:
+                        digest, _ = self._download(response, partial)
+                except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+                    raise DownloadError(f"Download of {url} failed: {e}")
+                self._verify(url, digest, sha256, partial)
+                os.replace(partial, dest)
+                self._forget_partial(partial)
+            return 'miss'
+
+        with self._partial(self._partial_path(url)) as partial:
+            state, entry, response = self._request(url, partial)
+            if state != 'miss' and sha256 and entry['sha256'] != sha256.lower():
+                self.log(f"Cached copy of {url} has sha256 {entry['sha256']}, expected {sha256}")
+                state, entry, response = self._request(url, partial, cached=False)
+            if state != 'miss':
+                self._use(url, entry, dest)
+                return state
+
+            with response:
+                self.log(f"Download cache MISS: {url}, downloading...")
+                started = time.time()
+                try:
+                    digest, size = self._download(response, partial)
+                except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+                    raise DownloadError(f"Download of {url} failed: {e}")
+                self.log(f"Downloaded {size} bytes in {time.time() - started:.1f}s")
+                self._verify(url, digest, sha256, partial)
+                entry = self._store(url, response, partial, digest, size)
+                self._forget_partial(partial)
+
+        self._link(self._object_path(entry['sha256']), dest)
+        self.evict()
+        return 'miss'
+
+    @contextlib.contextmanager
+    def open(self, url):
+        """
+        Context manager yielding a binary file object to read the contents
+        of `url` from. A current cached copy is read from disk; otherwise
+        the response is read directly from the server and stored in the
+        cache as it is read, so the data is never staged on disk first.
+        The copy is only added to the cache if it was read completely.
+        """
+        if self.max_size <= 0:
+            try:
+                response = urllib.request.urlopen(self._source(url), timeout=self.timeout)
+            except (urllib.error.URLError, OSError) as e:
+                raise DownloadError(f"Download of {url} failed: {e}")
+            with response:
+                yield response
+            return
+
+        state, entry, response = self._request(url)
+        if state != 'miss':
+            self._use(url, entry, None)
+            with open(self._object_path(entry['sha256']), 'rb') as f:
+                yield f
+            return
+
+        self.log(f"Download cache MISS: {url}, streaming...")
+        fd, tmp = tempfile.mkstemp(dir=self.tmp_dir, prefix='download-')
+        try:
+            with response, os.fdopen(fd, 'wb') as f:
+                tee = TeeReader(response, f)
+                yield tee
+            if tee.complete:
+                self._store(url, response, tmp, tee.sha.hexdigest(), tee.size)
+                self.evict()
+            else:
+                os.remove(tmp)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def _use(self, url, entry, dest):
+        self._link(self._object_path(entry['sha256']), dest)
+        with self._locked_index() as index:
+            if url in index:
+                index[url]['last_used'] = time.time()
+
+    def evict(self):
+        """
+        Remove least recently used objects until the cache is within its
+        size limit. Objects shared by several URLs are only removed when
+        none of those URLs are left.
+        """
+        with self._locked_index() as index:
+            objects = {}
+            for url, entry in index.items():
+                obj = objects.setdefault(entry['sha256'], {'size': entry['size'], 'last_used': 0, 'urls': []})
+                obj['last_used'] = max(obj['last_used'], entry['last_used'])
+                obj['urls'].append(url)
+
+            total = sum(o['size'] for o in objects.values())
+            for digest, obj in sorted(objects.items(), key=lambda o: o[1]['last_used']):
+                if total <= self.max_size:
+                    break
+                self.log(f"Download cache evicting {', '.join(obj['urls'])} ({obj['size']} bytes)")
+                for url in obj['urls']:
+                    del index[url]
+                path = self._object_path(digest)
+                if os.path.exists(path):
+                    os.remove(path)
+                total -= obj['size']
+
+        # Partial downloads are only worth keeping for a while.
+        for name in os.listdir(self.tmp_dir):
+            path = os.path.join(self.tmp_dir, name)
+            if name.endswith('.part') and time.time() - os.path.getmtime(path) > PARTIAL_MAX_AGE:
+                self.log(f"Download cache removing stale partial download {name}")
+                with self._partial(path):
+                    self._forget_partial(path)
+
+    def stats(self):
+        index = self._read_index()
+        return {'entries': len(index),
+                'size': sum(e['size'] for e in {e['sha256']: e for e in index.values()}.values()),
+                'max_size': self.max_size}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download a file through the PostGIS Baselayers download cache.")
+    subparsers = parser.add_subparsers(dest='command')
+    fetch = subparsers.add_parser('fetch')
+    fetch.add_argument('url')
+    fetch.add_argument('-O', dest='output', default=None, help="Output filename (defaults to the last part of the url)")
+    fetch.add_argument('--sha256', default=None, help="Expected sha256 of the file")
+    args = parser.parse_args()
+
+    if args.command != 'fetch':
+        parser.print_help()
+        return 2
+
+    cache_dir = os.environ.get('PG_BASELAYERS_DOWNLOAD_CACHE_DIR')
+    if not cache_dir:
+        print("PG_BASELAYERS_DOWNLOAD_CACHE_DIR is not defined", file=sys.stderr)
+        return 2
+    max_size = int(os.environ.get('PG_BASELAYERS_DOWNLOAD_CACHE_SIZE', '0')) * 1024 * 1024
+
+    cache = DownloadCache(cache_dir, max_size, log=lambda msg: print(msg, flush=True),
+                          mirror=os.environ.get('PG_BASELAYERS_DOWNLOAD_MIRROR'))
+    slots = slots_from_env('download')
+    try:
+        if slots is None:
+            cache.fetch(args.url, args.output or filename_from_url(args.url), args.sha256)
+        else:
+            def waiting(slots):
+                print(f"Waiting for a free download slot ({slots.limit} in use)...", flush=True)
+            with slots.acquire(on_wait=waiting):
+                cache.fetch(args.url, args.output or filename_from_url(args.url), args.sha256)
+    except DownloadError as e:
+        print(e, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
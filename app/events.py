@@ -0,0 +1,102 @@
+"""
+Live layer status for the web application, pushed by PostgreSQL.
+
+A trigger on postgis_baselayers.layer sends a NOTIFY on the
+'postgis_baselayers_status' channel whenever the status or info of a layer
+changes. Each web process runs a single StatusFeed, which LISTENs on that
+channel over a dedicated connection and keeps the latest change of every
+layer. Browsers wait on the feed (see the /events endpoint) rather than on
+the database, so the load on the database doesn't grow with the number of
+open pages.
+
+Every change gets a sequence number, and clients ask for the changes after
+the last one they've seen. Sequence numbers are only meaningful within the
+feed that handed them out, which is identified by `id`. Changes of the same
+layer are coalesced, so a slow client only gets the latest status of each
+layer. When the listening connection is lost notifications may have been
+missed, which is published as a change with "reload": true.
+"""
+import json
+import uuid
+import time
+import select
+import threading
+
+import psycopg2
+
+CHANNEL = 'postgis_baselayers_status'
+
+
+class StatusFeed(object):
+    def __init__(self, connect, channel=CHANNEL, poll=15, retry=5, log=print):
+        self.connect = connect
+        self.channel = channel
+        self.poll = poll
+        self.retry = retry
+        self.log = log
+        self.id = uuid.uuid4().hex[:8]
+        self.seq = 0
+        self._changes = {}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='status-feed', daemon=True)
+                self._thread.start()
+        return self
+
+    def _run(self):
+        connected_before = False
+        while True:
+            conn = None
+            try:
+                conn = self.connect()
+                conn.autocommit = True
+                conn.cursor().execute(f"LISTEN {self.channel};")
+                if connected_before:
+                    self.publish({'key': None, 'reload': True})
+                connected_before = True
+                while True:
+                    if select.select([conn], [], [], self.poll) == ([], [], []):
+                        # Nothing happened for a while; make sure the
+                        # connection is still alive.
+                        conn.cursor().execute("SELECT 1;")
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            self.publish(json.loads(notify.payload))
+                        except ValueError:
+                            self.log(f"Ignoring invalid status notification: {notify.payload}")
+            except (psycopg2.Error, OSError) as e:
+                self.log(f"Status feed lost its connection ({e}), retrying in {self.retry}s...")
+            finally:
+                if conn is not None:
+                    conn.close()
+            time.sleep(self.retry)
+
+    def publish(self, change):
+        with self._cond:
+            self.seq += 1
+            self._changes[change.get('key')] = (self.seq, change)
+            self._cond.notify_all()
+
+    def changes(self, since):
+        """
+        Returns a list of (seq, change) tuples of the layers that changed
+        after `since`, in order.
+        """
+        with self._cond:
+            return sorted(c for c in self._changes.values() if c[0] > since)
+
+    def wait(self, since, timeout):
+        """
+        Wait at most `timeout` seconds for changes after `since`, and return
+        them as in changes().
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self.seq > since, timeout)
+        return self.changes(since)
@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+"""
+Streaming import of delimited text files into PostgreSQL.
+
+Data is streamed from a URL (through the download cache, see downloads.py),
+optionally out of a member of a zip archive, straight into COPY ... FROM
+STDIN. Nothing is staged on disk except the copy kept by the download cache,
+and the import starts while the download is still running. The download
+runs in a separate thread that hands chunks over through a bounded queue,
+so that no more than `buffers` chunks are waiting to be imported however
+far the download is ahead of the import.
+
+Imports are declared per layer in metadata.json:
+
+    "imports": [
+        {
+            "name": "geoname",
+            "url": "http://download.geonames.org/export/dump/allCountries.zip",
+            "member": "allCountries.txt",
+            "table": "geonames.geoname",
+            "columns": ["geonameid", "name", ...],
+            "options": "null as ''"
+        }
+    ]
+
+and run from the makefile, which run_task starts in a directory containing
+a copy of metadata.json, with:
+
+    $(PG_BASELAYERS_STREAM_IMPORT) <layer> <name>
+
+Progress is reported on stdout as STATUS= lines, which run_task shows as
+the status of the layer.
+
+Large tables can be loaded over several connections at once by adding
+"parallel": true to the import. The data is then split into chunks on line
+boundaries which are loaded concurrently into an UNLOGGED staging table,
+which replaces the target table once everything has been loaded. The number
+of connections and the chunk size are set with PG_BASELAYERS_LOADER_WORKERS
+and PG_BASELAYERS_LOADER_CHUNK_SIZE (in MB).
+"""
+import io
+import os
+import sys
+import json
+import time
+import zlib
+import queue
+import struct
+import argparse
+import threading
+import contextlib
+
+import psycopg2
+from psycopg2 import sql
+
+from locks import slots_from_env
+from downloads import DownloadCache, DownloadError
+from postinstall import table_identifier, relocate
+
+CHUNK_SIZE = 1024 * 1024
+
+ZIP_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+ZIP_LOCAL_SIGNATURE = 0x04034b50
+
+
+class StreamImportError(Exception):
+    pass
+
+
+class BoundedStream(object):
+    """
+    File-like object reading from `source` in a background thread. At most
+    `buffers` chunks of `chunk_size` bytes are waiting in the queue, besides
+    the data of the read in progress.
+    """
+    def __init__(self, source, buffers=16, chunk_size=CHUNK_SIZE):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(maxsize=buffers)
+        self.buffer = b''
+        self.eof = False
+        self.error = None
+        self.stopped = False
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+
+    def _produce(self):
+        try:
+            while not self.stopped:
+                chunk = self.source.read(self.chunk_size)
+                self._put(chunk)
+                if not chunk:
+                    return
+        except Exception as e:
+            self.error = e
+            self._put(b'')
+
+    def _put(self, chunk):
+        while not self.stopped:
+            try:
+                self.queue.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def read(self, size=-1):
+        # Collect the chunks and join them once, as appending them one by one
+        # copies the buffer again for every chunk.
+        parts = [self.buffer]
+        length = len(self.buffer)
+        while not self.eof and (size < 0 or length < size):
+            chunk = self.queue.get()
+            if not chunk:
+                self.eof = True
+                if self.error:
+                    raise self.error
+            parts.append(chunk)
+            length += len(chunk)
+        data = b''.join(parts)
+        if size < 0 or length <= size:
+            self.buffer = b''
+            return data
+        data, self.buffer = data[:size], data[size:]
+        return data
+
+    def close(self):
+        self.stopped = True
+
+
+class ZipMemberStream(object):
+    """
+    File-like object with the decompressed contents of the zip archive
+    member called `member`, read sequentially from the non-seekable stream
+    `source` using the local file headers. Only stored and deflated members
+    are supported.
+    """
+    def __init__(self, source, member):
+        self.source = source
+        self.member = member
+        self.decompressor = None
+        self.remaining = None
+        self.done = False
+        self.pending = b''
+        self._find_member()
+
+    def _read_exact(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.source.read(size - len(data))
+            if not chunk:
+                raise StreamImportError("Unexpected end of zip archive")
+            data += chunk
+        return data
+
+    def _find_member(self):
+        while True:
+            header = self.source.read(ZIP_LOCAL_HEADER.size)
+            if len(header) < ZIP_LOCAL_HEADER.size or \
+               struct.unpack('<I', header[:4])[0] != ZIP_LOCAL_SIGNATURE:
+                raise StreamImportError(f"Member '{self.member}' not found in zip archive")
+            (_, _, flags, method, _, _, _, compressed_size, _,
+             name_length, extra_length) = ZIP_LOCAL_HEADER.unpack(header)
+            name = self._read_exact(name_length).decode('utf-8', 'replace')
+            extra = self._read_exact(extra_length)
+            if compressed_size == 0xFFFFFFFF:
+                compressed_size = self._zip64_size(extra)
+            if method not in (0, 8):
+                raise StreamImportError(f"Unsupported compression method {method} for '{name}'")
+            if flags & 0x08 and method == 0:
+                raise StreamImportError(f"Can't stream stored member '{name}' without known size")
+
+            if name == self.member:
+                self.decompressor = zlib.decompressobj(-15) if method == 8 else None
+                self.remaining = None if flags & 0x08 else compressed_size
+                return
+
+            # Skip this member, decompressing it when its size isn't known.
+            if flags & 0x08:
+                d = zlib.decompressobj(-15)
+                while not d.eof:
+                    chunk = self.source.read(CHUNK_SIZE)
+                    if not chunk:
+                        raise StreamImportError("Unexpected end of zip archive")
+                    d.decompress(chunk)
+                # Skip the data descriptor (crc and sizes, optionally 
+                # preceded by a signature) that follows the data.
+                leftover = d.unused_data
+                if len(leftover) < 16:
+                    leftover += self._read_exact(16 - len(leftover))
+                if struct.unpack('<I', leftover[:4])[0] == 0x08074b50:
+                    leftover = leftover[16:]
+                else:
+                    leftover = leftover[12:]
+                self.source = _Prepend(leftover, self.source)
+            else:
+                while compressed_size > 0:
+                    skipped = self.source.read(min(CHUNK_SIZE, compressed_size))
+                    if not skipped:
+                        raise StreamImportError("Unexpected end of zip archive")
+                    compressed_size -= len(skipped)
+
+    def _zip64_size(self, extra):
+        while len(extra) >= 4:
+            tag, size = struct.unpack('<HH', extra[:4])
+            if tag == 0x0001:
+                return struct.unpack('<QQ', extra[4:20])[1]
+            extra = extra[4 + size:]
+        raise StreamImportError("Missing zip64 extra field")
+
+    def read(self, size=-1):
+        size = CHUNK_SIZE if size is None or size < 0 else size
+        parts = [self.pending]
+        length = len(self.pending)
+        while length < size and not self.done:
+            # Decompress at most a chunk at a time, so that a well compressed
+            # member doesn't inflate into memory all at once.
+            if self.decompressor is not None and self.decompressor.unconsumed_tail:
+                chunk = self.decompressor.unconsumed_tail
+            else:
+                want = CHUNK_SIZE if self.remaining is None else min(CHUNK_SIZE, self.remaining)
+                chunk = self.source.read(want) if want else b''
+                if self.remaining is not None:
+                    self.remaining -= len(chunk)
+                    if not chunk and self.remaining > 0:
+                        raise StreamImportError("Unexpected end of zip archive")
+            if self.decompressor is None:
+                data = chunk
+                self.done = self.remaining == 0
+            else:
+                data = self.decompressor.decompress(chunk, CHUNK_SIZE)
+                if self.decompressor.eof or (self.remaining == 0 and not self.decompressor.unconsumed_tail):
+                    data += self.decompressor.flush()
+                    self.done = True
+                elif not chunk:
+                    raise StreamImportError("Unexpected end of zip archive")
+            parts.append(data)
+            length += len(data)
+        data = b''.join(parts)
+        data, self.pending = data[:size], data[size:]
+        return data
+
+
+class _Prepend(object):
+    def __init__(self, data, source):
+        self.data = data
+        self.source = source
+
+    def read(self, size=-1):
+        if self.data:
+            if size < 0:
+                data, self.data = self.data + self.source.read(), b''
+                return data
+            data, self.data = self.data[:size], self.data[size:]
+            return data
+        return self.source.read(size)
+
+
+class ProgressReader(object):
+    """
+    File-like object counting the bytes and lines read from `source`, and
+    printing a STATUS= line with the progress at most every `interval`
+    seconds.
+    """
+    def __init__(self, source, label, interval=5):
+        self.source = source
+        self.label = label
+        self.interval = interval
+        self.bytes = 0
+        self.rows = 0
+        self.started = time.time()
+        self.reported = 0
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.bytes += len(data)
+        self.rows += data.count(b'\n')
+        if time.time() - self.reported >= self.interval:
+            self.report()
+        return data
+
+    def report(self):
+        self.reported = time.time()
+        print(f"STATUS=Importing {self.label}: {self.bytes / 1024 / 1024:.0f} MB, {self.rows} rows", flush=True)
+
+    def summary(self):
+        elapsed = max(time.time() - self.started, 0.001)
+        return f"Imported {self.rows} rows ({self.bytes} bytes) into {self.label} in {elapsed:.1f}s ({self.rows / elapsed:.0f} rows/s)"
+
+
+def copy_statement(table, columns, options=''):
+    statement = sql.SQL("COPY {} ({}) FROM STDIN").format(table_identifier(table), sql.SQL(',').join(map(sql.Identifier, columns)))
+    if options:
+        statement = statement + sql.SQL(' ' + options)
+    return statement
+
+
+def iter_line_chunks(source, chunk_size):
+    """
+    Read `source` in chunks of about `chunk_size` bytes that end on a line
+    boundary.
+    """
+    rest = b''
+    while True:
+        data = source.read(chunk_size)
+        if not data:
+            if rest:
+                yield rest
+            return
+        data = rest + data
+        cut = data.rfind(b'\n') + 1
+        if cut == 0:
+            rest = data
+            continue
+        yield data[:cut]
+        rest = data[cut:]
+
+
+def parallel_copy(connect, source, spec, workers=4, chunk_size=64 * CHUNK_SIZE):
+    """
+    Split `source` into chunks on line boundaries and COPY these over 
+    `workers` connections into an UNLOGGED staging table. When all chunks
+    have been loaded the staging table is made LOGGED and swapped in place
+    of the target table in a single transaction.
+    """
+    if 'header' in spec.get('options', '').lower():
+        raise StreamImportError("Parallel imports don't support files with a header")
+
+    schema, _, name = spec['table'].rpartition('.')
+    target = table_identifier(spec['table'])
+    staging_name = f"{name}_staging"
+    staging = table_identifier(f"{schema}.{staging_name}" if schema else staging_name)
+
+    conn = connect()
+    try:
+        cur = conn.cursor()
+        cur.execute(sql.SQL("DROP TABLE IF EXISTS {staging}; CREATE UNLOGGED TABLE {staging} (LIKE {target} INCLUDING ALL);").format(staging=staging, target=target))
+        conn.commit()
+
+        statement = copy_statement(f"{schema}.{staging_name}" if schema else staging_name, spec['columns'], spec.get('options', ''))
+        chunks = queue.Queue(maxsize=workers * 2)
+        errors = []
+        output = threading.Lock()
+
+        def worker():
+            worker_conn = None
+            try:
+                worker_conn = connect()
+                copy_sql = statement.as_string(worker_conn)
+                while True:
+                    item = chunks.get()
+                    if item is None:
+                        return
+                    if errors:
+                        continue
+                    n, data = item
+                    started = time.time()
+                    worker_conn.cursor().copy_expert(copy_sql, io.BytesIO(data), size=CHUNK_SIZE)
+                    worker_conn.commit()
+                    elapsed = max(time.time() - started, 0.001)
+                    rows = data.count(b'\n')
+                    with output:
+                        print(f"Chunk {n}: {rows} rows ({len(data)} bytes) in {elapsed:.1f}s ({rows / elapsed:.0f} rows/s)", flush=True)
+            except Exception as e:
+                errors.append(e)
+                # Keep taking chunks off the queue so the reader doesn't block
+                while chunks.get() is not None:
+                    pass
+            finally:
+                if worker_conn is not None:
+                    worker_conn.close()
+
+        try:
+            threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+            for thread in threads:
+                thread.start()
+            try:
+                for n, chunk in enumerate(iter_line_chunks(source, chunk_size)):
+                    if errors:
+                        break
+                    chunks.put((n, chunk))
+            finally:
+                for thread in threads:
+                    chunks.put(None)
+                for thread in threads:
+                    thread.join()
+
+            if errors:
+                raise errors[0]
+
+            with output:
+                print(f"STATUS=Finalizing {spec['table']}", flush=True)
+            cur.execute(sql.SQL("ALTER TABLE {} SET LOGGED;").format(staging))
+            cur.execute(sql.SQL("DROP TABLE {};").format(target))
+            cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {};").format(staging, sql.Identifier(name)))
+            conn.commit()
+        except BaseException:
+            # Whatever went wrong, from reading the source to the swap, don't
+            # leave the staging table behind.
+            conn.rollback()
+            cur.execute(sql.SQL("DROP TABLE IF EXISTS {};").format(staging))
+            conn.commit()
+            raise
+    finally:
+        conn.close()
+
+
+def stream_import(conn, source, spec, buffers=16, connect=None, workers=1, chunk_size=64 * CHUNK_SIZE):
+    """
+    Stream the file-like object `source` into the table described by the
+    import `spec`. Imports marked as "parallel" are loaded with 
+    parallel_copy() when more than one worker is configured. Returns the 
+    ProgressReader with the totals.
+    """
+    stream = BoundedStream(source, buffers=buffers)
+    try:
+        data = ZipMemberStream(stream, spec['member']) if spec.get('member') else stream
+        progress = ProgressReader(data, spec['table'])
+        if spec.get('parallel') and connect and workers > 1:
+            parallel_copy(connect, progress, spec, workers, chunk_size)
+        else:
+            cur = conn.cursor()
+            cur.copy_expert(copy_statement(spec['table'], spec['columns'], spec.get('options', '')).as_string(conn), progress, size=CHUNK_SIZE)
+            conn.commit()
+
+        # Read the rest of the archive so that the download cache gets a 
+        # complete copy of it.
+        while stream.read(CHUNK_SIZE):
+            pass
+    finally:
+        stream.close()
+    progress.report()
+    print(progress.summary(), flush=True)
+    return progress
+
+
+def find_import(metadata, layer, name):
+    for entry in metadata['layers']:
+        if entry['name'] == layer:
+            for spec in entry.get('imports', []):
+                if spec['name'] == name:
+                    return spec
+    raise StreamImportError(f"No import '{name}' declared for layer '{layer}' in metadata.json")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream a file from a url into a PostgreSQL table.")
+    parser.add_argument('layer', help="Layer name in metadata.json")
+    parser.add_argument('name', help="Name of the import declared for the layer")
+    parser.add_argument('--metadata', default='metadata.json')
+    args = parser.parse_args()
+
+    with open(args.metadata) as f:
+        metadata = json.load(f)
+    spec = find_import(metadata, args.layer, args.name)
+
+    # Load into the shadow schema run_task installs the layer in, if any.
+    schema = os.environ.get('PG_BASELAYERS_SCHEMA')
+    if schema:
+        spec = dict(spec, table=relocate(spec['table'], metadata['name'], schema))
+
+    cache = DownloadCache(os.environ['PG_BASELAYERS_DOWNLOAD_CACHE_DIR'],
+                          int(os.environ.get('PG_BASELAYERS_DOWNLOAD_CACHE_SIZE', '0')) * 1024 * 1024,
+                          log=lambda msg: print(msg, flush=True),
+                          mirror=os.environ.get('PG_BASELAYERS_DOWNLOAD_MIRROR'))
+    buffers = int(os.environ.get('PG_BASELAYERS_STREAM_BUFFERS', '16'))
+    workers = int(os.environ.get('PG_BASELAYERS_LOADER_WORKERS', '1'))
+    chunk_size = int(os.environ.get('PG_BASELAYERS_LOADER_CHUNK_SIZE', '64')) * 1024 * 1024
+    slots = slots_from_env('import')
+
+    connect = lambda: psycopg2.connect(os.environ['POSTGRES_URI'])
+    conn = connect()
+    try:
+        with contextlib.ExitStack() as stack:
+            if slots is not None:
+                stack.enter_context(slots.acquire())
+            source = stack.enter_context(cache.open(spec['url']))
+            stream_import(conn, source, spec, buffers, connect, workers, chunk_size)
+    except (DownloadError, StreamImportError, psycopg2.Error) as e:
+        print(f"Import of {spec['url']} failed: {e}", file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Counting semaphores ("slots") shared between threads and processes.
+
+Each resource has a fixed number of slots, each backed by a lock file in
+the lock directory. Taking a slot means holding an exclusive flock() on one
+of those files, so slots are released automatically when a process dies.
+Because flock() locks belong to an open file description, separate threads
+in the same process also exclude each other.
+
+This is used by run_task to limit the number of tasks running per dataset
+and in total, and by the makefiles (through PG_BASELAYERS_IMPORT) and
+downloads.py to limit the number of concurrent imports and downloads:
+
+    $(PG_BASELAYERS_IMPORT) ogr2ogr -f PostgreSQL ...
+
+Those limit what runs on one machine. The task limits of run_task have to
+hold for all workers, on whichever machine they are, so DatabaseSlots keeps
+its slots as advisory locks in the database instead. They are held by the
+connection they were taken on, and released when it's closed or lost.
+"""
+import os
+import sys
+import time
+import fcntl
+import subprocess
+import contextlib
+
+
+class ResourceSlots(object):
+    def __init__(self, lock_dir, name, limit):
+        if limit < 1:
+            raise ValueError(f"Resource '{name}' needs at least one slot.")
+        self.lock_dir = lock_dir
+        self.name = name
+        self.limit = limit
+        os.makedirs(lock_dir, exist_ok=True)
+
+    def _try_acquire(self):
+        for i in range(self.limit):
+            path = os.path.join(self.lock_dir, f"{self.name}.{i}.lock")
+            f = open(path, 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return f
+            except BlockingIOError:
+                f.close()
+        return None
+
+    @contextlib.contextmanager
+    def acquire(self, poll=1.0, on_wait=None):
+        """
+        Context manager that blocks until a slot is free. The `on_wait`
+        callback is called once if we have to wait for it.
+        """
+        f = self._try_acquire()
+        if f is None and on_wait:
+            on_wait(self)
+        while f is None:
+            time.sleep(poll)
+            f = self._try_acquire()
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+
+class DatabaseSlots(object):
+    """
+    Slots like ResourceSlots, held as session advisory locks on `conn`,
+    which should be in autocommit mode.
+    """
+    def __init__(self, conn, name, limit):
+        if limit < 1:
+            raise ValueError(f"Resource '{name}' needs at least one slot.")
+        self.conn = conn
+        self.name = name
+        self.limit = limit
+
+    def _try_acquire(self):
+        cur = self.conn.cursor()
+        for i in range(self.limit):
+            cur.execute("SELECT pg_try_advisory_lock(hashtext(%s), %s);", (f"pg_baselayers:{self.name}", i))
+            if cur.fetchone()[0]:
+                return i
+        return None
+
+    @contextlib.contextmanager
+    def acquire(self, poll=1.0, on_wait=None):
+        """
+        Context manager that blocks until a slot is free. The `on_wait`
+        callback is called once if we have to wait for it.
+        """
+        slot = self._try_acquire()
+        if slot is None and on_wait:
+            on_wait(self)
+        while slot is None:
+            time.sleep(poll)
+            slot = self._try_acquire()
+        try:
+            yield
+        finally:
+            try:
+                cur = self.conn.cursor()
+                cur.execute("SELECT pg_advisory_unlock(hashtext(%s), %s);", (f"pg_baselayers:{self.name}", slot))
+            except Exception:
+                # The lock went with the connection.
+                pass
+
+
+def slots_from_env(name):
+    """
+    Returns the ResourceSlots for `name` as configured through the
+    environment by run_task, or None when running outside the app.
+    """
+    lock_dir = os.environ.get('PG_BASELAYERS_LOCK_DIR')
+    limit = os.environ.get(f"PG_BASELAYERS_MAX_{name.upper()}S")
+    if not lock_dir or not limit:
+        return None
+    return ResourceSlots(lock_dir, name, int(limit))
+
+
+def main():
+    # Usage: locks.py run <resource> -- <command> [args...]
+    if len(sys.argv) < 5 or sys.argv[1] != 'run' or sys.argv[3] != '--':
+        print("Usage: locks.py run <resource> -- <command> [args...]", file=sys.stderr)
+        return 2
+    resource, cmd = sys.argv[2], sys.argv[4:]
+    slots = slots_from_env(resource)
+    if slots is None:
+        return subprocess.call(cmd)
+    def waiting(slots):
+        print(f"Waiting for a free {slots.name} slot ({slots.limit} in use)...", flush=True)
+    with slots.acquire(on_wait=waiting):
+        return subprocess.call(cmd)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
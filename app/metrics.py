@@ -0,0 +1,63 @@
+"""
+Metrics in the Prometheus text exposition format, served on /metrics.
+
+Everything about tasks is kept in the database, so any web process can
+export it. The time taken to handle requests is kept in memory instead, in
+a Histogram per process, so with several web processes each one exports
+the requests it handled itself.
+"""
+import threading
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for (name, value) in labels.items()) + '}'
+
+
+def metric(name, kind, help, samples):
+    """
+    Returns the lines of a metric family with the given (labels, value)
+    samples, or (suffix, labels, value) for samples like _sum and _count.
+    """
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for sample in samples:
+        (suffix, labels, value) = sample if len(sample) == 3 else ('', *sample)
+        lines.append(f"{name}{suffix}{format_labels(labels)} {float(value):g}")
+    return lines
+
+
+class Histogram(object):
+    def __init__(self, name, help, labelnames, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = sorted(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self.lock:
+            (counts, count, total) = self.series.get(key, ([0] * len(self.buckets), 0, 0.0))
+            counts = [n + (value <= bound) for (n, bound) in zip(counts, self.buckets)]
+            self.series[key] = (counts, count + 1, total + value)
+
+    def render(self):
+        samples = []
+        with self.lock:
+            series = sorted(self.series.items())
+        for (key, (counts, count, total)) in series:
+            labels = dict(zip(self.labelnames, key))
+            for (bound, n) in zip(self.buckets, counts):
+                samples.append(('_bucket', dict(labels, le=f"{bound:g}"), n))
+            samples.append(('_bucket', dict(labels, le="+Inf"), count))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, count))
+        return metric(self.name, 'histogram', self.help, samples)
@@ -0,0 +1,253 @@
+import os
+import time
+import logging
+import threading
+
+import psycopg2
+import psycopg2.extensions
+
+logger = logging.getLogger(__name__)
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    A small thread-safe pool of psycopg2 connections.
+
+    Connections are checked for health when they are taken out of the pool,
+    and recycled (closed and replaced by a fresh one) after they have been
+    used `max_uses` times or have been open for longer than `max_age`
+    seconds. A value of 0 disables either of these limits.
+
+    The pool keeps track of the process id that created it, so that a pool
+    inherited through a fork (like gunicorn workers or the huey consumer
+    do) is discarded rather than sharing sockets between processes.
+    """
+    def __init__(self, connect, min_size=1, max_size=10, max_uses=0,
+                 max_age=0, timeout=30):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Invalid pool size: min={} max={}".format(min_size, max_size))
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_uses = max_uses
+        self.max_age = max_age
+        self.timeout = timeout
+
+        self._lock = threading.Condition()
+        self._pid = os.getpid()
+        self._idle = []         # list of connections ready for use
+        self._meta = {}         # id(conn) -> {'created': ts, 'uses': n}
+        self._in_use = set()    # id(conn) of checked out connections
+        self._opening = 0       # connections being opened outside the lock
+        self._inherited = set() # id(conn) of connections opened before a fork
+        self._orphans = []      # idle connections opened before a fork
+        self._stats = dict(created=0, closed=0, recycled=0, checkouts=0,
+                           waits=0, timeouts=0, failed_checks=0)
+
+    def _register(self, conn):
+        self._meta[id(conn)] = {'created': time.time(), 'uses': 0}
+        self._inherited.discard(id(conn))
+        self._stats['created'] += 1
+        return conn
+
+    def _discard(self, conn):
+        self._meta.pop(id(conn), None)
+        self._in_use.discard(id(conn))
+        self._stats['closed'] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _expired(self, conn):
+        meta = self._meta.get(id(conn))
+        if meta is None:
+            return True
+        if self.max_uses and meta['uses'] >= self.max_uses:
+            return True
+        if self.max_age and time.time() - meta['created'] >= self.max_age:
+            return True
+        return False
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1;")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _check_fork(self):
+        # Connections opened by a parent process must not be used by a child,
+        # so just forget about them without closing the parent's sockets.
+        # They're kept referenced, as psycopg2 ends the session when a
+        # connection is garbage collected.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._inherited |= set(self._meta)
+            self._orphans += self._idle
+            self._idle = []
+            self._meta = {}
+            self._in_use = set()
+            self._opening = 0
+
+    def getconn(self):
+        """
+        Take a connection out of the pool, opening a new one if there is
+        room. Blocks for up to `timeout` seconds when the pool is at
+        capacity, after which PoolExhausted is raised.
+
+        Connecting and the health check happen outside the lock, so that a
+        slow or unreachable server doesn't hold up the threads returning
+        connections or taking idle ones.
+        """
+        deadline = time.time() + self.timeout
+        while True:
+            conn = self._reserve(deadline)
+            if conn is None:
+                # A slot was reserved for a new connection.
+                try:
+                    conn = self.connect()
+                except Exception:
+                    with self._lock:
+                        self._opening -= 1
+                        self._lock.notify()
+                    raise
+                with self._lock:
+                    self._opening -= 1
+                    return self._checkout(self._register(conn))
+
+            if self._healthy(conn):
+                with self._lock:
+                    return self._checkout(conn)
+            with self._lock:
+                self._stats['failed_checks'] += 1
+                self._discard(conn)
+                self._lock.notify()
+
+    def _reserve(self, deadline):
+        """
+        Take an idle connection that hasn't expired, or reserve room for a
+        new one and return None.
+        """
+        with self._lock:
+            self._check_fork()
+            while True:
+                while self._idle:
+                    conn = self._idle.pop()
+                    if self._expired(conn):
+                        self._stats['recycled'] += 1
+                        self._discard(conn)
+                        continue
+                    return conn
+
+                if len(self._meta) + self._opening < self.max_size:
+                    self._opening += 1
+                    return None
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolExhausted("No database connection available after {}s (pool size {}).".format(self.timeout, self.max_size))
+                self._stats['waits'] += 1
+                self._lock.wait(remaining)
+
+    def _checkout(self, conn):
+        self._meta[id(conn)]['uses'] += 1
+        self._in_use.add(id(conn))
+        self._stats['checkouts'] += 1
+        return conn
+
+    def putconn(self, conn, close=False):
+        """
+        Return a connection to the pool. Any open transaction is rolled back
+        (outside the lock) so the next user gets a clean connection.
+        """
+        with self._lock:
+            self._check_fork()
+            if id(conn) in self._inherited:
+                # Opened before a fork, the parent may still be using it.
+                self._orphans.append(conn)
+                return
+            if id(conn) not in self._meta:
+                # Not ours, just close it.
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                return
+
+        if not close and not conn.closed:
+            try:
+                status = conn.info.transaction_status
+                if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                close = True
+
+        with self._lock:
+            self._in_use.discard(id(conn))
+            if id(conn) not in self._meta:
+                # Forgotten while it was being rolled back.
+                return
+            if close or conn.closed or self._expired(conn) or \
+               len(self._idle) >= self.max_size:
+                if not close and not conn.closed and self._expired(conn):
+                    self._stats['recycled'] += 1
+                self._discard(conn)
+            else:
+                self._idle.append(conn)
+            self._lock.notify()
+
+    def fill(self):
+        """
+        Open connections until at least `min_size` are available. They are
+        opened outside the lock, like in getconn.
+        """
+        while True:
+            with self._lock:
+                self._check_fork()
+                if len(self._meta) + self._opening >= self.min_size:
+                    return
+                self._opening += 1
+            try:
+                conn = self.connect()
+            except Exception:
+                with self._lock:
+                    self._opening -= 1
+                    self._lock.notify()
+                raise
+            with self._lock:
+                self._opening -= 1
+                self._idle.append(self._register(conn))
+                self._lock.notify()
+
+    def closeall(self):
+        with self._lock:
+            for conn in list(self._idle):
+                self._discard(conn)
+            self._idle = []
+
+    def stats(self):
+        """
+        Returns a dict with the current pool configuration and counters.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(pid=self._pid,
+                         size=len(self._meta),
+                         idle=len(self._idle),
+                         in_use=len(self._in_use),
+                         min_size=self.min_size,
+                         max_size=self.max_size,
+                         max_uses=self.max_uses,
+                         max_age=self.max_age)
+            return stats
@@ -0,0 +1,425 @@
+"""
+Post-install stages that run_task runs after a layer's makefile has loaded
+its data.
+
+Indexes and constraints are declared per layer in metadata.json rather
+than created in the makefile, so that they are built after the data has
+been loaded, in parallel, and with more memory than a default session:
+
+    "indexes": [
+        {"table": "geonames.geoname", "type": "primary key", "columns": ["geonameid"]},
+        {"table": "geonames.geoname", "columns": ["geom"], "method": "gist"},
+        {"table": "geonames.alternatename", "type": "foreign key", "columns": ["geonameid"],
+         "references": {"table": "geonames.geoname", "columns": ["geonameid"]}}
+    ]
+
+The type is one of 'primary key', 'unique', 'foreign key' or 'index' (the
+default). Primary keys and unique constraints are built first, then the
+other indexes, and then the foreign keys which need the former to exist.
+Within each of these phases everything is built concurrently over several
+connections. All tables are analyzed at the end.
+
+Before that, big tables can be stored in an order that keeps what is close
+together on the map close together on disk, and optionally partitioned:
+
+    "storage": [
+        {"table": "gadm.level2", "order": "geohash", "geometry": "geom",
+         "partition": {"by": "list", "column": "gid_0"}}
+    ]
+
+The order is "geohash", by the geohash of the center of the bounding box of
+the geometry column (which defaults to "geom" and must be in lon/lat), or a
+list of columns. Tables are partitioned "by" "list", with a partition for
+each of the given "values" ({"name": [value, ...]}) or for every distinct
+value of the column if there are none, or by "range", with a partition for
+each of the given "bounds" ({"name": [from, to]}, where null is unbounded).
+Rows that don't fit any of them end up in a default partition. Partitions
+are named after their table, like gadm.level2_nld. Indexes the makefile
+created on a table that is partitioned are lost, so they should be declared
+instead, and primary keys and unique constraints of partitioned tables
+must include the partition column.
+
+Simplified copies of polygon and line tables can be generated for maps at
+small scales, at one or more tolerances (in the units of the geometry):
+
+    "simplified": {
+        "tables": ["naturalearth.ne_10m_admin_0_countries"],
+        "tolerances": {"low": 0.1, "medium": 0.01},
+        "subdivide": 256
+    }
+
+This creates naturalearth.ne_10m_admin_0_countries_low and _medium, with
+the same columns and the geometry simplified with ST_SimplifyPreserveTopology,
+and cut into pieces of at most "subdivide" vertices with ST_Subdivide if
+given, which makes for smaller index entries and faster intersections. Each
+gets a GiST index on its geometry column, which is "geom" unless "geometry"
+says otherwise. They are built after the indexes, and every tolerance is
+registered as a layer of its own, derived from the layer it belongs to.
+
+Layers that declare their tables are installed into a shadow schema, and
+the indexes are built there before swap_tables() moves the tables into the
+dataset schema in a single transaction. The tables they replace end up in
+the shadow schema, where they are kept for a rollback.
+"""
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg2 import sql
+
+INDEX_PHASES = ('primary key', 'unique', 'index', 'foreign key')
+
+
+def table_identifier(table):
+    schema, _, name = table.rpartition('.')
+    return sql.Identifier(schema, name) if schema else sql.Identifier(name)
+
+
+def relocate(table, dataset, schema):
+    """
+    Returns the name of `table` when the tables of `dataset` are created in
+    `schema` instead. Tables in other schemas keep their name.
+    """
+    table_schema, _, name = table.rpartition('.')
+    return f"{schema}.{name}" if table_schema == dataset else table
+
+
+def relocate_index(index, dataset, schema):
+    index = dict(index, table=relocate(index['table'], dataset, schema))
+    if 'references' in index:
+        index['references'] = dict(index['references'], table=relocate(index['references']['table'], dataset, schema))
+    return index
+
+
+def index_name(index):
+    if index.get('name'):
+        return index['name']
+    prefix = {'primary key': 'pk', 'unique': 'uq', 'foreign key': 'fk'}.get(index.get('type', 'index'), 'idx')
+    table = index['table'].rpartition('.')[2]
+    return "_".join([prefix, table] + index['columns'])[:63]
+
+
+def index_statement(index):
+    """
+    Returns the SQL statement that builds the declared index or constraint.
+    """
+    kind = index.get('type', 'index')
+    table = table_identifier(index['table'])
+    name = sql.Identifier(index_name(index))
+    columns = sql.SQL(', ').join(map(sql.Identifier, index['columns']))
+
+    if kind == 'index':
+        method = index.get('method', 'btree')
+        if not method.isalnum():
+            raise ValueError(f"Invalid index method '{method}'")
+        return sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} USING {} ({});").format(
+            name, table, sql.SQL(method), columns)
+    # Not ALTER TABLE ONLY, so that constraints of partitioned tables are
+    # added to their partitions too.
+    if kind in ('primary key', 'unique'):
+        return sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {} ({});").format(
+            table, name, sql.SQL(kind.upper()), columns)
+    if kind == 'foreign key':
+        references = index['references']
+        return sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} FOREIGN KEY ({}) REFERENCES {} ({});").format(
+            table, name, columns, table_identifier(references['table']),
+            sql.SQL(', ').join(map(sql.Identifier, references['columns'])))
+    raise ValueError(f"Unknown index type '{kind}'")
+
+
+def index_exists(cur, index):
+    """
+    Whether the declared index or constraint has been built already, like
+    when an install is resumed after it failed halfway through building them.
+    """
+    table = table_identifier(index['table']).as_string(cur)
+    cur.execute("""
+        SELECT EXISTS (SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+                       WHERE pg_class.relname=%s AND pg_index.indrelid = to_regclass(%s))
+            OR EXISTS (SELECT 1 FROM pg_constraint WHERE conname=%s AND conrelid = to_regclass(%s));
+    """, (index_name(index), table, index_name(index), table))
+    return cur.fetchone()[0]
+
+
+def build_indexes(get_conn, release_conn, indexes, workers=4,
+                  maintenance_work_mem='512MB', parallel_workers=2, log=print):
+    """
+    Build the declared indexes phase by phase, each phase concurrently over
+    up to `workers` connections taken with `get_conn` and handed back with
+    `release_conn`. Indexes that exist already are skipped. Raises the first
+    error that occurs.
+    """
+    def build(index):
+        conn = get_conn()
+        try:
+            cur = conn.cursor()
+            if index_exists(cur, index):
+                conn.commit()
+                log(f"Skipped {index.get('type', 'index')} {index_name(index)} on {index['table']}, it exists already")
+                return
+            cur.execute("SET LOCAL maintenance_work_mem = %s;", (maintenance_work_mem,))
+            cur.execute("SET LOCAL max_parallel_maintenance_workers = %s;", (parallel_workers,))
+            started = time.time()
+            cur.execute(index_statement(index))
+            conn.commit()
+            log(f"Built {index.get('type', 'index')} {index_name(index)} on {index['table']} in {time.time() - started:.1f}s")
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            release_conn(conn)
+
+    for phase in INDEX_PHASES:
+        batch = [index for index in indexes if index.get('type', 'index') == phase]
+        if not batch:
+            continue
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for future in [executor.submit(build, index) for index in batch]:
+                future.result()
+        log(f"Built {len(batch)} {phase} index(es) in {time.time() - started:.1f}s")
+
+
+def order_expression(storage):
+    order = storage.get('order')
+    if order == 'geohash':
+        geom = sql.Identifier(storage.get('geometry', 'geom'))
+        return sql.SQL("(CASE WHEN {0} IS NULL OR ST_IsEmpty({0}) THEN NULL "
+                       "ELSE ST_GeoHash(ST_Centroid(ST_Envelope({0})), 10) END)").format(geom)
+    if isinstance(order, list):
+        return sql.SQL(', ').join(map(sql.Identifier, order))
+    raise ValueError(f"Unknown storage order '{order}'")
+
+
+def partition_suffix(value):
+    return re.sub(r'[^a-z0-9]+', '_', str(value).lower()).strip('_') or 'empty'
+
+
+def partition_table(cur, storage, log=print):
+    """
+    Replace a table with a partitioned one with the same columns and rows,
+    inserted in the declared order if any.
+    """
+    table = storage['table']
+    partition = storage['partition']
+    schema, _, name = table.rpartition('.')
+    column = sql.Identifier(partition['column'])
+    loaded = f"{name}_unpartitioned"[:63]
+    cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {};").format(table_identifier(table), sql.Identifier(loaded)))
+    loaded = f"{schema}.{loaded}" if schema else loaded
+
+    by = partition.get('by', 'list')
+    if by not in ('list', 'range'):
+        raise ValueError(f"Unknown partitioning '{by}'")
+    cur.execute(sql.SQL("""
+        CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING GENERATED INCLUDING IDENTITY
+                         INCLUDING CONSTRAINTS INCLUDING STORAGE INCLUDING COMMENTS)
+        PARTITION BY {} ({});
+    """).format(table_identifier(table), table_identifier(loaded), sql.SQL(by.upper()), column))
+
+    if by == 'list':
+        groups = partition.get('values')
+        if not groups:
+            cur.execute(sql.SQL("SELECT DISTINCT {0} FROM {1} WHERE {0} IS NOT NULL ORDER BY 1;").format(
+                column, table_identifier(loaded)))
+            groups = {row[0]: [row[0]] for row in cur.fetchall()}
+        bounds = [(suffix, sql.SQL("FOR VALUES IN ({})").format(sql.SQL(', ').join(map(sql.Literal, values))))
+                  for (suffix, values) in groups.items()]
+    else:
+        def bound(value, unbounded):
+            return sql.SQL(unbounded) if value is None else sql.Literal(value)
+        bounds = [(suffix, sql.SQL("FOR VALUES FROM ({}) TO ({})").format(bound(lower, 'MINVALUE'), bound(upper, 'MAXVALUE')))
+                  for (suffix, (lower, upper)) in partition['bounds'].items()]
+    bounds.append(('default', sql.SQL("DEFAULT")))
+
+    names = set()
+    for (suffix, values) in bounds:
+        partition_name = base = f"{name}_{partition_suffix(suffix)}"[:63]
+        while partition_name in names:
+            partition_name = f"{base[:58]}_{len(names)}"
+        names.add(partition_name)
+        cur.execute(sql.SQL("CREATE TABLE {} PARTITION OF {} {};").format(
+            sql.Identifier(schema, partition_name) if schema else sql.Identifier(partition_name),
+            table_identifier(table), values))
+
+    # Generated columns are computed again, everything else is copied.
+    cur.execute("""
+        SELECT attname, pg_get_serial_sequence(%s, attname), attidentity != ''
+        FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped AND attgenerated = ''
+        ORDER BY attnum;
+    """, (loaded, loaded))
+    columns = cur.fetchall()
+    column_list = sql.SQL(', ').join(sql.Identifier(c[0]) for c in columns)
+    order = sql.SQL(" ORDER BY {}").format(order_expression(storage)) if storage.get('order') else sql.SQL('')
+    cur.execute(sql.SQL("INSERT INTO {} ({}) OVERRIDING SYSTEM VALUE SELECT {} FROM {}{};").format(
+        table_identifier(table), column_list, column_list, table_identifier(loaded), order))
+
+    # Keep the sequences of serial columns, and continue identity columns
+    # where the loaded table left off.
+    for (column_name, sequence, identity) in columns:
+        if sequence and identity:
+            cur.execute(sql.SQL("SELECT setval(pg_get_serial_sequence(%s, %s), COALESCE(max({}), 0) + 1, false) FROM {};").format(
+                sql.Identifier(column_name), table_identifier(table)), (table, column_name))
+        elif sequence:
+            cur.execute(sql.SQL("ALTER SEQUENCE {} OWNED BY {}.{};").format(
+                sql.SQL(sequence), table_identifier(table), sql.Identifier(column_name)))
+    cur.execute(sql.SQL("DROP TABLE {};").format(table_identifier(loaded)))
+    log(f"Partitioned {table} by {by} of {partition['column']} into {len(bounds)} partitions")
+
+
+def reorganize(get_conn, release_conn, storage, workers=4, maintenance_work_mem='512MB', log=print):
+    """
+    Store tables as declared in the "storage" of a layer: partitioned and/or
+    ordered. Tables that aren't partitioned are ordered with CLUSTER, on an
+    index that is dropped again afterwards. Every table is done in a single
+    transaction, concurrently over up to `workers` connections, and tables
+    that are partitioned already are left alone.
+    """
+    def store(storage):
+        table = storage['table']
+        conn = get_conn()
+        try:
+            cur = conn.cursor()
+            cur.execute("SET LOCAL maintenance_work_mem = %s;", (maintenance_work_mem,))
+            started = time.time()
+            cur.execute("SELECT relkind FROM pg_class WHERE oid = %s::regclass;", (table,))
+            if cur.fetchone()[0] == 'p':
+                conn.commit()
+                log(f"Skipped {table}, it is partitioned already")
+                return
+            if storage.get('partition'):
+                partition_table(cur, storage, log=log)
+            elif storage.get('order'):
+                index = f"{table.rpartition('.')[2]}_storage_order"[:63]
+                cur.execute(sql.SQL("CREATE INDEX {} ON {} ({});").format(
+                    sql.Identifier(index), table_identifier(table), order_expression(storage)))
+                cur.execute(sql.SQL("CLUSTER {} USING {};").format(table_identifier(table), sql.Identifier(index)))
+                cur.execute(sql.SQL("DROP INDEX {};").format(
+                    table_identifier(f"{table.rpartition('.')[0]}.{index}")))
+            conn.commit()
+            log(f"Stored {table} in {storage.get('order') or 'load'} order in {time.time() - started:.1f}s")
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            release_conn(conn)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for future in [executor.submit(store, s) for s in storage]:
+            future.result()
+
+
+def simplified_tables(simplified):
+    """
+    Returns the tables declared in the "simplified" of a layer as a list of
+    dicts with the level, source and table, and how to simplify it.
+    """
+    if not simplified:
+        return []
+    return [{'level': level, 'source': source, 'table': f"{source}_{level}",
+             'tolerance': tolerance, 'subdivide': simplified.get('subdivide'),
+             'geometry': simplified.get('geometry', 'geom')}
+            for (level, tolerance) in simplified['tolerances'].items()
+            for source in simplified['tables']]
+
+
+def build_simplified(get_conn, release_conn, derived, workers=4, log=print):
+    """
+    (Re)create the simplified tables, each with its GiST index, concurrently
+    over up to `workers` connections.
+    """
+    def build(derived):
+        (source, table) = (derived['source'], derived['table'])
+        conn = get_conn()
+        try:
+            cur = conn.cursor()
+            started = time.time()
+            cur.execute("""
+                SELECT attname FROM pg_attribute
+                WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped AND attname != %s
+                ORDER BY attnum;
+            """, (source, derived['geometry']))
+            columns = [sql.Identifier(row[0]) for row in cur.fetchall()]
+            geom = sql.Identifier(derived['geometry'])
+            simplified = sql.SQL("ST_SimplifyPreserveTopology({}, {})").format(geom, sql.Literal(derived['tolerance']))
+            if derived.get('subdivide'):
+                simplified = sql.SQL("ST_Subdivide({}, {})").format(simplified, sql.Literal(int(derived['subdivide'])))
+            cur.execute(sql.SQL("DROP TABLE IF EXISTS {};").format(table_identifier(table)))
+            cur.execute(sql.SQL("""
+                CREATE TABLE {table} AS 
+                SELECT * FROM (SELECT {columns} {simplified} AS {geom} FROM {source} WHERE {geom} IS NOT NULL) simplified
+                WHERE NOT ST_IsEmpty({geom});
+            """).format(table=table_identifier(table), source=table_identifier(source), geom=geom, simplified=simplified,
+                         columns=sql.SQL('').join(sql.SQL("{}, ").format(c) for c in columns)))
+            cur.execute("SELECT Populate_Geometry_Columns(%s::regclass);", (table,))
+            cur.execute(sql.SQL("CREATE INDEX {} ON {} USING gist ({});").format(
+                sql.Identifier(f"idx_{table.rpartition('.')[2]}_{derived['geometry']}"[:63]), table_identifier(table), geom))
+            conn.commit()
+            log(f"Built {table} from {source} with tolerance {derived['tolerance']} in {time.time() - started:.1f}s")
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            release_conn(conn)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for future in [executor.submit(build, d) for d in derived]:
+            future.result()
+
+
+def analyze(get_conn, release_conn, tables, log=print):
+    conn = get_conn()
+    try:
+        conn.autocommit = True
+        cur = conn.cursor()
+        for table in tables:
+            started = time.time()
+            cur.execute(sql.SQL("ANALYZE {};").format(table_identifier(table)))
+            log(f"Analyzed {table} in {time.time() - started:.1f}s")
+    finally:
+        conn.autocommit = False
+        release_conn(conn)
+
+
+def swap_tables(cur, dataset, schema, tables, lock_timeout='60s'):
+    """
+    Exchange the given tables of `dataset` with those in `schema`: afterwards
+    the dataset schema has the tables that were in `schema` and vice versa.
+    Indexes, constraints and owned sequences move along with their tables,
+    anything else left in `schema` is dropped. The caller commits, so that
+    the swap happens in a single transaction. Returns the number of tables
+    that were replaced.
+    """
+    names = [table.rpartition('.')[2] for table in tables]
+    swap_schema = f"{schema}_swap"[:63]
+
+    def existing(schema):
+        # Partitions move along with the tables they are part of.
+        cur.execute("""
+            SELECT tablename FROM pg_tables WHERE schemaname=%s AND tablename = ANY(%s)
+            UNION
+            SELECT child.relname FROM pg_inherits
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE parent.relnamespace = to_regnamespace(%s) AND child.relnamespace = parent.relnamespace
+              AND parent.relname = ANY(%s);
+        """, (schema, names, schema, names))
+        return [row[0] for row in cur.fetchall()]
+
+    def move(schema, names, to):
+        for name in names:
+            cur.execute(sql.SQL("ALTER TABLE {} SET SCHEMA {};").format(
+                sql.Identifier(schema, name), sql.Identifier(to)))
+
+    # Don't wait forever for queries on the old tables to complete, holding
+    # up new queries in the meantime.
+    cur.execute("SET LOCAL lock_timeout = %s;", (lock_timeout,))
+    cur.execute(sql.SQL("CREATE SCHEMA {};").format(sql.Identifier(swap_schema)))
+    replaced = existing(dataset)
+    move(dataset, replaced, swap_schema)
+    move(schema, existing(schema), dataset)
+    cur.execute(sql.SQL("DROP SCHEMA {} CASCADE;").format(sql.Identifier(schema)))
+    cur.execute(sql.SQL("ALTER SCHEMA {} RENAME TO {};").format(
+        sql.Identifier(swap_schema), sql.Identifier(schema)))
+    return len(replaced)
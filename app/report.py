@@ -0,0 +1,228 @@
+"""
+Query performance report of a layer, made after it has been installed.
+
+The report has the size, number of rows and statistics of each table of
+the layer, and the time taken by representative queries on each table with
+a geometry column, as measured with EXPLAIN (ANALYZE, BUFFERS). The queries
+are run on points and boxes picked at random within the extent of the
+table, with a fixed seed, so that they're the same on every install and the
+reports of several installs can be compared. The built-in queries are:
+
+    bbox                the rows in a box of 5% of the width and height of
+                        the extent
+    point_in_polygon    the polygons containing a point, only for tables of
+                        (multi)polygons
+    nearest             the 10 rows nearest to a point
+
+Layers can choose which of these are run, and add queries of their own,
+under "report_queries" in metadata.json:
+
+    "report_queries": [
+        "bbox",
+        {"name": "by_country", "table": "gadm.level2",
+         "query": "SELECT count(*) FROM {table} WHERE gid_0 = 'NLD' AND {geom} && %(box)s"}
+    ]
+
+In a query {table} and {geom} are replaced by the table and its geometry
+column, and %(box)s and %(point)s by a random box and point (so a literal
+% is written as %%, as in any query with parameters). A query without a
+"table" is run on every table with a geometry column.
+
+The report warns about geometry columns without a spatial index, queries
+that scan a table of more than SEQ_SCAN_ROWS rows sequentially, tables of
+which the statistics are missing or out of date, and queries that failed or
+timed out.
+"""
+import time
+import random
+import statistics
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extensions import AsIs
+
+BUILTIN_QUERIES = {
+    'bbox': "SELECT count(*) FROM {table} WHERE {geom} && %(box)s",
+    'point_in_polygon': "SELECT count(*) FROM {table} WHERE ST_Intersects({geom}, %(point)s)",
+    'nearest': "SELECT 1 FROM {table} ORDER BY {geom} <-> %(point)s LIMIT 10"
+}
+POLYGON_TYPES = ('ST_Polygon', 'ST_MultiPolygon')
+
+# Tables with fewer rows than this may be scanned sequentially.
+SEQ_SCAN_ROWS = 10000
+
+# Box size as a fraction of the width and height of the extent.
+BOX_SIZE = 0.05
+
+
+def table_stats(cur, table):
+    """
+    Returns the size, number of rows (as estimated by the last ANALYZE),
+    and statistics freshness of a table, including its partitions.
+    """
+    cur.execute("""
+        WITH rel AS (
+            SELECT %(table)s::regclass AS oid
+            UNION ALL
+            SELECT inhrelid FROM pg_inherits WHERE inhparent = %(table)s::regclass
+        )
+        SELECT
+            sum(pg_table_size(rel.oid)),
+            sum(pg_indexes_size(rel.oid)),
+            sum(GREATEST(pg_class.reltuples, 0))::bigint,
+            max(GREATEST(stat.last_analyze, stat.last_autoanalyze)),
+            sum(stat.n_mod_since_analyze)
+        FROM rel
+        JOIN pg_class ON pg_class.oid = rel.oid
+        LEFT JOIN pg_stat_user_tables stat ON stat.relid = rel.oid;
+    """, {'table': table})
+    (table_size, index_size, rows, analyzed, modified) = cur.fetchone()
+    return {
+        'table': table,
+        'table_size': int(table_size or 0),
+        'index_size': int(index_size or 0),
+        'rows': int(rows or 0),
+        'analyzed': analyzed.isoformat() if analyzed else None,
+        'modified_since_analyze': int(modified or 0)
+    }
+
+
+def geometry_columns(cur, table):
+    """
+    Returns (column, has spatial index) for the geometry columns of a table.
+    """
+    cur.execute("""
+        SELECT attname, EXISTS (
+            SELECT 1 FROM pg_index
+            JOIN pg_class idx ON idx.oid = pg_index.indexrelid
+            JOIN pg_am ON pg_am.oid = idx.relam
+            WHERE pg_index.indrelid = pg_attribute.attrelid AND pg_attribute.attnum = ANY(pg_index.indkey)
+              AND pg_am.amname IN ('gist', 'spgist', 'brin')
+        )
+        FROM pg_attribute
+        WHERE attrelid = %s::regclass AND atttypid = 'geometry'::regtype AND NOT attisdropped
+        ORDER BY attnum;
+    """, (table,))
+    return cur.fetchall()
+
+
+def plan_nodes(plan):
+    """
+    Returns the nodes of a plan and all of its sub plans.
+    """
+    nodes = [plan]
+    for child in plan.get('Plans', []):
+        nodes += plan_nodes(child)
+    return nodes
+
+
+def run_query(cur, name, query, table, geom, extent, srid, count, seed):
+    """
+    Run a query `count` times and return its timings, or the error it gave.
+    """
+    (xmin, ymin, xmax, ymax) = extent
+    rnd = random.Random(seed)
+    (width, height) = ((xmax - xmin) * BOX_SIZE, (ymax - ymin) * BOX_SIZE)
+    statement = sql.SQL("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ") + sql.SQL(query).format(
+        table=sql.Identifier(*table.split('.')), geom=sql.Identifier(geom))
+    result = {'name': name, 'table': table, 'queries': count}
+    (times, pages, node_types, seq_scans) = ([], [], set(), set())
+    try:
+        for _ in range(count):
+            x = xmin + rnd.random() * (xmax - xmin - width)
+            y = ymin + rnd.random() * (ymax - ymin - height)
+            box = sql.SQL("ST_MakeEnvelope({}, {}, {}, {}, {})").format(
+                *[sql.Literal(v) for v in (x, y, x + width, y + height, srid)])
+            point = sql.SQL("ST_SetSRID(ST_MakePoint({}, {}), {})").format(
+                *[sql.Literal(v) for v in (x + width / 2, y + height / 2, srid)])
+            cur.execute(statement, {'box': AsIs(box.as_string(cur)), 'point': AsIs(point.as_string(cur))})
+            explained = cur.fetchone()[0][0]
+            times.append(explained['Execution Time'])
+            plan = explained['Plan']
+            pages.append(plan.get('Shared Hit Blocks', 0) + plan.get('Shared Read Blocks', 0))
+            for node in plan_nodes(plan):
+                node_types.add(node['Node Type'])
+                if node['Node Type'].endswith('Seq Scan'):
+                    seq_scans.add(node.get('Relation Name'))
+    except psycopg2.Error as e:
+        return dict(result, error=str(e).strip().splitlines()[0])
+    return dict(result, median_ms=round(statistics.median(times), 3), max_ms=round(max(times), 3),
+                pages=round(statistics.mean(pages)), nodes=sorted(node_types),
+                seq_scans=sorted(name for name in seq_scans if name))
+
+
+def layer_queries(definition):
+    """
+    Returns the queries of a layer as (name, query, table or None).
+    """
+    queries = []
+    for entry in definition.get('report_queries', list(BUILTIN_QUERIES)):
+        if isinstance(entry, str):
+            queries.append((entry, BUILTIN_QUERIES[entry], None))
+        else:
+            queries.append((entry['name'], entry['query'], entry.get('table')))
+    return queries
+
+
+def build_report(get_conn, release_conn, definition, tables, count=10, timeout='10s', seed=0, log=print):
+    """
+    Returns the report of the given tables of a layer, as a dict with the
+    'tables', the 'queries' and the 'warnings'.
+    """
+    report = {'tables': [], 'queries': [], 'warnings': []}
+    warnings = report['warnings']
+    conn = get_conn()
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        cur.execute("SET statement_timeout = %s;", (timeout,))
+        for table in tables:
+            cur.execute("SELECT to_regclass(%s);", (table,))
+            if cur.fetchone()[0] is None:
+                warnings.append(f"{table} doesn't exist")
+                continue
+            stats = table_stats(cur, table)
+            columns = geometry_columns(cur, table)
+            stats['geometry_columns'] = [column for (column, _) in columns]
+            report['tables'].append(stats)
+            if stats['analyzed'] is None:
+                warnings.append(f"{table} has never been analyzed")
+            elif stats['modified_since_analyze'] > max(stats['rows'] / 10, 1000):
+                warnings.append(f"the statistics of {table} are out of date")
+            for (column, indexed) in columns:
+                if not indexed:
+                    warnings.append(f"{table}.{column} has no spatial index")
+            if not columns:
+                continue
+
+            (geom, _) = columns[0]
+            (schema, _, name) = table.rpartition('.')
+            cur.execute(sql.SQL("""
+                SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e),
+                       (SELECT ST_SRID({0}) FROM {1} WHERE {0} IS NOT NULL LIMIT 1),
+                       (SELECT ST_GeometryType({0}) FROM {1} WHERE {0} IS NOT NULL LIMIT 1)
+                FROM (SELECT COALESCE(ST_EstimatedExtent(%s, %s, %s), (SELECT ST_Extent({0}) FROM {1})) AS e) AS extent;
+            """).format(sql.Identifier(geom), sql.Identifier(schema, name)), (schema, name, geom))
+            (xmin, ymin, xmax, ymax, srid, geometry_type) = cur.fetchone()
+            if xmin is None:
+                continue
+            for (query_name, query, query_table) in layer_queries(definition):
+                if query_table not in (None, table):
+                    continue
+                if query_name == 'point_in_polygon' and query_table is None and geometry_type not in POLYGON_TYPES:
+                    continue
+                started = time.time()
+                result = run_query(cur, query_name, query, table, geom, (xmin, ymin, xmax, ymax), srid, count, seed)
+                report['queries'].append(result)
+                if 'error' in result:
+                    warnings.append(f"{query_name} on {table} failed: {result['error']}")
+                    continue
+                log(f"Ran {count} {query_name} queries on {table} in {time.time() - started:.1f}s, "
+                    f"median {result['median_ms']}ms")
+                if stats['rows'] > SEQ_SCAN_ROWS and name in result['seq_scans']:
+                    warnings.append(f"{query_name} on {table} scans the table sequentially")
+    finally:
+        cur.execute("RESET statement_timeout;")
+        conn.autocommit = False
+        release_conn(conn)
+    return report
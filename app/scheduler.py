@@ -0,0 +1,160 @@
+"""
+Dependency-aware planning of install tasks.
+
+Layers can declare in their metadata.json which other layers they depend
+on and which source files they download:
+
+    {
+        "name": "level1",
+        "depends_on": ["level0"],
+        "downloads": ["https://example.com/source.zip"],
+        "estimated_duration": 600,
+        "metadata": { ... }
+    }
+
+Names in `depends_on` are either layer names within the same dataset or
+full 'dataset.layer' keys. From these declarations build_plan() creates a
+DAG of tasks: missing dependencies are added, and downloads shared by more
+than one layer in the plan get a separate 'fetch' node which the layers
+using them depend on, so that they are downloaded only once. The plan also
+has the expected start and finish time of each node, assuming independent
+nodes run in parallel, and the critical path through the graph.
+"""
+
+# Prefix used for the keys of nodes that prefetch shared downloads.
+FETCH_PREFIX = 'fetch:'
+
+# Duration used for nodes of which we know nothing at all.
+DEFAULT_DURATION = 300
+
+
+class PlanError(Exception):
+    pass
+
+
+def dependency_key(dataset, name):
+    return name if '.' in name else f"{dataset}.{name}"
+
+
+def build_plan(layers, selected, installed, durations=None):
+    """
+    Build an install plan.
+
+    `layers` maps every known layer key to the layer entry of its dataset's
+    metadata.json, `selected` maps the keys the user asked for to their
+    target ('install' or 'uninstall'), `installed` is the set of keys that
+    are currently installed, and `durations` optionally maps keys to their
+    measured duration in seconds.
+
+    Returns a dict with the nodes (in a valid execution order) and the
+    critical path. Raises PlanError on unknown dependencies or cycles.
+    """
+    durations = durations or {}
+    nodes = {}
+
+    def add(key, target, reason):
+        if key in nodes:
+            return
+        layer = layers.get(key)
+        if layer is None:
+            raise PlanError(f"Unknown layer '{key}'")
+        dataset = key.split('.')[0]
+        deps = []
+        if target == 'install':
+            deps = [dependency_key(dataset, d) for d in layer.get('depends_on', [])]
+        nodes[key] = {
+            'key': key,
+            'target': target,
+            'reason': reason,
+            'depends_on': deps,
+            'downloads': list(layer.get('downloads', [])) if target == 'install' else [],
+            'duration': durations.get(key) or layer.get('estimated_duration') or DEFAULT_DURATION
+        }
+        for dep in deps:
+            if dep not in layers:
+                raise PlanError(f"Layer '{key}' depends on unknown layer '{dep}'")
+            if dep not in installed and dep not in selected:
+                add(dep, 'install', f"required by {key}")
+
+    for key, target in selected.items():
+        add(key, target, 'selected')
+
+    # Dependencies that are already installed and not part of this plan
+    # don't need to be waited for.
+    for node in nodes.values():
+        node['depends_on'] = [d for d in node['depends_on'] if d in nodes]
+
+    # Downloads used by more than one layer of a dataset are fetched once by
+    # a separate node for that dataset.
+    users = {}
+    for node in nodes.values():
+        for url in node['downloads']:
+            users.setdefault(url, []).append(node['key'])
+    for url, keys in users.items():
+        if len(keys) < 2:
+            continue
+        for key in keys:
+            fetch_key = FETCH_PREFIX + key.split('.')[0]
+            fetch = nodes.setdefault(fetch_key, {
+                'key': fetch_key,
+                'target': 'fetch',
+                'reason': 'shared downloads',
+                'depends_on': [],
+                'downloads': [],
+                'duration': durations.get(fetch_key) or 0
+            })
+            if url not in fetch['downloads']:
+                fetch['downloads'].append(url)
+            if fetch_key not in nodes[key]['depends_on']:
+                nodes[key]['depends_on'].append(fetch_key)
+
+    order = topological_order(nodes)
+
+    # Earliest start and finish times assuming unlimited parallelism.
+    for key in order:
+        node = nodes[key]
+        node['start'] = max([nodes[d]['finish'] for d in node['depends_on']] or [0])
+        node['finish'] = node['start'] + node['duration']
+
+    critical_path = []
+    if order:
+        key = max(order, key=lambda k: nodes[k]['finish'])
+        while key:
+            critical_path.insert(0, key)
+            node = nodes[key]
+            deps = [d for d in node['depends_on'] if nodes[d]['finish'] == node['start']]
+            key = deps[0] if deps else None
+    for key in critical_path:
+        nodes[key]['critical'] = True
+
+    return {
+        'nodes': [nodes[k] for k in order],
+        'critical_path': critical_path,
+        'total_duration': max([n['finish'] for n in nodes.values()] or [0]),
+        'serial_duration': sum(n['duration'] for n in nodes.values())
+    }
+
+
+def topological_order(nodes):
+    """
+    Order the nodes so that every node comes after its dependencies, keeping
+    the order stable by key. Raises PlanError when there is a cycle.
+    """
+    order = []
+    state = {}
+
+    def visit(key, path):
+        if state.get(key) == 'done':
+            return
+        if state.get(key) == 'visiting':
+            cycle = path[path.index(key):] + [key]
+            raise PlanError("Dependency cycle: {}".format(' -> '.join(cycle)))
+        state[key] = 'visiting'
+        for dep in sorted(nodes[key]['depends_on']):
+            visit(dep, path + [key])
+        state[key] = 'done'
+        order.append(key)
+
+    for key in sorted(nodes):
+        visit(key, [])
+    return order
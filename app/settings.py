@@ -24,3 +24,100 @@ PG_BASELAYERS_SHOW_LOGS = os.getenv('PG_BASELAYERS_SHOW_LOGS', default='YES')
 PG_BASELAYERS_USERNAME = os.getenv('PG_BASELAYERS_USERNAME', default='')
 PG_BASELAYERS_PASSWORD = os.getenv('PG_BASELAYERS_PASSWORD', default='')
 
+
+# Database connection pool. Connections are health-checked when taken from 
+# the pool and recycled after MAX_USES checkouts or MAX_AGE seconds (0 means
+# no limit). TIMEOUT is how long to wait for a free connection.
+PG_BASELAYERS_POOL_MIN_SIZE = os.getenv('PG_BASELAYERS_POOL_MIN_SIZE', default='1')
+PG_BASELAYERS_POOL_MAX_SIZE = os.getenv('PG_BASELAYERS_POOL_MAX_SIZE', default='10')
+PG_BASELAYERS_POOL_MAX_USES = os.getenv('PG_BASELAYERS_POOL_MAX_USES', default='1000')
+PG_BASELAYERS_POOL_MAX_AGE = os.getenv('PG_BASELAYERS_POOL_MAX_AGE', default='3600')
+PG_BASELAYERS_POOL_TIMEOUT = os.getenv('PG_BASELAYERS_POOL_TIMEOUT', default='30')
+
+# Number of seconds the result of the PostGIS and schema checks done before 
+# each request is cached for.
+PG_BASELAYERS_STATE_CACHE_TTL = os.getenv('PG_BASELAYERS_STATE_CACHE_TTL', default='60')
+
+# Maximum size in MB of the download cache for dataset source files. Set to 
+# 0 to disable the cache.
+PG_BASELAYERS_DOWNLOAD_CACHE_SIZE = os.getenv('PG_BASELAYERS_DOWNLOAD_CACHE_SIZE', default='10240')
+
+# URL of a mirror to download all source files from instead, which has them
+# at <mirror>/<host>/<path>. Used by benchmark.py to serve fixtures.
+PG_BASELAYERS_DOWNLOAD_MIRROR = os.getenv('PG_BASELAYERS_DOWNLOAD_MIRROR', default='')
+
+# Concurrency limits. These apply across all workers (the number of which is
+# set with PG_BASELAYERS_WORKERS) that share the same instance directory.
+PG_BASELAYERS_MAX_TASKS = os.getenv('PG_BASELAYERS_MAX_TASKS', default='2')
+PG_BASELAYERS_MAX_TASKS_PER_DATASET = os.getenv('PG_BASELAYERS_MAX_TASKS_PER_DATASET', default='2')
+PG_BASELAYERS_MAX_DOWNLOADS = os.getenv('PG_BASELAYERS_MAX_DOWNLOADS', default='2')
+PG_BASELAYERS_MAX_IMPORTS = os.getenv('PG_BASELAYERS_MAX_IMPORTS', default='2')
+
+# Number of 1MB buffers between the download and the database in streaming
+# imports (see importer.py).
+PG_BASELAYERS_STREAM_BUFFERS = os.getenv('PG_BASELAYERS_STREAM_BUFFERS', default='16')
+
+# Number of connections and chunk size in MB used to load imports marked as 
+# "parallel" in metadata.json.
+PG_BASELAYERS_LOADER_WORKERS = os.getenv('PG_BASELAYERS_LOADER_WORKERS', default='4')
+PG_BASELAYERS_LOADER_CHUNK_SIZE = os.getenv('PG_BASELAYERS_LOADER_CHUNK_SIZE', default='64')
+
+# Settings for building the indexes declared in metadata.json after an 
+# install: the number of indexes built at the same time, and the memory and
+# parallel workers that PostgreSQL may use for each of them.
+PG_BASELAYERS_INDEX_WORKERS = os.getenv('PG_BASELAYERS_INDEX_WORKERS', default='4')
+PG_BASELAYERS_MAINTENANCE_WORK_MEM = os.getenv('PG_BASELAYERS_MAINTENANCE_WORK_MEM', default='512MB')
+PG_BASELAYERS_PARALLEL_MAINTENANCE_WORKERS = os.getenv('PG_BASELAYERS_PARALLEL_MAINTENANCE_WORKERS', default='2')
+
+# Whether to partition and order tables as declared in the "storage" of 
+# their layer in metadata.json after an install. Set to NO to keep them as
+# they were loaded, for example to compare the two with benchmark.py.
+PG_BASELAYERS_STORAGE_OPTIONS = os.getenv('PG_BASELAYERS_STORAGE_OPTIONS', default='YES')
+
+# Schedule on which installed layers that support incremental updates (see
+# deltas.py) are updated, as a crontab expression ('minute hour day month
+# day_of_week'). Leave empty to only update on request.
+PG_BASELAYERS_UPDATE_SCHEDULE = os.getenv('PG_BASELAYERS_UPDATE_SCHEDULE', default='0 3 * * *')
+
+# Minimum number of seconds between two updates of the status info of a 
+# layer while a task is running. More frequent updates are coalesced.
+PG_BASELAYERS_STATUS_INTERVAL = os.getenv('PG_BASELAYERS_STATUS_INTERVAL', default='2')
+
+# Size in KB of the start and the end of a task log that are stored. Output
+# in between is left out.
+PG_BASELAYERS_LOG_HEAD_SIZE = os.getenv('PG_BASELAYERS_LOG_HEAD_SIZE', default='1024')
+PG_BASELAYERS_LOG_TAIL_SIZE = os.getenv('PG_BASELAYERS_LOG_TAIL_SIZE', default='1024')
+
+# Number of seconds a task that timed out or was cancelled gets to stop 
+# after a SIGTERM, before it's killed.
+PG_BASELAYERS_KILL_GRACE = os.getenv('PG_BASELAYERS_KILL_GRACE', default='10')
+
+# Vector tiles served on /tiles/: the maximum size in MB of the tile cache on
+# disk (0 to disable it) and of the one in memory of each web process, and
+# how long building a tile may take.
+PG_BASELAYERS_TILE_CACHE_SIZE = os.getenv('PG_BASELAYERS_TILE_CACHE_SIZE', default='1024')
+PG_BASELAYERS_TILE_MEMORY_CACHE_SIZE = os.getenv('PG_BASELAYERS_TILE_MEMORY_CACHE_SIZE', default='64')
+PG_BASELAYERS_TILE_TIMEOUT = os.getenv('PG_BASELAYERS_TILE_TIMEOUT', default='30s')
+
+# Where the task queue is kept: 'postgres' for the postgis_baselayers schema,
+# which lets workers on several machines share it (see taskqueue.py), or 
+# 'sqlite' for a file in the instance directory. With 'postgres', a worker
+# holds a lease on a task for the given number of seconds and renews it while
+# the task runs. A task whose lease ran out is run again by another worker,
+# up to the given number of attempts after which its layer is marked failed.
+PG_BASELAYERS_QUEUE = os.getenv('PG_BASELAYERS_QUEUE', default='postgres')
+PG_BASELAYERS_QUEUE_LEASE = os.getenv('PG_BASELAYERS_QUEUE_LEASE', default='60')
+PG_BASELAYERS_QUEUE_MAX_ATTEMPTS = os.getenv('PG_BASELAYERS_QUEUE_MAX_ATTEMPTS', default='3')
+
+# Snapshots of installed layers made by the export target, see snapshots.py:
+# the number of jobs that dump and restore tables at the same time, and the
+# number of snapshots of each layer that are kept.
+PG_BASELAYERS_SNAPSHOT_JOBS = os.getenv('PG_BASELAYERS_SNAPSHOT_JOBS', default='4')
+PG_BASELAYERS_SNAPSHOTS_KEPT = os.getenv('PG_BASELAYERS_SNAPSHOTS_KEPT', default='2')
+
+# Whether to measure the performance of queries on a layer after it has been
+# installed (see report.py), how many times each query is run, and how long
+# a query may take.
+PG_BASELAYERS_REPORT = os.getenv('PG_BASELAYERS_REPORT', default='YES')
+PG_BASELAYERS_REPORT_QUERIES = os.getenv('PG_BASELAYERS_REPORT_QUERIES', default='10')
+PG_BASELAYERS_REPORT_TIMEOUT = os.getenv('PG_BASELAYERS_REPORT_TIMEOUT', default='10s')
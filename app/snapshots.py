@@ -0,0 +1,344 @@
+"""
+Snapshots of installed layers, kept in <instance>/snapshots/<layer>/<name>/.
+
+The export target dumps the tables of a layer with pg_dump, in the
+directory format and with several jobs at once. The dump includes the
+indexes and constraints of the tables, and next to it snapshot.json
+records the version and metadata of the layer it was taken from.
+
+The restore target installs a layer from its latest snapshot, into the
+shadow schema of the layer, after which it's swapped in like any install.
+pg_restore can't restore into another schema than the one the tables were
+dumped from, so the definitions in the dump are first restored without
+their data into the dataset schema of a scratch database. There the schema
+is renamed to the shadow schema and dumped again, which leaves it to
+Postgres to get every reference to the schema right. That dump creates
+the tables in the shadow schema, after which the data of the snapshot is
+copied into them, several tables at once, and pg_restore --jobs builds
+their indexes and constraints. The database user must be allowed to
+create databases for this.
+
+The password of the database is passed to pg_dump and pg_restore through
+PGPASSWORD rather than on their command line.
+"""
+import os
+import json
+import uuid
+import shutil
+import datetime
+import tempfile
+import threading
+import contextlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extensions import parse_dsn, make_dsn
+
+SNAPSHOT_FILE = 'snapshot.json'
+DUMP_DIR = 'dump'
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def snapshot_name(version, created):
+    return f"v{version}-{created.strftime('%Y%m%d%H%M%S')}"
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for (root, dirs, files) in os.walk(path) for name in files)
+
+
+def list_snapshots(directory, key):
+    """
+    Returns the snapshots of a layer, the latest first.
+    """
+    layer_dir = os.path.join(directory, key)
+    snapshots = []
+    if not os.path.isdir(layer_dir):
+        return snapshots
+    for name in os.listdir(layer_dir):
+        try:
+            with open(os.path.join(layer_dir, name, SNAPSHOT_FILE)) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            # Incomplete or removed in the meantime.
+            continue
+        snapshot.update(name=name, path=os.path.join(layer_dir, name))
+        snapshots.append(snapshot)
+    return sorted(snapshots, key=lambda s: s['created'], reverse=True)
+
+
+def remove_snapshots(directory, key, keep=0):
+    """
+    Remove the snapshots of a layer except for the `keep` latest ones.
+    """
+    for snapshot in list_snapshots(directory, key)[keep:]:
+        shutil.rmtree(snapshot['path'], ignore_errors=True)
+
+
+def dumped_tables(cur, schema, tables):
+    """
+    Returns the given tables that exist in `schema`, along with their
+    partitions, which pg_dump doesn't include by itself.
+    """
+    names = [table.rpartition('.')[2] for table in tables]
+    cur.execute("""
+        SELECT tablename FROM pg_tables WHERE schemaname=%s AND tablename = ANY(%s)
+        UNION
+        SELECT child.relname FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relnamespace = to_regnamespace(%s) AND parent.relname = ANY(%s)
+        ORDER BY 1;
+    """, (schema, names, schema, names))
+    return [row[0] for row in cur.fetchall()]
+
+
+def libpq_args(uri, dbname=None):
+    """
+    Returns the connection string to pass to pg_dump and pg_restore, which
+    leaves out the password so that it doesn't show up in the process list,
+    and the environment that passes the password to them instead.
+    """
+    params = parse_dsn(uri)
+    password = params.pop('password', None)
+    if dbname:
+        params['dbname'] = dbname
+    env = dict(os.environ)
+    if password is not None:
+        env['PGPASSWORD'] = password
+    return (make_dsn(**params), env)
+
+
+def run(cmd, log, timeout=None, **kwargs):
+    log(f"Running '{' '.join(cmd)}'")
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                universal_newlines=True, timeout=timeout, **kwargs)
+    except subprocess.TimeoutExpired:
+        raise SnapshotError(f"{cmd[0]} did not finish within {timeout}s")
+    for line in result.stderr.splitlines():
+        log(line)
+    if result.returncode != 0:
+        raise SnapshotError(f"{cmd[0]} failed: {result.stderr.strip()[-500:]}")
+    return result.stdout
+
+
+def export_snapshot(cur, directory, key, tables, layer, uri, jobs=4, timeout=None, log=print):
+    """
+    Dump the tables of an installed layer to a new snapshot and return its
+    path. `layer` is the row of the layer, of which the version, install
+    time and metadata are kept with the snapshot.
+    """
+    dataset = key.split('.')[0]
+    names = dumped_tables(cur, dataset, tables)
+    if not names:
+        raise SnapshotError(f"None of the tables of {key} exist")
+    cur.execute("SELECT current_setting('server_version'), postgis_lib_version();")
+    (server_version, postgis_version) = cur.fetchone()
+
+    (dsn, env) = libpq_args(uri)
+    created = datetime.datetime.utcnow()
+    name = snapshot_name(layer['version'], created)
+    path = os.path.join(directory, key, name)
+    partial = os.path.join(directory, key, f".{name}")
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+    try:
+        cmd = ["pg_dump", "--format=directory", f"--jobs={jobs}", "--no-owner", "--no-privileges",
+               f"--file={os.path.join(partial, DUMP_DIR)}", f"--dbname={dsn}"]
+        for table in names:
+            cmd.append("--table={}".format(sql.Identifier(dataset, table).as_string(cur)))
+        run(cmd, log, timeout, env=env)
+        snapshot = {
+            'key': key,
+            'version': layer['version'],
+            'installed': layer['installed'].isoformat() if layer['installed'] else None,
+            'metadata': layer['metadata'],
+            'tables': [f"{dataset}.{table}" for table in names],
+            'created': created.isoformat(),
+            'server_version': server_version,
+            'postgis_version': postgis_version,
+            'size': directory_size(partial)
+        }
+        with open(os.path.join(partial, SNAPSHOT_FILE), 'w') as f:
+            json.dump(snapshot, f, indent=2)
+        os.rename(partial, path)
+    except Exception:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+    log(f"Exported {len(names)} table(s) of {key} to {path} ({snapshot['size'] / 1024 / 1024:.1f} MB)")
+    return path
+
+
+class CopyData(object):
+    """
+    File-like object with the data of a COPY statement dumped by pg_restore,
+    up to its end marker.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.done = False
+
+    def read(self, size=-1):
+        lines = []
+        length = 0
+        while not self.done and (size < 0 or length < size):
+            line = self.f.readline()
+            if not line or line == '\\.\n':
+                self.done = True
+                break
+            lines.append(line)
+            length += len(line)
+        return ''.join(lines)
+
+
+@contextlib.contextmanager
+def scratch_database(uri, extensions, log=print):
+    """
+    Create an empty database with the given extensions for the duration of
+    the context, and yield its connection string.
+    """
+    name = f"pg_baselayers_restore_{uuid.uuid4().hex[:12]}"
+    conn = psycopg2.connect(uri)
+    conn.autocommit = True
+    try:
+        cur = conn.cursor()
+        cur.execute(sql.SQL("CREATE DATABASE {};").format(sql.Identifier(name)))
+        log(f"Created scratch database {name}")
+        try:
+            scratch = psycopg2.connect(uri, dbname=name)
+            try:
+                scratch.autocommit = True
+                for extension in extensions:
+                    scratch.cursor().execute(sql.SQL("CREATE EXTENSION IF NOT EXISTS {};").format(sql.Identifier(extension)))
+            finally:
+                scratch.close()
+            yield name
+        finally:
+            cur.execute(sql.SQL("DROP DATABASE IF EXISTS {};").format(sql.Identifier(name)))
+    finally:
+        conn.close()
+
+
+def restore_snapshot(path, schema, uri, get_conn, release_conn, jobs=4, timeout=None, log=print):
+    """
+    Restore the tables of a snapshot into `schema`, which must exist.
+    """
+    with open(os.path.join(path, SNAPSHOT_FILE)) as f:
+        snapshot = json.load(f)
+    dataset = snapshot['key'].split('.')[0]
+    dump = os.path.join(path, DUMP_DIR)
+    (dsn, env) = libpq_args(uri)
+
+    def restore_data(entry):
+        (listfile, table) = entry
+        process = subprocess.Popen(["pg_restore", "--data-only", f"--use-list={listfile}", "--file=-", dump],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        # Read stderr while the data is copied, so that pg_restore doesn't
+        # block on it when it has a lot to say.
+        errors = []
+        reader = threading.Thread(target=lambda: errors.extend(process.stderr), daemon=True)
+        reader.start()
+        # The columns of the restored table are in the same order as in the
+        # dump, so the COPY statement doesn't need to list them.
+        copy = sql.SQL("COPY {} FROM STDIN;").format(sql.Identifier(schema, table))
+        conn = get_conn()
+        try:
+            for line in process.stdout:
+                if line.startswith('COPY '):
+                    cur = conn.cursor()
+                    cur.copy_expert(copy.as_string(conn), CopyData(process.stdout))
+            conn.commit()
+            process.stdout.read()
+            returncode = process.wait(timeout)
+            reader.join()
+            if returncode != 0:
+                raise SnapshotError(f"pg_restore failed on {table}: {''.join(errors).strip()[-500:]}")
+        except Exception:
+            conn.rollback()
+            process.kill()
+            raise
+        finally:
+            release_conn(conn)
+            process.stdout.close()
+            reader.join()
+            process.stderr.close()
+        log(f"Restored the data of {table}")
+
+    def write_list(name, lines):
+        listfile = os.path.join(work_dir, name)
+        with open(listfile, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        return listfile
+
+    conn = get_conn()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT extname FROM pg_extension WHERE extname <> 'plpgsql' ORDER BY oid;")
+        extensions = [row[0] for row in cur.fetchall()]
+        conn.rollback()
+    finally:
+        release_conn(conn)
+
+    work_dir = tempfile.mkdtemp(prefix='pg-baselayers-restore-')
+    try:
+        # The definitions of the tables, sequences, indexes and constraints,
+        # restored as they were dumped into an empty copy of the dataset
+        # schema and dumped again once that has been renamed.
+        definitions = os.path.join(work_dir, 'definitions.dump')
+        toc = [line for line in run(["pg_restore", "--list", dump], log, timeout).splitlines()
+               if line and not line.startswith(';')]
+        with scratch_database(uri, extensions, log) as name:
+            (scratch, scratch_env) = libpq_args(uri, dbname=name)
+            scratch_conn = psycopg2.connect(uri, dbname=name)
+            try:
+                scratch_conn.cursor().execute(sql.SQL("CREATE SCHEMA {};").format(sql.Identifier(dataset)))
+                scratch_conn.commit()
+                run(["pg_restore", "--schema-only", "--no-owner", "--no-privileges", f"--dbname={scratch}", dump],
+                    log, timeout, env=scratch_env)
+                sequences = [line for line in toc if ' SEQUENCE SET ' in line]
+                if sequences:
+                    run(["pg_restore", "--data-only", f"--use-list={write_list('sequences.list', sequences)}",
+                         f"--dbname={scratch}", dump], log, timeout, env=scratch_env)
+                scratch_conn.cursor().execute(sql.SQL("ALTER SCHEMA {} RENAME TO {};").format(
+                    sql.Identifier(dataset), sql.Identifier(schema)))
+                scratch_conn.commit()
+            finally:
+                scratch_conn.close()
+            run(["pg_dump", "--format=custom", "--no-owner", "--no-privileges", f"--schema={schema}",
+                 f"--file={definitions}", f"--dbname={scratch}"], log, timeout, env=scratch_env)
+
+        # The schema itself exists already.
+        entries = [line for line in run(["pg_restore", "--list", definitions], log, timeout).splitlines()
+                   if line and not line.startswith(';') and ' SCHEMA - ' not in line]
+        listfile = write_list('definitions.list', entries)
+        run(["pg_restore", "--section=pre-data", "--no-owner", "--no-privileges", f"--use-list={listfile}",
+             f"--dbname={dsn}", definitions], log, timeout, env=env)
+
+        # The data of each table, and of each partition, and then the values
+        # of their sequences.
+        data = []
+        for line in toc:
+            if ' TABLE DATA ' in line:
+                data.append((write_list(f"{len(data)}.list", [line]), line.split(' TABLE DATA ', 1)[1].split(' ')[1]))
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            list(pool.map(restore_data, data))
+        sequences = [line for line in entries if ' SEQUENCE SET ' in line]
+        if sequences:
+            run(["pg_restore", "--data-only", f"--use-list={write_list('sequences.list', sequences)}",
+                 f"--dbname={dsn}", definitions], log, timeout, env=env)
+
+        # Indexes and constraints, several at once, and whatever depends on
+        # those.
+        run(["pg_restore", "--section=post-data", f"--jobs={jobs}", "--no-owner", "--no-privileges",
+             f"--use-list={listfile}", f"--dbname={dsn}", definitions], log, timeout, env=env)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    log(f"Restored {len(snapshot['tables'])} table(s) of {snapshot['key']} from {path}")
+    return snapshot
@@ -0,0 +1,131 @@
+"""
+Incremental storage of task logs.
+
+The output of a task is written to postgis_baselayers.log_chunk while the
+task is running, in chunks of about `chunk_size` bytes, rather than being
+collected in memory and stored in one go when the task is done. Secrets
+are redacted from every line before it is stored.
+
+The size of a log is capped: the first `head_size` bytes are stored, and of
+everything after that only the last `tail_size` bytes are kept (in memory)
+and stored when the log is closed, after a line saying how much was left
+out. Memory use is bounded by the size of the tail.
+
+All tasks log through the same logger, with the id of the task in the
+`task_id` attribute of their records (see for_task()), and the handler
+of a task only stores the records of that task. Loggers are never freed,
+so a logger per task would leak one for every task that was ever run.
+"""
+import logging
+from collections import deque
+
+
+def for_task(logger, task_id):
+    """
+    Returns an adapter of `logger` that marks its records as those of the
+    task `task_id`.
+    """
+    return logging.LoggerAdapter(logger, {'task_id': task_id})
+
+
+class TaskLogHandler(logging.Handler):
+    def __init__(self, get_conn, release_conn, task_id, redactions=None,
+                 chunk_size=64 * 1024, head_size=1024 * 1024, tail_size=1024 * 1024):
+        super().__init__()
+        self.get_conn = get_conn
+        self.release_conn = release_conn
+        self.task_id = task_id
+        self.redactions = [(s, r) for (s, r) in (redactions or {}).items() if s]
+        self.chunk_size = chunk_size
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.seq = 0
+        self.buffer = []
+        self.buffered = 0
+        self.stored = 0
+        self.head_full = False
+        self.tail = deque()
+        self.tail_bytes = 0
+        self.omitted_lines = 0
+        self.omitted_bytes = 0
+
+    def filter(self, record):
+        return getattr(record, 'task_id', None) == self.task_id and super().filter(record)
+
+    def redact(self, line):
+        for (secret, replacement) in self.redactions:
+            line = line.replace(secret, replacement)
+        return line
+
+    def emit(self, record):
+        try:
+            line = self.redact(self.format(record).rstrip('\n')) + '\n'
+            size = len(line.encode())
+            if not self.head_full and self.stored + self.buffered + size <= self.head_size:
+                self.buffer.append(line)
+                self.buffered += size
+                if self.buffered >= self.chunk_size:
+                    self._write()
+            else:
+                # Once a line didn't fit, later (shorter) lines mustn't end
+                # up in the head before it.
+                self.head_full = True
+                self.tail.append(line)
+                self.tail_bytes += size
+                while self.tail_bytes > self.tail_size and len(self.tail) > 1:
+                    dropped = self.tail.popleft()
+                    self.tail_bytes -= len(dropped.encode())
+                    self.omitted_lines += 1
+                    self.omitted_bytes += len(dropped.encode())
+        except Exception:
+            self.handleError(record)
+
+    def _write(self):
+        if not self.buffer:
+            return
+        content = ''.join(self.buffer)
+        conn = self.get_conn()
+        try:
+            cur = conn.cursor()
+            cur.execute("SET LOCAL synchronous_commit TO OFF;")
+            cur.execute("""
+                INSERT INTO postgis_baselayers.log_chunk (task_id, seq, content) VALUES (%s, %s, %s);
+            """, (self.task_id, self.seq, content))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.release_conn(conn)
+        self.seq += 1
+        self.stored += self.buffered
+        self.buffer = []
+        self.buffered = 0
+
+    def flush(self):
+        self.acquire()
+        try:
+            self._write()
+        finally:
+            self.release()
+
+    def close(self):
+        """
+        Store whatever is left, including the tail of the log.
+        """
+        self.acquire()
+        try:
+            self._write()
+            lines = list(self.tail)
+            if self.omitted_lines:
+                lines.insert(0, f"\n[... {self.omitted_lines} lines ({self.omitted_bytes} bytes) omitted ...]\n\n")
+            for line in lines:
+                self.buffer.append(line)
+                self.buffered += len(line.encode())
+                if self.buffered >= self.chunk_size:
+                    self._write()
+            self.tail.clear()
+            self._write()
+        finally:
+            self.release()
+        super().close()
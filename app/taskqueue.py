@@ -0,0 +1,293 @@
+"""
+Task queue stored in PostgreSQL, for huey.
+
+PostgresHuey keeps its queue in the postgis_baselayers schema rather than
+in a file, so that workers on any machine that can reach the database can
+consume it. Tasks are stored in postgis_baselayers.queue_task along with
+their priority and the time they may run, and the results and revocations
+that huey keeps in postgis_baselayers.queue_data.
+
+Workers claim the next task with FOR UPDATE SKIP LOCKED, highest priority
+first, which gives the claiming worker a lease on it. A heartbeat thread in
+every worker process extends the leases of the tasks it is running, and a
+task is removed from the queue once it has been executed. When a worker
+crashes or loses its connection the lease of its task runs out, and the
+task is claimed and run again by another worker. After `max_attempts` the
+task is abandoned instead: it is removed from the queue and passed to the
+functions registered with @huey.abandoned().
+
+Tasks that fail and have retries left are retried after their retry_delay,
+which grows by a factor `backoff` with every retry up to `max_retry_delay`.
+"""
+import os
+import time
+import uuid
+import socket
+import datetime
+import threading
+
+import psycopg2
+from huey.api import Huey
+from huey.constants import EmptyData
+from huey.storage import BaseStorage
+
+
+class PostgresStorage(BaseStorage):
+    def __init__(self, name='huey', get_conn=None, release_conn=None, connect=None, lease=60,
+                 max_attempts=3, on_abandoned=None, **kwargs):
+        super(PostgresStorage, self).__init__(name)
+        self.get_conn = get_conn
+        self.release_conn = release_conn
+        self.connect = connect
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.on_abandoned = on_abandoned
+        self.worker = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._local = threading.local()
+        self._heartbeat = None
+        self._heartbeat_lock = threading.Lock()
+
+    def sql(self, query, params=None, fetch=None):
+        conn = self.get_conn()
+        try:
+            cur = conn.cursor()
+            cur.execute(query, params)
+            result = cur.fetchall() if fetch == 'all' else cur.fetchone() if fetch == 'one' else None
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.release_conn(conn)
+
+    def enqueue(self, data, priority=None):
+        self.sql("""
+            INSERT INTO postgis_baselayers.queue_task (queue, data, priority) VALUES (%s, %s, %s);
+        """, (self.name, psycopg2.Binary(data), priority or 0))
+
+    def dequeue(self):
+        """
+        Claim the next task and return its data. The claim is released with
+        done() once the task has been executed.
+        """
+        try:
+            self.abandon_expired()
+            row = self.sql("""
+                UPDATE postgis_baselayers.queue_task
+                SET state='running', claimed_by=%s, attempts=attempts+1,
+                    lease_expires=NOW() + make_interval(secs => %s)
+                WHERE id = (
+                    SELECT id FROM postgis_baselayers.queue_task
+                    WHERE queue=%s AND (state='queued' OR (state='running' AND lease_expires < NOW()))
+                    ORDER BY priority DESC, id
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, data;
+            """, (self.worker, self.lease, self.name), fetch='one')
+        except psycopg2.errors.UndefinedTable:
+            # The application hasn't been initialized yet.
+            return None
+        if row is None:
+            return None
+        self._local.claimed = row[0]
+        self.start_heartbeat()
+        return bytes(row[1])
+
+    def done(self):
+        """
+        Remove the task this thread claimed last from the queue.
+        """
+        claimed = getattr(self._local, 'claimed', None)
+        if claimed is not None:
+            self._local.claimed = None
+            self.sql("DELETE FROM postgis_baselayers.queue_task WHERE id=%s;", (claimed,))
+
+    def abandon_expired(self):
+        rows = self.sql("""
+            DELETE FROM postgis_baselayers.queue_task
+            WHERE id IN (
+                SELECT id FROM postgis_baselayers.queue_task
+                WHERE queue=%s AND state='running' AND lease_expires < NOW() AND attempts >= %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING data;
+        """, (self.name, self.max_attempts), fetch='all')
+        for (data,) in rows:
+            if self.on_abandoned:
+                self.on_abandoned(bytes(data))
+
+    def start_heartbeat(self):
+        with self._heartbeat_lock:
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._beat, name='queue-heartbeat', daemon=True)
+                self._heartbeat.start()
+
+    def _beat(self):
+        """
+        Renew the leases of the tasks of this worker. The heartbeat has a 
+        connection of its own, so that it keeps going when the tasks use up
+        all connections of the pool.
+        """
+        conn = None
+        while True:
+            time.sleep(self.lease / 3)
+            try:
+                if conn is None or conn.closed:
+                    conn = self.connect()
+                cur = conn.cursor()
+                cur.execute("""
+                    UPDATE postgis_baselayers.queue_task SET lease_expires=NOW() + make_interval(secs => %s)
+                    WHERE claimed_by=%s AND state='running';
+                """, (self.lease, self.worker))
+                conn.commit()
+            except Exception:
+                # Try again with a new connection on the next beat, the lease
+                # lasts a few of them.
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                conn = None
+
+    def queue_size(self):
+        return self.sql("""
+            SELECT count(*) FROM postgis_baselayers.queue_task WHERE queue=%s AND state='queued';
+        """, (self.name,), fetch='one')[0]
+
+    def running_size(self):
+        return self.sql("""
+            SELECT count(*) FROM postgis_baselayers.queue_task WHERE queue=%s AND state='running';
+        """, (self.name,), fetch='one')[0]
+
+    def enqueued_items(self, limit=None):
+        rows = self.sql("""
+            SELECT data FROM postgis_baselayers.queue_task WHERE queue=%s AND state='queued'
+            ORDER BY priority DESC, id LIMIT %s;
+        """, (self.name, limit), fetch='all')
+        return [bytes(row[0]) for row in rows]
+
+    def flush_queue(self):
+        self.sql("DELETE FROM postgis_baselayers.queue_task WHERE queue=%s AND state != 'scheduled';", (self.name,))
+
+    def add_to_schedule(self, data, ts):
+        self.sql("""
+            INSERT INTO postgis_baselayers.queue_task (queue, data, state, run_after)
+            VALUES (%s, %s, 'scheduled', %s);
+        """, (self.name, psycopg2.Binary(data), ts))
+
+    def read_schedule(self, ts):
+        try:
+            rows = self.sql("""
+                DELETE FROM postgis_baselayers.queue_task
+                WHERE id IN (
+                    SELECT id FROM postgis_baselayers.queue_task
+                    WHERE queue=%s AND state='scheduled' AND run_after <= %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING data;
+            """, (self.name, ts), fetch='all')
+        except psycopg2.errors.UndefinedTable:
+            return []
+        return [bytes(row[0]) for row in rows]
+
+    def schedule_size(self):
+        return self.sql("""
+            SELECT count(*) FROM postgis_baselayers.queue_task WHERE queue=%s AND state='scheduled';
+        """, (self.name,), fetch='one')[0]
+
+    def scheduled_items(self, limit=None):
+        rows = self.sql("""
+            SELECT data FROM postgis_baselayers.queue_task WHERE queue=%s AND state='scheduled'
+            ORDER BY run_after LIMIT %s;
+        """, (self.name, limit), fetch='all')
+        return [bytes(row[0]) for row in rows]
+
+    def flush_schedule(self):
+        self.sql("DELETE FROM postgis_baselayers.queue_task WHERE queue=%s AND state='scheduled';", (self.name,))
+
+    def put_data(self, key, value):
+        self.sql("""
+            INSERT INTO postgis_baselayers.queue_data (queue, key, value) VALUES (%s, %s, %s)
+            ON CONFLICT (queue, key) DO UPDATE SET value=EXCLUDED.value;
+        """, (self.name, key, psycopg2.Binary(value)))
+
+    def peek_data(self, key):
+        row = self.sql("""
+            SELECT value FROM postgis_baselayers.queue_data WHERE queue=%s AND key=%s;
+        """, (self.name, key), fetch='one')
+        return EmptyData if row is None else bytes(row[0])
+
+    def pop_data(self, key):
+        row = self.sql("""
+            DELETE FROM postgis_baselayers.queue_data WHERE queue=%s AND key=%s RETURNING value;
+        """, (self.name, key), fetch='one')
+        return EmptyData if row is None else bytes(row[0])
+
+    def has_data_for_key(self, key):
+        return self.peek_data(key) is not EmptyData
+
+    def put_if_empty(self, key, value):
+        row = self.sql("""
+            INSERT INTO postgis_baselayers.queue_data (queue, key, value) VALUES (%s, %s, %s)
+            ON CONFLICT (queue, key) DO NOTHING RETURNING key;
+        """, (self.name, key, psycopg2.Binary(value)), fetch='one')
+        return row is not None
+
+    def result_store_size(self):
+        return self.sql("SELECT count(*) FROM postgis_baselayers.queue_data WHERE queue=%s;",
+                        (self.name,), fetch='one')[0]
+
+    def result_items(self):
+        rows = self.sql("SELECT key, value FROM postgis_baselayers.queue_data WHERE queue=%s;",
+                        (self.name,), fetch='all')
+        return {key: bytes(value) for (key, value) in rows}
+
+    def flush_results(self):
+        self.sql("DELETE FROM postgis_baselayers.queue_data WHERE queue=%s;", (self.name,))
+
+
+class PostgresHuey(Huey):
+    def __init__(self, name='huey', backoff=2, max_retry_delay=3600, **kwargs):
+        self.backoff = backoff
+        self.max_retry_delay = max_retry_delay
+        self._abandoned = []
+        super(PostgresHuey, self).__init__(name, **kwargs)
+
+    def get_storage(self, **kwargs):
+        return PostgresStorage(self.name, on_abandoned=self._handle_abandoned, **kwargs)
+
+    def abandoned(self):
+        """
+        Decorator for functions to call with the tasks that were abandoned
+        because the workers running them kept disappearing.
+        """
+        def decorator(fn):
+            self._abandoned.append(fn)
+            return fn
+        return decorator
+
+    def _handle_abandoned(self, data):
+        task = self.deserialize_task(data)
+        for fn in self._abandoned:
+            fn(task)
+
+    def execute(self, task, timestamp=None):
+        try:
+            return super(PostgresHuey, self).execute(task, timestamp)
+        finally:
+            if isinstance(self.storage, PostgresStorage):
+                self.storage.done()
+
+    def _requeue_task(self, task, timestamp):
+        task.retries -= 1
+        delay = task.retry_delay
+        if delay:
+            # The next retry waits longer.
+            task.retry_delay = min(delay * self.backoff, self.max_retry_delay)
+            task.eta = timestamp + datetime.timedelta(seconds=delay)
+            self.add_schedule(task)
+        else:
+            self.enqueue(task)
@@ -0,0 +1,108 @@
+import os
+import json
+
+import pytest
+
+from catalog import DatasetCatalog, CatalogError, validate, make_targets
+
+MAKEFILE = "install:\n\techo install\n\nuninstall:\n\techo uninstall\n"
+
+
+def write_dataset(directory, name, layers, makefiles=None):
+    path = os.path.join(directory, name)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'metadata.json'), 'w') as f:
+        json.dump({'name': name, 'metadata': {}, 'layers': layers}, f)
+    for layer in layers:
+        if makefiles is None or layer['name'] in makefiles:
+            with open(os.path.join(path, f"{layer['name']}.make"), 'w') as f:
+                f.write((makefiles or {}).get(layer['name'], MAKEFILE))
+    # Make sure the change shows up, whatever the resolution of mtimes.
+    stamp = os.stat(os.path.join(path, 'metadata.json')).st_mtime_ns + 1000000000
+    for entry in os.scandir(path):
+        os.utime(entry.path, ns=(stamp, stamp))
+    return path
+
+
+def layer(name, **kwargs):
+    return dict(name=name, metadata={}, **kwargs)
+
+
+def test_make_targets(tmp_path):
+    path = tmp_path / 'a.make'
+    path.write_text("install update: download\n\techo\nVAR := 1\nuninstall:\n\techo\n")
+    assert make_targets(str(path)) == {'install', 'update', 'uninstall'}
+
+
+def test_validate_accepts_valid_dataset(tmp_path):
+    path = write_dataset(str(tmp_path), 'ds', [layer('a', tables=['ds.a'])])
+    with open(os.path.join(path, 'metadata.json')) as f:
+        assert validate('ds', json.load(f), path) == []
+
+
+def test_validate_names_every_problem(tmp_path):
+    path = write_dataset(str(tmp_path), 'ds', [layer('a'), layer('b', updates=[{}])],
+                         makefiles={'b': MAKEFILE})
+    dataset = {
+        'name': 'other',
+        'metadata': {},
+        'downloads': [],
+        'layers': [
+            layer('a', tables=['no_schema']),
+            layer('a'),
+            layer('Bad-Name'),
+            layer('b', updates=[{}], report_queries=['no_such_query', {'name': 'x'}],
+                  indexes=[{'table': 'ds.b', 'columns': ['id']}, {'table': 'ds.b', 'columns': ['id']}]),
+        ]
+    }
+    problems = validate('ds', dataset, path)
+    assert "name 'other' doesn't match its directory" in problems
+    assert "'downloads' must be declared on the layers that use them, not on the dataset" in problems
+    assert "table 'no_schema' of layer 'a' must be named as 'schema.table'" in problems
+    assert "layer 'a' is listed more than once" in problems
+    assert "layer name 'Bad-Name' must consist of lowercase letters, digits and underscores" in problems
+    assert "layer 'a' has no makefile a.make" in problems
+    assert "b.make has no target update" in problems
+    assert "layer 'b' has an unknown report query 'no_such_query'" in problems
+    assert "report queries of layer 'b' need a 'name' and a 'query'" in problems
+    assert "layer 'b' has more than one index or constraint named 'idx_b_id' in ds" in problems
+
+
+def test_validate_needs_layers(tmp_path):
+    assert validate('ds', {'name': 'ds', 'metadata': {}}, str(tmp_path)) == ["'layers' must be a list of layers"]
+
+
+def test_loads_and_refreshes(tmp_path):
+    directory = str(tmp_path)
+    write_dataset(directory, 'ds', [layer('a')])
+    catalog = DatasetCatalog(directory, interval=0)
+    assert catalog.refresh() is True
+    assert list(catalog.layers()) == ['ds.a']
+    assert catalog.refresh() is False
+
+    write_dataset(directory, 'other', [layer('b', depends_on=['ds.a'])])
+    assert sorted(catalog.layers()) == ['ds.a', 'other.b']
+    assert catalog.get('other')['readme'] == ''
+
+
+def test_first_load_raises(tmp_path):
+    write_dataset(str(tmp_path), 'ds', [layer('a', depends_on=['missing'])])
+    with pytest.raises(CatalogError, match="depends on unknown layer 'ds.missing'"):
+        DatasetCatalog(str(tmp_path)).refresh()
+
+
+def test_keeps_last_valid_catalog(tmp_path):
+    directory = str(tmp_path)
+    write_dataset(directory, 'ds', [layer('a')])
+    catalog = DatasetCatalog(directory, interval=0)
+    catalog.refresh()
+
+    # An edit that breaks the dataset.
+    write_dataset(directory, 'ds', [layer('a'), layer('b')], makefiles={})
+    assert list(catalog.layers()) == ['ds.a']
+    assert "layer 'b' has no makefile b.make" in catalog.error
+
+    # And the fix.
+    write_dataset(directory, 'ds', [layer('a'), layer('b')])
+    assert sorted(catalog.layers()) == ['ds.a', 'ds.b']
+    assert catalog.error is None
@@ -0,0 +1,214 @@
+import os
+import time
+import types
+import hashlib
+import threading
+import http.server
+
+import pytest
+
+import downloads
+from downloads import DownloadCache, DownloadError
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the files of the server, honouring conditional and range
+    requests like a well behaved web server.
+    """
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        f = self.server.files.get(self.path)
+        if f is None:
+            self.send_error(404)
+            return
+        body = f['body']
+        etag = f.get('etag')
+        last_modified = f.get('last_modified')
+        if (etag and self.headers.get('If-None-Match') == etag) or \
+           (last_modified and self.headers.get('If-Modified-Since') == last_modified):
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        start = 0
+        if_range = self.headers.get('If-Range')
+        if self.headers.get('Range') and if_range and if_range in (etag, last_modified):
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{len(body) - 1}/{len(body)}")
+        else:
+            self.send_response(200)
+        if etag:
+            self.send_header('ETag', etag)
+        if last_modified:
+            self.send_header('Last-Modified', last_modified)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+
+        cut = f.pop('cut', None)
+        if cut is not None:
+            # Hang up halfway, like a dropped connection.
+            self.wfile.write(body[start:start + cut])
+            self.close_connection = True
+            return
+        self.wfile.write(body[start:])
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.files = {}
+    httpd.requests = []
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    thread = threading.Thread(target=httpd.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return DownloadCache(str(tmp_path / 'cache'), 1024 * 1024, timeout=5, log=lambda msg: None)
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def test_revalidates_with_etag(server, cache, tmp_path):
+    server.files['/a.zip'] = {'body': b'a' * 1000, 'etag': '"v1"'}
+    dest = str(tmp_path / 'a.zip')
+    assert cache.fetch(server.url + '/a.zip', dest) == 'miss'
+    os.remove(dest)
+    assert cache.fetch(server.url + '/a.zip', dest) == 'hit'
+    assert server.requests[-1][1]['If-None-Match'] == '"v1"'
+    with open(dest, 'rb') as f:
+        assert f.read() == b'a' * 1000
+
+
+def test_revalidates_with_last_modified(server, cache, tmp_path):
+    date = 'Mon, 01 Jun 2020 00:00:00 GMT'
+    server.files['/a.csv'] = {'body': b'1,2\n', 'last_modified': date}
+    assert cache.fetch(server.url + '/a.csv') == 'miss'
+    assert cache.fetch(server.url + '/a.csv') == 'hit'
+    assert server.requests[-1][1]['If-Modified-Since'] == date
+
+
+def test_downloads_changed_file_again(server, cache, tmp_path):
+    server.files['/a.zip'] = {'body': b'old', 'etag': '"v1"'}
+    cache.fetch(server.url + '/a.zip')
+    server.files['/a.zip'] = {'body': b'new', 'etag': '"v2"'}
+    dest = str(tmp_path / 'a.zip')
+    assert cache.fetch(server.url + '/a.zip', dest) == 'miss'
+    with open(dest, 'rb') as f:
+        assert f.read() == b'new'
+
+
+def test_resumes_partial_download(server, cache, tmp_path):
+    body = os.urandom(300 * 1024)
+    server.files['/big.zip'] = {'body': body, 'etag': '"v1"', 'cut': 100 * 1024}
+    dest = str(tmp_path / 'big.zip')
+    with pytest.raises(DownloadError):
+        cache.fetch(server.url + '/big.zip', dest)
+    assert os.path.getsize(cache._partial_path(server.url + '/big.zip')) == 100 * 1024
+
+    assert cache.fetch(server.url + '/big.zip', dest) == 'miss'
+    headers = server.requests[-1][1]
+    assert headers['Range'] == f"bytes={100 * 1024}-"
+    assert headers['If-Range'] == '"v1"'
+    with open(dest, 'rb') as f:
+        assert f.read() == body
+    assert cache._read_index()[server.url + '/big.zip']['sha256'] == sha256(body)
+    assert not os.path.exists(cache._partial_path(server.url + '/big.zip'))
+
+
+def test_partial_download_starts_over_when_changed(server, cache, tmp_path):
+    server.files['/big.zip'] = {'body': b'x' * 200000, 'etag': '"v1"', 'cut': 50000}
+    with pytest.raises(DownloadError):
+        cache.fetch(server.url + '/big.zip')
+    server.files['/big.zip'] = {'body': b'y' * 200000, 'etag': '"v2"'}
+    dest = str(tmp_path / 'big.zip')
+    assert cache.fetch(server.url + '/big.zip', dest) == 'miss'
+    with open(dest, 'rb') as f:
+        assert f.read() == b'y' * 200000
+
+
+def test_weak_etag_is_not_resumed(server, cache):
+    server.files['/big.zip'] = {'body': b'x' * 200000, 'etag': 'W/"v1"', 'cut': 50000}
+    with pytest.raises(DownloadError):
+        cache.fetch(server.url + '/big.zip')
+    assert not os.path.exists(cache._partial_path(server.url + '/big.zip'))
+
+
+def test_sha256_mismatch(server, cache, tmp_path):
+    server.files['/a.zip'] = {'body': b'data', 'etag': '"v1"'}
+    dest = str(tmp_path / 'a.zip')
+    with pytest.raises(DownloadError, match='sha256'):
+        cache.fetch(server.url + '/a.zip', dest, sha256=sha256(b'other'))
+    assert not os.path.exists(dest)
+    assert cache._read_index() == {}
+    assert os.listdir(cache.objects_dir) == []
+
+    assert cache.fetch(server.url + '/a.zip', dest, sha256=sha256(b'data')) == 'miss'
+    assert cache.fetch(server.url + '/a.zip', dest, sha256=sha256(b'data')) == 'hit'
+
+
+def test_sha256_mismatch_of_cached_copy(server, cache, tmp_path):
+    server.files['/a.zip'] = {'body': b'old', 'etag': '"v1"'}
+    cache.fetch(server.url + '/a.zip')
+    # The server didn't change the ETag, but the file is expected to be new.
+    server.files['/a.zip'] = {'body': b'new', 'etag': '"v1"'}
+    dest = str(tmp_path / 'a.zip')
+    assert cache.fetch(server.url + '/a.zip', dest, sha256=sha256(b'new')) == 'miss'
+    assert 'If-None-Match' not in server.requests[-1][1]
+    with open(dest, 'rb') as f:
+        assert f.read() == b'new'
+
+
+def test_evicts_least_recently_used(server, tmp_path, monkeypatch):
+    clock = iter(range(int(time.time()), int(time.time()) + 1000))
+    monkeypatch.setattr(downloads, 'time', types.SimpleNamespace(time=lambda: next(clock)))
+    cache = DownloadCache(str(tmp_path / 'cache'), 250, timeout=5, log=lambda msg: None)
+    for name in 'abc':
+        server.files[f"/{name}"] = {'body': name.encode() * 100, 'etag': f'"{name}"'}
+
+    cache.fetch(server.url + '/a')
+    cache.fetch(server.url + '/b')
+    assert cache.fetch(server.url + '/a') == 'hit'
+    cache.fetch(server.url + '/c')
+
+    index = cache._read_index()
+    assert sorted(index) == [server.url + '/a', server.url + '/c']
+    assert sorted(os.listdir(cache.objects_dir)) == sorted([sha256(b'a' * 100), sha256(b'c' * 100)])
+    assert cache.stats()['size'] == 200
+
+
+def test_downloads_from_mirror(server, tmp_path):
+    server.files['/mirror/example.com/data/a.zip'] = {'body': b'mirrored', 'etag': '"v1"'}
+    server.files['/mirror/example.com/query?x=1'] = {'body': b'query', 'etag': '"v1"'}
+    cache = DownloadCache(str(tmp_path / 'cache'), 1024 * 1024, timeout=5, log=lambda msg: None,
+                          mirror=server.url + '/mirror/')
+    dest = str(tmp_path / 'a.zip')
+    assert cache.fetch('http://example.com/data/a.zip', dest) == 'miss'
+    assert server.requests[-1][0] == '/mirror/example.com/data/a.zip'
+    with open(dest, 'rb') as f:
+        assert f.read() == b'mirrored'
+    assert list(cache._read_index()) == ['http://example.com/data/a.zip']
+
+    cache.fetch('https://example.com/query?x=1')
+    assert server.requests[-1][0] == '/mirror/example.com/query?x=1'
+
+
+def test_open_streams_into_cache(server, cache):
+    server.files['/a.txt'] = {'body': b'line\n' * 10, 'etag': '"v1"'}
+    with cache.open(server.url + '/a.txt') as f:
+        assert f.read() == b'line\n' * 10
+        f.read()
+    with cache.open(server.url + '/a.txt') as f:
+        assert f.read() == b'line\n' * 10
+    assert server.requests[-1][1]['If-None-Match'] == '"v1"'
@@ -0,0 +1,102 @@
+import io
+import zipfile
+
+import pytest
+
+from importer import iter_line_chunks, ZipMemberStream, StreamImportError
+
+
+class Trickle(object):
+    """
+    Non-seekable stream that returns at most `size` bytes per read.
+    """
+    def __init__(self, data, size=1000):
+        self.f = io.BytesIO(data)
+        self.size = size
+
+    def read(self, size=-1):
+        return self.f.read(min(size, self.size) if size >= 0 else self.size)
+
+
+class Unseekable(object):
+    def __init__(self):
+        self.f = io.BytesIO()
+
+    def write(self, data):
+        return self.f.write(data)
+
+    def flush(self):
+        pass
+
+
+def read_all(stream, size=4096):
+    parts = []
+    while True:
+        data = stream.read(size)
+        if not data:
+            return b''.join(parts)
+        parts.append(data)
+
+
+def test_iter_line_chunks_ends_chunks_on_lines():
+    data = b''.join(b"%d,row number %d\n" % (i, i) for i in range(1000))
+    chunks = list(iter_line_chunks(io.BytesIO(data), 100))
+    assert b''.join(chunks) == data
+    assert all(chunk.endswith(b'\n') for chunk in chunks)
+    assert all(chunk.count(b'\n') >= 1 for chunk in chunks)
+
+
+def test_iter_line_chunks_with_lines_longer_than_a_chunk():
+    data = b'x' * 250 + b'\n' + b'y' * 10 + b'\n' + b'z' * 150 + b'\n'
+    chunks = list(iter_line_chunks(io.BytesIO(data), 100))
+    assert b''.join(chunks) == data
+    assert all(chunk.endswith(b'\n') for chunk in chunks)
+    assert b'x' * 250 + b'\n' in chunks[0]
+
+
+def test_iter_line_chunks_keeps_last_line_without_newline():
+    assert list(iter_line_chunks(io.BytesIO(b'a\nb'), 100)) == [b'a\n', b'b']
+    assert list(iter_line_chunks(io.BytesIO(b''), 100)) == []
+
+
+def make_zip(members, f=None):
+    f = f or io.BytesIO()
+    with zipfile.ZipFile(f, 'w') as archive:
+        for (name, data, method) in members:
+            archive.writestr(zipfile.ZipInfo(name), data, compress_type=method)
+    return (f.f if isinstance(f, Unseekable) else f).getvalue()
+
+
+BIG = b''.join(b"%d\tsome text that compresses well\n" % i for i in range(100000))
+
+
+@pytest.mark.parametrize('member,expected', [
+    ('first.txt', b'first'),
+    ('stored.txt', b'stored data'),
+    ('big.txt', BIG),
+])
+def test_zip_member_stream(member, expected):
+    data = make_zip([('first.txt', b'first', zipfile.ZIP_DEFLATED),
+                     ('stored.txt', b'stored data', zipfile.ZIP_STORED),
+                     ('big.txt', BIG, zipfile.ZIP_DEFLATED)])
+    assert read_all(ZipMemberStream(Trickle(data), member)) == expected
+
+
+def test_zip_member_stream_with_data_descriptors():
+    # Archives written to a pipe have the sizes after the data.
+    data = make_zip([('first.txt', BIG, zipfile.ZIP_DEFLATED),
+                     ('second.txt', b'second', zipfile.ZIP_DEFLATED)], Unseekable())
+    assert read_all(ZipMemberStream(Trickle(data, 70000), 'second.txt')) == b'second'
+    assert read_all(ZipMemberStream(Trickle(data, 70000), 'first.txt')) == BIG
+
+
+def test_zip_member_stream_missing_member():
+    data = make_zip([('first.txt', b'first', zipfile.ZIP_DEFLATED)])
+    with pytest.raises(StreamImportError, match='not found'):
+        ZipMemberStream(Trickle(data), 'other.txt')
+
+
+def test_zip_member_stream_truncated():
+    data = make_zip([('big.txt', BIG, zipfile.ZIP_DEFLATED)])
+    with pytest.raises(StreamImportError, match='Unexpected end'):
+        read_all(ZipMemberStream(Trickle(data[:len(data) // 2]), 'big.txt'))
@@ -0,0 +1,136 @@
+import types
+import threading
+
+import psycopg2
+import psycopg2.extensions
+import pytest
+
+import pool
+from pool import ConnectionPool, PoolExhausted
+
+
+class FakeCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query):
+        if self.conn.broken:
+            raise psycopg2.OperationalError("server closed the connection")
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+        self.rollbacks = 0
+        self.info = types.SimpleNamespace(transaction_status=psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+def test_fill_opens_min_size():
+    p = ConnectionPool(FakeConnection, min_size=2, max_size=4)
+    p.fill()
+    assert p.stats()['idle'] == 2
+    p.fill()
+    assert p.stats()['created'] == 2
+
+
+def test_reuses_returned_connections():
+    p = ConnectionPool(FakeConnection, min_size=0, max_size=2)
+    conn = p.getconn()
+    p.putconn(conn)
+    assert p.getconn() is conn
+    assert p.stats()['created'] == 1
+
+
+def test_rolls_back_open_transactions():
+    p = ConnectionPool(FakeConnection, min_size=0, max_size=2)
+    conn = p.getconn()
+    conn.rollbacks = 0
+    conn.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+    p.putconn(conn)
+    assert conn.rollbacks == 1
+    assert p.stats()['idle'] == 1
+
+
+def test_recycles_after_max_uses():
+    p = ConnectionPool(FakeConnection, min_size=0, max_size=2, max_uses=2)
+    first = p.getconn()
+    p.putconn(first)
+    assert p.getconn() is first
+    p.putconn(first)
+    assert first.closed
+    assert p.getconn() is not first
+    assert p.stats()['recycled'] == 1
+
+
+def test_replaces_unhealthy_connections():
+    p = ConnectionPool(FakeConnection, min_size=0, max_size=2)
+    conn = p.getconn()
+    p.putconn(conn)
+    conn.broken = True
+    assert p.getconn() is not conn
+    assert conn.closed
+    assert p.stats()['failed_checks'] == 1
+
+
+def test_exhausted():
+    p = ConnectionPool(FakeConnection, min_size=0, max_size=1, timeout=0.05)
+    p.getconn()
+    with pytest.raises(PoolExhausted):
+        p.getconn()
+    assert p.stats()['timeouts'] == 1
+
+
+def test_waits_for_a_returned_connection():
+    p = ConnectionPool(FakeConnection, min_size=0, max_size=1, timeout=5)
+    conn = p.getconn()
+    threading.Timer(0.05, p.putconn, args=(conn,)).start()
+    assert p.getconn() is conn
+    assert p.stats()['waits'] >= 1
+
+
+def test_failed_connect_frees_its_slot():
+    def connect():
+        raise psycopg2.OperationalError("could not connect")
+    p = ConnectionPool(connect, min_size=1, max_size=1, timeout=0.05)
+    with pytest.raises(psycopg2.OperationalError):
+        p.fill()
+    with pytest.raises(psycopg2.OperationalError):
+        p.getconn()
+    p.connect = FakeConnection
+    assert p.getconn() is not None
+
+
+def test_inherited_connections_are_not_closed(monkeypatch):
+    p = ConnectionPool(FakeConnection, min_size=0, max_size=2)
+    idle = p.getconn()
+    in_use = p.getconn()
+    p.putconn(idle)
+
+    # As if the pool was inherited through a fork.
+    monkeypatch.setattr(pool, 'os', types.SimpleNamespace(getpid=lambda: -1))
+    p.putconn(in_use)
+    fresh = p.getconn()
+    assert fresh is not idle and fresh is not in_use
+    assert not idle.closed and not in_use.closed
+    assert p.stats()['size'] == 1
+
+
+def test_closes_connections_it_does_not_know():
+    p = ConnectionPool(FakeConnection, min_size=0, max_size=2)
+    stranger = FakeConnection()
+    p.putconn(stranger)
+    assert stranger.closed
@@ -0,0 +1,85 @@
+import pytest
+
+from scheduler import build_plan, PlanError, FETCH_PREFIX
+
+
+def keys(plan):
+    return [node['key'] for node in plan['nodes']]
+
+
+def test_orders_dependencies_first():
+    layers = {
+        'ds.a': {},
+        'ds.b': {'depends_on': ['a']},
+        'other.c': {'depends_on': ['ds.b']},
+    }
+    plan = build_plan(layers, {'other.c': 'install'}, set())
+    assert keys(plan) == ['ds.a', 'ds.b', 'other.c']
+    nodes = {node['key']: node for node in plan['nodes']}
+    assert nodes['ds.a']['reason'] == 'required by ds.b'
+    assert nodes['other.c']['reason'] == 'selected'
+
+
+def test_skips_installed_dependencies():
+    layers = {'ds.a': {}, 'ds.b': {'depends_on': ['a']}}
+    plan = build_plan(layers, {'ds.b': 'install'}, {'ds.a'})
+    assert keys(plan) == ['ds.b']
+    assert plan['nodes'][0]['depends_on'] == []
+
+
+def test_uninstall_has_no_dependencies():
+    layers = {'ds.a': {}, 'ds.b': {'depends_on': ['a']}}
+    plan = build_plan(layers, {'ds.b': 'uninstall'}, set())
+    assert keys(plan) == ['ds.b']
+
+
+def test_critical_path():
+    layers = {
+        'ds.a': {},
+        'ds.b': {'depends_on': ['a']},
+        'ds.c': {'depends_on': ['a']},
+        'ds.d': {'depends_on': ['b', 'c']},
+    }
+    durations = {'ds.a': 10, 'ds.b': 100, 'ds.c': 5, 'ds.d': 1}
+    plan = build_plan(layers, {'ds.d': 'install'}, set(), durations)
+    assert plan['critical_path'] == ['ds.a', 'ds.b', 'ds.d']
+    assert plan['total_duration'] == 111
+    assert plan['serial_duration'] == 116
+    nodes = {node['key']: node for node in plan['nodes']}
+    assert nodes['ds.c']['start'] == 10 and nodes['ds.c']['finish'] == 15
+    assert nodes['ds.d']['start'] == 110
+    assert not nodes['ds.c'].get('critical')
+
+
+def test_estimated_and_default_durations():
+    layers = {'ds.a': {'estimated_duration': 60}, 'ds.b': {}}
+    plan = build_plan(layers, {'ds.a': 'install', 'ds.b': 'install'}, set())
+    assert [node['duration'] for node in plan['nodes']] == [60, 300]
+
+
+def test_shared_downloads_get_a_fetch_node():
+    shared = 'https://example.com/shared.zip'
+    layers = {
+        'ds.a': {'downloads': [shared, 'https://example.com/a.zip']},
+        'ds.b': {'downloads': [shared]},
+        'ds.c': {'downloads': ['https://example.com/c.zip']},
+    }
+    plan = build_plan(layers, {'ds.a': 'install', 'ds.b': 'install', 'ds.c': 'install'}, set())
+    fetch_key = FETCH_PREFIX + 'ds'
+    assert keys(plan)[0] == fetch_key
+    nodes = {node['key']: node for node in plan['nodes']}
+    assert nodes[fetch_key]['downloads'] == [shared]
+    assert nodes['ds.a']['depends_on'] == [fetch_key]
+    assert nodes['ds.b']['depends_on'] == [fetch_key]
+    assert nodes['ds.c']['depends_on'] == []
+
+
+def test_unknown_dependency():
+    with pytest.raises(PlanError, match="unknown layer 'ds.missing'"):
+        build_plan({'ds.a': {'depends_on': ['missing']}}, {'ds.a': 'install'}, set())
+
+
+def test_cycle():
+    layers = {'ds.a': {'depends_on': ['b']}, 'ds.b': {'depends_on': ['a']}}
+    with pytest.raises(PlanError, match='cycle'):
+        build_plan(layers, {'ds.a': 'install'}, set())
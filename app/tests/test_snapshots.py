@@ -0,0 +1,52 @@
+import io
+import os
+import json
+import datetime
+
+from snapshots import libpq_args, CopyData, snapshot_name, list_snapshots, remove_snapshots, SNAPSHOT_FILE
+
+
+def test_libpq_args_leave_out_password():
+    (dsn, env) = libpq_args('postgresql://user:s%40cret@db:5432/gis?sslmode=require')
+    assert 's@cret' not in dsn and 'password' not in dsn
+    assert 'dbname=gis' in dsn and 'host=db' in dsn and 'sslmode=require' in dsn
+    assert env['PGPASSWORD'] == 's@cret'
+
+
+def test_libpq_args_other_database():
+    (dsn, env) = libpq_args('host=db user=user dbname=gis', dbname='scratch')
+    assert 'dbname=scratch' in dsn
+    assert 'PGPASSWORD' not in env or env['PGPASSWORD'] == os.environ.get('PGPASSWORD')
+
+
+def test_copy_data_stops_at_end_marker():
+    f = io.StringIO("1\ta\n2\tb\n\\.\n\nSELECT 1;\n")
+    data = CopyData(f)
+    assert data.read(3) == "1\ta\n"
+    assert data.read() == "2\tb\n"
+    assert data.read() == ""
+    assert f.readline() == "\n"
+
+
+def write_snapshot(directory, key, version, created):
+    name = snapshot_name(version, created)
+    path = os.path.join(directory, key, name)
+    os.makedirs(path)
+    with open(os.path.join(path, SNAPSHOT_FILE), 'w') as f:
+        json.dump({'key': key, 'version': version, 'created': created.isoformat()}, f)
+    return name
+
+
+def test_list_and_remove_snapshots(tmp_path):
+    directory = str(tmp_path)
+    old = write_snapshot(directory, 'ds.a', 1, datetime.datetime(2020, 1, 1))
+    new = write_snapshot(directory, 'ds.a', 2, datetime.datetime(2020, 6, 1))
+    # An export that didn't finish.
+    os.makedirs(os.path.join(directory, 'ds.a', '.v3-20200701000000'))
+
+    assert new == 'v2-20200601000000'
+    assert [s['name'] for s in list_snapshots(directory, 'ds.a')] == [new, old]
+    assert list_snapshots(directory, 'ds.b') == []
+
+    remove_snapshots(directory, 'ds.a', keep=1)
+    assert [s['name'] for s in list_snapshots(directory, 'ds.a')] == [new]
@@ -0,0 +1,93 @@
+import logging
+
+from tasklog import TaskLogHandler, for_task
+
+
+class FakeCursor(object):
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def execute(self, query, params=None):
+        if params:
+            self.chunks.append(params)
+
+
+class FakeConnection(object):
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def cursor(self):
+        return FakeCursor(self.chunks)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+def make_handler(task_id='task-1', **kwargs):
+    chunks = []
+    handler = TaskLogHandler(lambda: FakeConnection(chunks), lambda conn: None, task_id, **kwargs)
+    logger = logging.getLogger(f"test_tasklog.{task_id}")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    return (handler, logger, chunks)
+
+
+def content(chunks):
+    return ''.join(chunk[2] for chunk in chunks)
+
+
+def test_writes_in_chunks():
+    (handler, logger, chunks) = make_handler(chunk_size=20)
+    log = for_task(logger, 'task-1')
+    for i in range(5):
+        log.info(f"line {i}")
+    assert [seq for (_, seq, _) in chunks] == [0]
+    handler.close()
+    logger.removeHandler(handler)
+    assert [seq for (_, seq, _) in chunks] == [0, 1]
+    assert content(chunks) == ''.join(f"line {i}\n" for i in range(5))
+
+
+def test_only_stores_records_of_its_task():
+    (handler, logger, chunks) = make_handler()
+    for_task(logger, 'task-1').info("mine")
+    for_task(logger, 'task-2').info("someone else's")
+    logger.info("no task at all")
+    handler.close()
+    logger.removeHandler(handler)
+    assert content(chunks) == "mine\n"
+
+
+def test_redacts_secrets():
+    (handler, logger, chunks) = make_handler(redactions={'hunter2': '********', '': 'ignored'})
+    for_task(logger, 'task-1').info("postgresql://user:hunter2@db/gis")
+    handler.close()
+    logger.removeHandler(handler)
+    assert content(chunks) == "postgresql://user:********@db/gis\n"
+
+
+def test_keeps_head_and_tail():
+    (handler, logger, chunks) = make_handler(head_size=20, tail_size=20)
+    log = for_task(logger, 'task-1')
+    for i in range(1, 10):
+        log.info(f"line {i}")
+    handler.close()
+    logger.removeHandler(handler)
+    assert content(chunks) == ("line 1\nline 2\n"
+                               "\n[... 5 lines (35 bytes) omitted ...]\n\n"
+                               "line 8\nline 9\n")
+
+
+def test_no_lines_in_head_after_one_did_not_fit():
+    (handler, logger, chunks) = make_handler(head_size=20, tail_size=100)
+    log = for_task(logger, 'task-1')
+    log.info("short")
+    log.info("a line that is too long for the head")
+    log.info("short")
+    handler.close()
+    logger.removeHandler(handler)
+    assert content(chunks) == "short\na line that is too long for the head\nshort\n"
@@ -0,0 +1,29 @@
+import pytest
+
+from tiles import tile_envelope, WORLD_SIZE
+
+HALF = WORLD_SIZE / 2
+
+
+def test_whole_world():
+    assert tile_envelope(0, 0, 0) == pytest.approx((-HALF, -HALF, HALF, HALF))
+
+
+def test_quadrants():
+    assert tile_envelope(1, 0, 0) == pytest.approx((-HALF, 0, 0, HALF))
+    assert tile_envelope(1, 1, 1) == pytest.approx((0, -HALF, HALF, 0))
+
+
+def test_neighbours_share_edges():
+    (xmin, ymin, xmax, ymax) = tile_envelope(10, 524, 340)
+    assert xmax - xmin == pytest.approx(WORLD_SIZE / 1024)
+    assert ymax - ymin == pytest.approx(WORLD_SIZE / 1024)
+    assert tile_envelope(10, 525, 340)[0] == pytest.approx(xmax)
+    assert tile_envelope(10, 524, 341)[3] == pytest.approx(ymin)
+    # The last tile of a row ends at the edge of the world.
+    assert tile_envelope(10, 1023, 1023)[1:3] == pytest.approx((-HALF, HALF))
+
+
+def test_margin():
+    (xmin, ymin, xmax, ymax) = tile_envelope(2, 1, 2)
+    assert tile_envelope(2, 1, 2, margin=10) == pytest.approx((xmin - 10, ymin - 10, xmax + 10, ymax + 10))
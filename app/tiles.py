@@ -0,0 +1,271 @@
+"""
+Mapbox vector tiles of installed layers, served on /tiles/<layer>/<z>/<x>/<y>.mvt.
+
+A tile has a layer for every table of the layer with a geometry column,
+named after the table and with all of its other columns as attributes. It
+is built with ST_AsMVT from the rows of which the geometry intersects the
+tile (plus a margin, so that lines and outlines continue across tiles).
+Geometries are clipped to that area before they're transformed to Web
+Mercator, which can't transform the poles.
+
+Tiles are cached in memory, in an LRU cache per process, and on disk in a
+directory shared by all processes, of which the least recently used tiles
+are removed when it grows beyond its size limit. Cached tiles are stored
+under the generation of their layer, which changes whenever the layer is
+installed, updated or rolled back, so a tile is never served from the
+cache after the data it was built from has changed. The generation is also
+the ETag of the tiles, which lets clients revalidate them without the tile
+being built or even read from the cache. run_task removes the tiles of the
+previous generations of a layer from disk once it has been reinstalled.
+"""
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+from psycopg2 import sql
+
+EXTENT = 4096
+BUFFER = 64
+
+# Width of the world in Web Mercator (EPSG:3857) meters.
+WORLD_SIZE = 40075016.68557849
+
+
+def generation(version, installed, last_update):
+    """
+    Returns a short identifier of the state of the data of a layer.
+    """
+    state = f"{version}|{installed.isoformat() if installed else ''}|{last_update or ''}"
+    return hashlib.sha1(state.encode()).hexdigest()[:16]
+
+
+def valid_tile(z, x, y, max_zoom=24):
+    return 0 <= z <= max_zoom and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def tile_envelope(z, x, y, margin=0):
+    """
+    Returns the bounds of a tile in Web Mercator as (xmin, ymin, xmax, ymax),
+    like ST_TileEnvelope, which needs PostGIS 3.0.
+    """
+    size = WORLD_SIZE / 2 ** z
+    xmin = -WORLD_SIZE / 2 + x * size
+    ymax = WORLD_SIZE / 2 - y * size
+    return (xmin - margin, ymax - size - margin, xmin + size + margin, ymax + margin)
+
+
+def table_sources(cur, tables):
+    """
+    Returns (table, geometry column, srid, other columns) for each of the
+    tables that exists and has a geometry column.
+    """
+    sources = []
+    for table in tables:
+        (schema, _, name) = table.rpartition('.')
+        cur.execute("""
+            SELECT f_geometry_column, srid FROM geometry_columns
+            WHERE f_table_schema=%s AND f_table_name=%s ORDER BY f_geometry_column LIMIT 1;
+        """, (schema, name))
+        row = cur.fetchone()
+        if row is None:
+            continue
+        cur.execute("""
+            SELECT attname FROM pg_attribute
+            WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+              AND format_type(atttypid, NULL) NOT IN ('geometry', 'geography', 'raster')
+            ORDER BY attnum;
+        """, (table,))
+        sources.append((table, row[0], row[1], [r[0] for r in cur.fetchall()]))
+    return sources
+
+
+def build_tile(cur, sources, z, x, y):
+    """
+    Returns the tile with the features of the given tables (see
+    table_sources) as bytes. The tiles of each table are concatenated, which
+    is a valid tile with all of their layers.
+    """
+    margin = WORLD_SIZE / 2 ** z * BUFFER / EXTENT
+    envelope = sql.SQL("ST_MakeEnvelope({}, {}, {}, {}, 3857)")
+    bounds = envelope.format(*[sql.Literal(v) for v in tile_envelope(z, x, y)])
+    search = envelope.format(*[sql.Literal(v) for v in tile_envelope(z, x, y, margin)])
+    tile = b''
+    for (table, geom, srid, columns) in sources:
+        query = sql.SQL("""
+            SELECT ST_AsMVT(tile, %(name)s, %(extent)s, '__mvt_geom') FROM (
+                SELECT {columns}
+                    ST_AsMVTGeom(ST_Transform(ST_ClipByBox2D({geom}, search.box), 3857), {bounds},
+                                 %(extent)s, %(buffer)s, true) AS __mvt_geom
+                FROM {table}, (SELECT ST_Transform({search}, %(srid)s) AS box) AS search
+                WHERE {geom} && search.box
+            ) AS tile
+            WHERE __mvt_geom IS NOT NULL;
+        """).format(table=sql.Identifier(*table.split('.')), geom=sql.Identifier(geom),
+                    bounds=bounds, search=search,
+                    columns=sql.SQL('').join(sql.SQL("{}, ").format(sql.Identifier(c)) for c in columns))
+        cur.execute(query, {'name': table.rpartition('.')[2], 'extent': EXTENT, 'buffer': BUFFER,
+                            'srid': srid})
+        row = cur.fetchone()
+        if row and row[0]:
+            tile += bytes(row[0])
+    return tile
+
+
+def directory_size(path):
+    size = 0
+    for (root, dirs, files) in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+class TileCache(object):
+    def __init__(self, directory, max_size, memory_size, log=print):
+        self.directory = directory
+        self.max_size = max_size
+        self.memory_size = memory_size
+        self.log = log
+        self.memory = OrderedDict()
+        self.memory_used = 0
+        self.disk_used = None
+        self.lock = threading.Lock()
+        self.counts = {'memory': 0, 'disk': 0, 'built': 0, 'not_modified': 0}
+        self.evicting = None    # pid of the process that is evicting
+        if self.max_size:
+            # Find out how much is on disk already without holding anything
+            # up, the cache isn't limited until then.
+            self._evict_in_background()
+
+    def _path(self, key, generation, z, x, y):
+        return os.path.join(self.directory, key, generation, str(z), str(x), f"{y}.mvt")
+
+    def count(self, result):
+        with self.lock:
+            self.counts[result] += 1
+
+    def get(self, key, generation, z, x, y):
+        """
+        Returns a cached tile, or None.
+        """
+        with self.lock:
+            tile = self.memory.get((key, generation, z, x, y))
+            if tile is not None:
+                self.memory.move_to_end((key, generation, z, x, y))
+                self.counts['memory'] += 1
+                return tile
+        if not self.max_size:
+            return None
+        path = self._path(key, generation, z, x, y)
+        try:
+            with open(path, 'rb') as f:
+                tile = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        self.count('disk')
+        self._remember((key, generation, z, x, y), tile)
+        return tile
+
+    def put(self, key, generation, z, x, y, tile):
+        self.count('built')
+        self._remember((key, generation, z, x, y), tile)
+        if not self.max_size:
+            return
+        path = self._path(key, generation, z, x, y)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(tile)
+            os.replace(tmp, path)
+        except OSError as e:
+            self.log(f"Could not cache tile {path}: {e}")
+            return
+        with self.lock:
+            if self.disk_used is not None:
+                self.disk_used += len(tile)
+            # Not known yet, or not in a process forked after it was.
+            full = self.disk_used is None or self.disk_used > self.max_size
+        if full:
+            self._evict_in_background()
+
+    def _remember(self, cache_key, tile):
+        if len(tile) > self.memory_size:
+            return
+        with self.lock:
+            if cache_key not in self.memory:
+                self.memory[cache_key] = tile
+                self.memory_used += len(tile)
+            while self.memory_used > self.memory_size:
+                (_, evicted) = self.memory.popitem(last=False)
+                self.memory_used -= len(evicted)
+
+    def _evict_in_background(self):
+        with self.lock:
+            if self.evicting == os.getpid():
+                return
+            self.evicting = os.getpid()
+        threading.Thread(target=self.evict, name='tile-cache-evict', daemon=True).start()
+
+    def evict(self):
+        """
+        Remove the least recently used tiles from disk until the cache is
+        within 90% of its size limit. This walks the whole cache, so it runs
+        in a thread of its own when the cache has grown too large. The size
+        is kept track of in between, but only of the tiles this process
+        added and removed.
+        """
+        try:
+            tiles = []
+            for (root, dirs, files) in os.walk(self.directory):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    tiles.append((stat.st_mtime, stat.st_size, path))
+            total = sum(t[1] for t in tiles)
+            if total > self.max_size:
+                for (_, size, path) in sorted(tiles):
+                    if total <= self.max_size * 0.9:
+                        break
+                    try:
+                        os.remove(path)
+                        total -= size
+                    except OSError:
+                        pass
+            with self.lock:
+                self.disk_used = total
+        finally:
+            with self.lock:
+                self.evicting = None
+
+    def invalidate(self, key, keep=None):
+        """
+        Remove the tiles of a layer from disk, except those of the generation
+        given as `keep`. Tiles in memory are keyed by generation, so those of
+        previous generations are just never used again.
+        """
+        layer_dir = os.path.join(self.directory, key)
+        if not os.path.isdir(layer_dir):
+            return
+        removed = 0
+        for name in os.listdir(layer_dir):
+            if name != keep:
+                removed += directory_size(os.path.join(layer_dir, name))
+                shutil.rmtree(os.path.join(layer_dir, name), ignore_errors=True)
+        with self.lock:
+            if self.disk_used is not None:
+                self.disk_used = max(self.disk_used - removed, 0)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, memory_tiles=len(self.memory), memory_used=self.memory_used,
+                        memory_size=self.memory_size, disk_used=self.disk_used, max_size=self.max_size)